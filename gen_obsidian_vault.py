@@ -1,5 +1,6 @@
 import os
 import json
+import models_store
 
 
 def write_models_to_obsidian(vault_path):
@@ -29,7 +30,8 @@ def populate_vault(models_json_path, vault_path):
     Links model notes using composite scores to create a relational network of models.
 
     Arguments:
-    - models_json_path: str (path to models.json containing the models data)
+    - models_json_path: str (path to models.json containing the models data,
+      or to a columnar results store directory, see models_store)
     - vault_path: str (path of the vault where the models will be stored)
     """
     # Ensure the models.json file exists
@@ -44,9 +46,12 @@ def populate_vault(models_json_path, vault_path):
     else:
         print(f"Using existing vault at '{vault_path}'.")
 
-    # Load models data from models.json
-    with open(models_json_path, "r", encoding="utf-8") as json_file:
-        models_data = json.load(json_file)
+    # Load models data from models.json (or from the results store)
+    if os.path.isdir(models_json_path):
+        models_data = models_store.load_models_indexes(models_json_path)
+    else:
+        with open(models_json_path, "r", encoding="utf-8") as json_file:
+            models_data = json.load(json_file)
 
     # Validate models data
     if not all(key in models_data for key in ['non_mixed', 'mixed']):
@@ -72,8 +77,10 @@ def populate_vault(models_json_path, vault_path):
         related_models = [m['formula'] for m in similar_models if m != model][:max_links]
         return related_models
 
-    # Write notes for each model category
-    for category, models in models_data.items():
+    # Write notes for each model category (the timed-out fits have no
+    # metrics to write)
+    for category in ('non_mixed', 'mixed'):
+        models = models_data[category]
         category_path = os.path.join(vault_path, category)
         os.makedirs(category_path, exist_ok=True)
 
@@ -0,0 +1,204 @@
+# Bootstrap stability of the best-model selection. The resamples are drawn
+# once, as a (resamples x rows) matrix of how many times each resample draws
+# every row. The non-mixed candidates are fitted on all the resamples at once
+# from resampled Gram matrices (see ols_engine.bootstrap_key_sets); the mixed
+# candidates are fitted with lmer, one resample per task, spread over R worker
+# processes. Every resample is then scored like weighted_evaluation does, and
+# the share of resamples each formula wins is reported with percentile
+# intervals of its metrics.
+import numpy as np
+from tqdm import tqdm
+import ols_engine
+import models_features
+import models_parallel
+import models_terms
+import models_comparison
+from vars_conversion import adapt_r
+
+
+def _set_resample(counts):
+    """
+    Make the R data frame 'df_r' the resample drawing every row of the
+    original data (kept as 'psy_df_full' until it is restored) counts times;
+    None restores it.
+    """
+    import rpy2.robjects
+
+    globalenv = rpy2.robjects.globalenv
+    snapshot = rpy2.robjects.r['exists']('psy_df_full', envir=globalenv, inherits=False)[0]
+    if counts is None:
+        # Drop the snapshot, so the next bootstrap resamples the data df_r
+        # holds then
+        if snapshot:
+            globalenv['df_r'] = globalenv['psy_df_full']
+            rpy2.robjects.r('rm(psy_df_full, psy_rows, envir = globalenv())')
+        return
+    if not snapshot:
+        globalenv['psy_df_full'] = globalenv['df_r']
+    rows = np.repeat(np.arange(1, len(counts) + 1), counts)
+    rpy2.robjects.r.assign('psy_rows', rpy2.robjects.IntVector(rows.tolist()))
+    globalenv['df_r'] = rpy2.robjects.r('psy_df_full[psy_rows, , drop = FALSE]')
+
+
+def _fit_mixed_resample(state, counts):
+    """Worker task of the R worker pool: fit every mixed formula on one resample."""
+    _set_resample(counts)
+    return models_features.fit_mixed_formulas(state['formulas'], state['mixed_engine'])
+
+
+def _resample_metrics(results, metric_keys):
+    """One row of metrics per formula of a resample, NaN for the failed fits."""
+    return np.array([
+        [result[key] for key in metric_keys] if isinstance(result, dict) else [np.nan] * len(metric_keys)
+        for result in results
+    ], dtype=np.float64).reshape(len(results), len(metric_keys))
+
+
+def _selection_stability(formulas, metrics, metric_keys, weights, confidence):
+    """
+    Score every resample like weighted_evaluation (normalizing over the
+    formulas of each resample) and summarize the winners and the metrics.
+
+    Parameters:
+    formulas (list): The formulas.
+    metrics (np.ndarray): Shape (resamples, formulas, metrics), NaN where a fit failed.
+    metric_keys (list): The metrics, in the order of the last axis.
+    weights (dict): The weight of each metric.
+    confidence (float): The coverage of the percentile intervals.
+
+    Returns:
+    list: One dict per formula, the most frequent winners first.
+    """
+    if not formulas:
+        return []
+    resamples = metrics.shape[0]
+    normalized = models_comparison.normalize_metrics(
+        np.moveaxis(metrics, 1, 0), np.array([key in models_comparison.MINIMIZED_METRICS for key in metric_keys])
+    )
+    scores = np.nan_to_num(normalized, nan=0.0) @ np.array([weights.get(key, 0.0) for key in metric_keys])
+    # A formula that failed on a resample cannot win it (nor can any formula
+    # win a resample on which they all failed)
+    scores[np.isnan(metrics).all(axis=2).T] = -np.inf
+    decided = np.isfinite(scores.max(axis=0))
+    wins = np.bincount(np.argmax(scores, axis=0)[decided], minlength=len(formulas))
+
+    tail = (1 - confidence) / 2 * 100
+    with np.errstate(all='ignore'):
+        low, high = np.nanpercentile(metrics, [tail, 100 - tail], axis=0)
+    summary = []
+    for j, formula in enumerate(formulas):
+        entry = {'formula': formula, 'win_frequency': float(wins[j] / resamples)}
+        for m, key in enumerate(metric_keys):
+            entry[key] = [float(low[j, m]), float(high[j, m])]
+        summary.append(entry)
+    return sorted(summary, key=lambda entry: -entry['win_frequency'])
+
+
+def bootstrap_indexes(
+    df, model_formulas, n_resamples=1000, weights=None, confidence=0.95, seed=0, r_jobs=1,
+    df_r=None, mixed_engine="batched", resample_chunk=100,
+):
+    """
+    Estimate how stable the choice of the best model is: how often each
+    formula would win models_comparison.weighted_evaluation across bootstrap
+    resamples of the rows, and percentile intervals of its metrics.
+
+    Meant for a shortlist of candidates (e.g. the top_k models of
+    weighted_evaluation): every candidate is fitted on every resample.
+    Non-mixed formulas the column-sliced engine cannot handle (see
+    ols_engine.parse_formula) are left out.
+
+    Parameters:
+    df (pd.DataFrame): The input DataFrame containing the data.
+    model_formulas (list): The candidate formulas.
+    n_resamples (int): The number of bootstrap resamples.
+    weights (dict): The weight of each metric (see weighted_evaluation);
+    models_comparison.DEFAULT_WEIGHTS if None.
+    confidence (float): The coverage of the metric intervals.
+    seed (int): The seed of the resamples, for reproducible results.
+    r_jobs (int): Number of R worker processes for the mixed formulas (each
+    fits all of them on one resample at a time); with 1, the embedded R
+    interpreter of this process fits them, on the R data frame 'df_r'.
+    df_r (pd.DataFrame): The R-ready copy of df for the R workers (see
+    vars_conversion.adapt_r). Built from df if None.
+    mixed_engine (str): How mixed formulas are fitted (see
+    models_features.compute_models_indexes).
+    resample_chunk (int): The number of resamples fitted together by the
+    non-mixed engine (bounds the memory of the resampled Gram matrices).
+
+    Returns:
+    dict: 'resamples' and, for 'non_mixed' and 'mixed', one dict per formula
+    with its 'win_frequency' (share of the resamples it wins) and the
+    [low, high] interval of every metric, the most frequent winners first.
+    """
+    if n_resamples < 1:
+        raise ValueError("n_resamples must be at least 1.")
+    if not 0 < confidence < 1:
+        raise ValueError("confidence must be between 0 and 1.")
+    weights = models_comparison.DEFAULT_WEIGHTS if weights is None else weights
+
+    formulas = list(models_terms.unique_formulas(model_formulas, tuple(df.columns)))
+    mixed = [formula for formula in formulas if '|' in formula]
+
+    # The non-mixed formulas the engine supports, by response variable
+    designs, by_design = {}, {}
+    for formula in formulas:
+        parsed = None if '|' in formula else ols_engine.parse_formula(formula)
+        if parsed is None:
+            continue
+        if parsed[0] not in designs:
+            designs[parsed[0]] = ols_engine.build_design(df, parsed[0])
+        keys = None if designs[parsed[0]] is None else ols_engine.term_blocks(designs[parsed[0]], parsed[1])
+        if keys is None:
+            print(f"Warning: Model '{formula}' cannot be bootstrapped by the column-sliced engine; skipping it.")
+            continue
+        by_design.setdefault(parsed[0], []).append((formula, keys))
+    non_mixed = [formula for candidates in by_design.values() for formula, _ in candidates]
+
+    # Draw the resamples once: how many times each resample draws every row
+    n = df.shape[0]
+    rng = np.random.default_rng(seed)
+    counts = np.empty((n_resamples, n), dtype=np.uint16)
+    for start in range(0, n_resamples, resample_chunk):
+        counts[start:start + resample_chunk] = rng.multinomial(n, np.full(n, 1 / n), size=min(resample_chunk, n_resamples - start))
+
+    non_mixed_metrics = np.empty((n_resamples, len(non_mixed), len(models_comparison.NON_MIXED_METRICS)))
+    progress = tqdm(total=n_resamples * bool(non_mixed) + n_resamples * bool(mixed), desc="Bootstrapping models", unit="resample")
+    try:
+        for start in range(0, n_resamples * bool(non_mixed), resample_chunk):
+            column = 0
+            for response, candidates in by_design.items():
+                fitted = ols_engine.bootstrap_key_sets(
+                    designs[response], [keys for _, keys in candidates], counts[start:start + resample_chunk]
+                )
+                for m, key in enumerate(models_comparison.NON_MIXED_METRICS):
+                    non_mixed_metrics[start:start + resample_chunk, column:column + len(candidates), m] = fitted[key]
+                column += len(candidates)
+            progress.update(min(resample_chunk, n_resamples - start))
+
+        mixed_metrics = np.empty((n_resamples, len(mixed), len(models_comparison.MIXED_METRICS)))
+        if mixed:
+            if r_jobs > 1:
+                with models_parallel.start_r_pool(adapt_r(df) if df_r is None else df_r, r_jobs,
+                                                  state={'formulas': mixed, 'mixed_engine': mixed_engine}) as r_pool:
+                    futures = models_parallel.submit_chunks(r_pool, _fit_mixed_resample, list(counts))
+                    for b, results in enumerate(models_parallel.collect_chunks(
+                            futures, range(n_resamples), on_done=lambda b, results: progress.update(1))):
+                        mixed_metrics[b] = _resample_metrics(results, models_comparison.MIXED_METRICS)
+            else:
+                try:
+                    for b in range(n_resamples):
+                        _set_resample(counts[b])
+                        results = models_features.fit_mixed_formulas(mixed, mixed_engine)
+                        mixed_metrics[b] = _resample_metrics(results, models_comparison.MIXED_METRICS)
+                        progress.update(1)
+                finally:
+                    _set_resample(None)
+    finally:
+        progress.close()
+
+    return {
+        'resamples': n_resamples,
+        'non_mixed': _selection_stability(non_mixed, non_mixed_metrics, models_comparison.NON_MIXED_METRICS, weights, confidence),
+        'mixed': _selection_stability(mixed, mixed_metrics, models_comparison.MIXED_METRICS, weights, confidence),
+    }
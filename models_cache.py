@@ -0,0 +1,222 @@
+# Persistent fit cache shared across runs. Results are stored in an SQLite
+# database keyed by a content hash of the (converted) DataFrame and the
+# normalised (canonical) formula, so rerunning a sweep on the same data with a slightly
+# different predictor list only fits the formulas never seen before.
+# The least recently used results are evicted when the cache grows over its
+# size limit; the total size is kept up to date in the open cache, so storing
+# results never scans the whole table.
+import json
+import time
+import sqlite3
+import hashlib
+from models_checkpoint import dataset_fingerprint, fit_variant
+from models_terms import canonical_formula
+
+
+def normalise_formula(formula, variables=()):
+    """
+    Normalise a formula for use as a cache key: formulas describing the same
+    model ("y ~ b + a" and "y ~ a + b") get the same key.
+
+    Parameters:
+    formula (str): The model formula.
+    variables (tuple): The variable names of the dataset (see
+    models_terms.parse_model).
+
+    Returns:
+    str: The canonical formula (see models_terms.canonical_formula) without
+    whitespace, or just the formula without whitespace if it cannot be
+    parsed (R/Patsy formulas ignore whitespace).
+    """
+    return "".join(canonical_formula(formula, tuple(variables)).split())
+
+
+def _cache_key(fingerprint, formula, variant="", variables=()):
+    text = f"{fingerprint}\n{normalise_formula(formula, variables)}" + (f"\n{variant}" if variant else "")
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def open_cache(cache_file, max_bytes=256 * 1024 ** 2, variant="", variables=()):
+    """
+    Open (or create) the fit cache.
+
+    Parameters:
+    cache_file (str): Path of the SQLite cache file.
+    max_bytes (int): Size limit of the stored results; the least recently
+    used ones are evicted above it.
+    variant (str): The settings that change the non-mixed results (e.g. the
+    cross-validation metrics); results cached with other settings are not
+    reused.
+    variables (tuple): The variable names of the dataset (e.g. its columns),
+    used to key the results by canonical formula.
+
+    Returns:
+    dict: The open cache, to be passed to the other functions.
+    """
+    connection = sqlite3.connect(cache_file)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS fits ("
+        "key TEXT PRIMARY KEY, fingerprint TEXT, formula TEXT, "
+        "result TEXT, size INTEGER, last_access REAL)"
+    )
+    connection.execute("CREATE INDEX IF NOT EXISTS fits_last_access ON fits (last_access)")
+    connection.execute("CREATE INDEX IF NOT EXISTS fits_fingerprint ON fits (fingerprint)")
+    connection.commit()
+    return {
+        'connection': connection,
+        'max_bytes': max_bytes,
+        'variant': variant,
+        'variables': tuple(variables),
+        'total': _total_size(connection),
+    }
+
+
+def _total_size(connection):
+    return connection.execute("SELECT COALESCE(SUM(size), 0) FROM fits").fetchone()[0]
+
+
+def _stored_sizes(connection, keys):
+    """The sizes of the results already stored under some keys, by key."""
+    sizes = {}
+    # Stay below SQLite's limit on query parameters
+    for i in range(0, len(keys), 500):
+        chunk = keys[i:i + 500]
+        sizes.update(connection.execute(
+            f"SELECT key, size FROM fits WHERE key IN ({', '.join('?' * len(chunk))})", chunk
+        ).fetchall())
+    return sizes
+
+
+def get_cached(cache, fingerprint, formulas):
+    """
+    Look up the cached results of formulas fitted on a dataset, marking them
+    as recently used.
+
+    Parameters:
+    cache (dict): The cache returned by open_cache.
+    fingerprint (str): The dataset fingerprint (see models_checkpoint.dataset_fingerprint).
+    formulas (list): The model formulas.
+
+    Returns:
+    dict: The cached metrics dict of every formula found, by formula.
+    """
+    connection = cache['connection']
+    keys = {
+        _cache_key(fingerprint, formula, fit_variant(formula, cache['variant']), cache['variables']): formula
+        for formula in formulas
+    }
+    found = {}
+    key_list = list(keys)
+    # Stay below SQLite's limit on query parameters
+    for i in range(0, len(key_list), 500):
+        chunk = key_list[i:i + 500]
+        rows = connection.execute(
+            f"SELECT key, result FROM fits WHERE key IN ({', '.join('?' * len(chunk))})", chunk
+        ).fetchall()
+        for key, result in rows:
+            result = json.loads(result)
+            result['formula'] = keys[key]
+            found[keys[key]] = result
+        connection.executemany(
+            "UPDATE fits SET last_access = ? WHERE key = ?", [(time.time(), key) for key, _ in rows]
+        )
+    connection.commit()
+    return found
+
+
+def put_cached(cache, fingerprint, formulas, results):
+    """
+    Store results in the cache, then evict the least recently used ones if
+    the cache is over its size limit. Failed fits are not cached.
+
+    Parameters:
+    cache (dict): The cache returned by open_cache.
+    fingerprint (str): The dataset fingerprint.
+    formulas (list): The fitted formulas.
+    results (list): One metrics dict, or the exception that prevented the
+    fit, per formula.
+    """
+    rows = []
+    for formula, result in zip(formulas, results):
+        if isinstance(result, Exception):
+            continue
+        payload = json.dumps(result)
+        key = _cache_key(fingerprint, formula, fit_variant(formula, cache['variant']), cache['variables'])
+        rows.append((key, fingerprint, formula, payload, len(payload), time.time()))
+
+    connection = cache['connection']
+    # A result stored again replaces the previous one
+    replaced = _stored_sizes(connection, list({row[0]: None for row in rows}))
+    new_sizes = {row[0]: row[4] for row in rows}
+    connection.executemany("INSERT OR REPLACE INTO fits VALUES (?, ?, ?, ?, ?, ?)", rows)
+    connection.commit()
+    cache['total'] += sum(new_sizes.values()) - sum(replaced.values())
+    evict(cache)
+
+
+def evict(cache):
+    """
+    Delete the least recently used results until the cache fits its size limit.
+
+    Parameters:
+    cache (dict): The cache returned by open_cache.
+
+    Returns:
+    int: The number of evicted results.
+    """
+    connection = cache['connection']
+    excess = cache['total'] - cache['max_bytes']
+    if excess <= 0:
+        return 0
+
+    evicted = []
+    for key, size in connection.execute("SELECT key, size FROM fits ORDER BY last_access"):
+        evicted.append((key,))
+        excess -= size
+        cache['total'] -= size
+        if excess <= 0:
+            break
+    connection.executemany("DELETE FROM fits WHERE key = ?", evicted)
+    connection.commit()
+    return len(evicted)
+
+
+def invalidate(cache, df=None, formulas=None):
+    """
+    Remove results from the cache.
+
+    Parameters:
+    cache (dict): The cache returned by open_cache.
+    df (pd.DataFrame): If given, only the results of this dataset are removed.
+    formulas (list): If given, only the results of these formulas are
+    removed (for the given dataset, or for every dataset if df is None).
+
+    Returns:
+    int: The number of removed results.
+    """
+    connection = cache['connection']
+    fingerprint = dataset_fingerprint(df) if df is not None else None
+
+    if formulas is None:
+        if fingerprint is None:
+            removed = connection.execute("DELETE FROM fits").rowcount
+        else:
+            removed = connection.execute("DELETE FROM fits WHERE fingerprint = ?", (fingerprint,)).rowcount
+    else:
+        variables = tuple(df.columns) if df is not None else cache['variables']
+        normalised = {normalise_formula(formula, variables) for formula in formulas}
+        keys = [
+            (key,) for key, formula, row_fingerprint in connection.execute("SELECT key, formula, fingerprint FROM fits")
+            if normalise_formula(formula, variables) in normalised and fingerprint in (None, row_fingerprint)
+        ]
+        connection.executemany("DELETE FROM fits WHERE key = ?", keys)
+        removed = len(keys)
+
+    connection.commit()
+    cache['total'] = _total_size(connection)
+    return removed
+
+
+def close_cache(cache):
+    """Close the cache database."""
+    cache['connection'].close()
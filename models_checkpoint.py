@@ -0,0 +1,187 @@
+# Resumable model sweeps. Every result is appended to a JSON-lines checkpoint
+# as soon as it is computed, keyed by a hash of the formula and a fingerprint
+# of the dataset, so a rerun after a crash or a kernel restart only fits the
+# formulas that are not done yet.
+import os
+import json
+import hashlib
+import pandas as pd
+
+
+def dataset_fingerprint(df):
+    """
+    Compute a content hash of a DataFrame (column names, dtypes and values).
+
+    Parameters:
+    df (pd.DataFrame): The DataFrame.
+
+    Returns:
+    str: A hexadecimal SHA-256 digest.
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps([[str(column), str(dtype)] for column, dtype in df.dtypes.items()]).encode("utf-8"))
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def formula_key(fingerprint, formula, variant=""):
+    """Return the checkpoint key of a formula fitted on a dataset (with the fit settings variant, if any)."""
+    text = f"{fingerprint}\n{formula}" + (f"\n{variant}" if variant else "")
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def fit_variant(formula, variant):
+    """The fit settings variant of a formula: only non-mixed fits depend on it."""
+    return "" if '|' in formula else variant
+
+
+def open_checkpoint(checkpoint_file, df, fingerprint=None, variant=""):
+    """
+    Open (or create) a checkpoint file and load the results it already holds
+    for this dataset.
+
+    A line cut short by a crash while it was written is ignored.
+
+    Parameters:
+    checkpoint_file (str): Path of the JSON-lines checkpoint file.
+    df (pd.DataFrame): The DataFrame the models are fitted on.
+    fingerprint (str): The fingerprint of df, if already computed.
+    variant (str): The settings that change the non-mixed results (e.g. the
+    cross-validation metrics); results stored with other settings are not
+    reused.
+
+    Returns:
+    dict: The open checkpoint, to be passed to the other functions.
+    """
+    fingerprint = dataset_fingerprint(df) if fingerprint is None else fingerprint
+    done = {}
+    complete = True
+    if os.path.exists(checkpoint_file):
+        with open(checkpoint_file, "r", encoding="utf-8") as checkpoint:
+            for line in checkpoint:
+                complete = line.endswith("\n")
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                done[record['key']] = record
+
+    checkpoint = open(checkpoint_file, "a", encoding="utf-8")
+    if not complete:
+        # Terminate the truncated line so the next record starts on its own
+        checkpoint.write("\n")
+
+    return {
+        'path': checkpoint_file,
+        'fingerprint': fingerprint,
+        'variant': variant,
+        'done': done,
+        'file': checkpoint,
+    }
+
+
+def split_done(checkpoint, model_formulas):
+    """
+    Separate the formulas still to be fitted from the ones already in the
+    checkpoint.
+
+    Parameters:
+    checkpoint (dict): The checkpoint returned by open_checkpoint.
+    model_formulas (list): The formulas of the sweep.
+
+    Returns:
+    tuple: (pending formulas, restored non-mixed results, restored mixed
+    results, restored timeout records, number of restored formulas that had
+    failed).
+    """
+    pending, non_mixed_results, mixed_results, timeouts = [], [], [], []
+    failed = 0
+    for formula in model_formulas:
+        record = checkpoint['done'].get(
+            formula_key(checkpoint['fingerprint'], formula, fit_variant(formula, checkpoint['variant']))
+        )
+        if record is None:
+            pending.append(formula)
+        elif record.get('status') == 'timeout':
+            timeouts.append({'formula': formula, 'status': 'timeout', 'error': record['error']})
+        elif 'result' not in record:
+            failed += 1
+        elif record['kind'] == 'mixed':
+            mixed_results.append(record['result'])
+        else:
+            non_mixed_results.append(record['result'])
+    return pending, non_mixed_results, mixed_results, timeouts, failed
+
+
+def write_results(checkpoint, formulas, results):
+    """
+    Append results to the checkpoint and flush them to disk.
+
+    Parameters:
+    checkpoint (dict): The checkpoint returned by open_checkpoint.
+    formulas (list): The fitted formulas.
+    results (list): One metrics dict, or the exception that prevented the
+    fit, per formula. Failed fits are recorded too so they are not retried;
+    fits stopped by a time budget (TimeoutError) get the status "timeout".
+    """
+    for formula, result in zip(formulas, results):
+        variant = fit_variant(formula, checkpoint['variant'])
+        record = {
+            'key': formula_key(checkpoint['fingerprint'], formula, variant),
+            'formula': formula,
+            'kind': 'mixed' if '|' in formula else 'non_mixed',
+        }
+        if variant:
+            record['variant'] = variant
+        if isinstance(result, Exception):
+            record['error'] = str(result)
+            if isinstance(result, TimeoutError):
+                record['status'] = 'timeout'
+        else:
+            record['result'] = result
+        checkpoint['done'][record['key']] = record
+        checkpoint['file'].write(json.dumps(record) + "\n")
+    checkpoint['file'].flush()
+
+
+def close_checkpoint(checkpoint):
+    """Close the checkpoint file."""
+    checkpoint['file'].close()
+
+
+def load_models_indexes(checkpoint_file, df=None):
+    """
+    Rebuild the compute_models_indexes results (sorted by AIC) from a
+    checkpoint without fitting anything.
+
+    Parameters:
+    checkpoint_file (str): Path of the JSON-lines checkpoint file.
+    df (pd.DataFrame): If given, only the results computed on this dataset
+    are kept (the latest one of each formula, whatever its fit settings).
+
+    Returns:
+    dict: A dictionary with keys 'non_mixed', 'mixed' and 'timeouts'.
+    """
+    fingerprint = dataset_fingerprint(df) if df is not None else None
+    models_indexes = {'non_mixed': [], 'mixed': [], 'timeouts': []}
+    with open(checkpoint_file, "r", encoding="utf-8") as checkpoint:
+        records = {}
+        for line in checkpoint:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if fingerprint is None:
+                records[record['key']] = record
+            elif record['key'] == formula_key(fingerprint, record['formula'], record.get('variant', "")):
+                records[record['formula']] = record
+
+    for record in records.values():
+        if record.get('status') == 'timeout':
+            models_indexes['timeouts'].append({'formula': record['formula'], 'status': 'timeout', 'error': record['error']})
+        elif 'result' in record:
+            models_indexes[record['kind']].append(record['result'])
+
+    for kind in ('non_mixed', 'mixed'):
+        models_indexes[kind].sort(key=lambda x: x['aic'])
+    return models_indexes
@@ -1,7 +1,33 @@
 import numpy as np
+import pandas as pd
 import json
 import os
 import sys
+import models_store
+
+# The metrics each kind of model is scored on
+NON_MIXED_METRICS = ['aic', 'bic', 'r_squared', 'adj_r_squared']
+MIXED_METRICS = ['aic', 'bic', 'marginal_r_squared', 'conditional_r_squared']
+
+# Out-of-sample metrics of the non-mixed models, when they were computed
+# (see models_features.compute_models_indexes): scored only if the weights name them
+CV_METRICS = ['press', 'kfold_mse']
+
+# Metrics that should be minimized (all the others are maximized)
+MINIMIZED_METRICS = ['aic', 'bic', 'press', 'kfold_mse']
+
+# Weights of the composite score when none are given
+DEFAULT_WEIGHTS = {
+    'aic': 0.25,
+    'bic': 0.25,
+    'r_squared': 0.25,
+    'adj_r_squared': 0.25,
+    'marginal_r_squared': 0.25,
+    'conditional_r_squared': 0.25
+}
+
+# Largest (models x weight vectors) score block computed at once
+SCORE_BLOCK_SIZE = 4 * 1024 ** 2
 
 
 def normalize_metric(values, reverse=False):
@@ -33,16 +59,233 @@ def normalize_metric(values, reverse=False):
         return None
 
 
-def weighted_evaluation(non_mixed_results, mixed_results, weights=None, models_json_path=None):
+def metrics_matrix(results, metric_keys):
+    """
+    Gather the metrics of the results into one float matrix.
+
+    Parameters:
+    results (list or pd.DataFrame): The result dicts (or one row per model).
+    metric_keys (list): The metrics, one column each.
+
+    Returns:
+    np.ndarray: One row per model, one column per metric, NaN where a model
+    has no value for a metric.
+    """
+    if isinstance(results, pd.DataFrame):
+        return results.reindex(columns=metric_keys).to_numpy(dtype=np.float64, na_value=np.nan)
+    return pd.DataFrame.from_records(results, columns=metric_keys).to_numpy(dtype=np.float64, na_value=np.nan)
+
+
+def normalize_metrics(matrix, reverse):
+    """
+    Normalize every column of a metrics matrix between 0 and 1 at once (see
+    normalize_metric).
+
+    Parameters:
+    matrix (np.ndarray): One row per model, one column per metric, NaN where missing.
+    reverse (np.ndarray): One bool per column, True for the metrics that should be minimized.
+
+    Returns:
+    np.ndarray: The normalized matrix, NaN where missing. Values that are not
+    finite count as missing, so that they cannot stretch the range of the
+    whole column. Columns with a single distinct value cannot be normalized
+    and are all zero.
+    """
+    present = np.isfinite(matrix)
+    with np.errstate(invalid='ignore'):
+        low = np.min(matrix, axis=0, initial=np.inf, where=present)
+        high = np.max(matrix, axis=0, initial=-np.inf, where=present)
+    span = high - low
+    constant = ~(span > 0)
+    if matrix.shape[0] > 1 and constant.any():
+        print("Normalization Error: All values are identical; cannot normalize")
+    span = np.where(constant, 1.0, span)
+    with np.errstate(invalid='ignore'):
+        normalized = np.where(reverse, high - matrix, matrix - low) / span
+    return np.where(present, np.where(constant, 0.0, normalized), np.nan)
+
+
+def top_k_indices(scores, k):
+    """
+    Find the k highest scores without sorting all of them.
+
+    Parameters:
+    scores (np.ndarray): The scores.
+    k (int): How many to return.
+
+    Returns:
+    np.ndarray: The positions of the k highest scores, best first.
+    """
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top], kind='stable')]
+
+
+def composite_scores(results, metric_keys, weights):
+    """
+    Compute the composite score of every model: the weights times its
+    normalized metrics, in one matrix product. A metric a model does not have
+    does not count in its score.
+
+    Parameters:
+    results (list or pd.DataFrame): The result dicts (or one row per model).
+    metric_keys (list): The metrics used in the evaluation.
+    weights (dict): The weight of each metric.
+
+    Returns:
+    np.ndarray: The composite score of every model.
+    """
+    normalized = normalize_metrics(
+        metrics_matrix(results, metric_keys), np.array([key in MINIMIZED_METRICS for key in metric_keys])
+    )
+    return np.nan_to_num(normalized, nan=0.0) @ np.array([weights.get(key, 0.0) for key in metric_keys])
+
+
+def _rows(results, positions):
+    """The result dicts at some positions of a list of results (or DataFrame)."""
+    if isinstance(results, pd.DataFrame):
+        return results.iloc[positions].to_dict('records')
+    return [results[i] for i in positions]
+
+
+def pareto_front(matrix, minimize):
+    """
+    Find the models no other model beats on every metric (the non-dominated
+    models).
+
+    The models are visited in lexicographic order of their metrics, so a
+    model can only be dominated by a model already on the front; the front is
+    checked against blocks of models at once.
+
+    Parameters:
+    matrix (np.ndarray): One row per model, one column per metric (NaN is
+    treated as the worst value).
+    minimize (np.ndarray): One bool per column, True for the metrics that
+    should be minimized.
+
+    Returns:
+    np.ndarray: The positions of the models on the front, in lexicographic order.
+    """
+    costs = np.where(minimize, matrix, -matrix)
+    costs = np.where(np.isnan(costs), np.inf, costs)
+    order = np.lexsort(costs.T[::-1])
+    front = []
+    for start in range(0, len(order), 256):
+        block = order[start:start + 256]
+        if front:
+            front_costs = costs[front]
+            dominated = (np.all(front_costs[None, :, :] <= costs[block][:, None, :], axis=2)
+                         & np.any(front_costs[None, :, :] < costs[block][:, None, :], axis=2)).any(axis=1)
+            block = block[~dominated]
+        for position in block:
+            if front:
+                front_costs = costs[front]
+                if np.any(np.all(front_costs <= costs[position], axis=1) & np.any(front_costs < costs[position], axis=1)):
+                    continue
+            front.append(position)
+    return np.array(front, dtype=np.intp)
+
+
+def weight_sensitivity(results, weight_sets=None, metric_keys=None, n_weightings=200, seed=0):
+    """
+    Check whether the best model holds up under other weightings: score every
+    model under many weight vectors at once (one matrix product of the
+    normalized metrics, see composite_scores), and find the Pareto front of
+    the metrics, which holds every model some weighting could choose.
+
+    Parameters:
+    results (list or pd.DataFrame): The result dicts of one kind of model (or
+    one row per model, e.g. from models_store.read_frame).
+    weight_sets (list): The weightings, as dicts like the weights of
+    weighted_evaluation or as rows of an array (one column per metric). If
+    None, n_weightings random weightings are drawn uniformly from the simplex.
+    metric_keys (list): The metrics scored (NON_MIXED_METRICS, or
+    MIXED_METRICS if the results have 'conditional_r_squared', if None).
+    n_weightings (int): The number of random weightings if weight_sets is None.
+    seed (int): The seed of the random weightings.
+
+    Returns:
+    dict: 'weights' (one row per weighting), 'metric_keys', 'winners' (the
+    best model under each weighting), 'winner_indices' (their positions in
+    results), 'selection_frequency' ((formula, fraction of the weightings
+    choosing it) pairs, most chosen first) and 'pareto_front' (the
+    non-dominated models, by increasing first metric).
+    """
+    if metric_keys is None:
+        mixed = (('conditional_r_squared' in results.columns) if isinstance(results, pd.DataFrame)
+                 else any('conditional_r_squared' in result for result in results))
+        metric_keys = MIXED_METRICS if mixed else NON_MIXED_METRICS
+    if len(results) == 0:
+        raise ValueError("No models to evaluate.")
+
+    if weight_sets is None:
+        weights = np.random.default_rng(seed).dirichlet(np.ones(len(metric_keys)), n_weightings)
+    elif isinstance(weight_sets, np.ndarray):
+        weights = np.asarray(weight_sets, dtype=np.float64)
+    else:
+        weights = np.array([[weight_set.get(key, 0.0) for key in metric_keys] for weight_set in weight_sets], dtype=np.float64)
+    if weights.ndim != 2 or weights.shape[1] != len(metric_keys):
+        raise ValueError(f"weight_sets must have one weight per metric ({', '.join(metric_keys)}).")
+
+    matrix = metrics_matrix(results, metric_keys)
+    minimize = np.array([key in MINIMIZED_METRICS for key in metric_keys])
+    normalized = np.nan_to_num(normalize_metrics(matrix, minimize), nan=0.0)
+
+    # Best model under every weighting, scoring blocks of models at a time
+    best_scores = np.full(len(weights), -np.inf)
+    winner_indices = np.zeros(len(weights), dtype=np.intp)
+    block_size = max(1, SCORE_BLOCK_SIZE // len(weights))
+    for start in range(0, len(normalized), block_size):
+        scores = normalized[start:start + block_size] @ weights.T
+        block_best = np.argmax(scores, axis=0)
+        block_scores = scores[block_best, np.arange(len(weights))]
+        better = block_scores > best_scores
+        best_scores[better] = block_scores[better]
+        winner_indices[better] = block_best[better] + start
+
+    winners = _rows(results, winner_indices)
+    positions, counts = np.unique(winner_indices, return_counts=True)
+    frequency = sorted(
+        zip([winner['formula'] for winner in _rows(results, positions)], (counts / len(weights)).tolist()),
+        key=lambda item: -item[1],
+    )
+    return {
+        'weights': weights,
+        'metric_keys': list(metric_keys),
+        'winners': winners,
+        'winner_indices': winner_indices,
+        'selection_frequency': frequency,
+        'pareto_front': _rows(results, pareto_front(matrix, minimize)),
+    }
+
+
+def weighted_evaluation(
+    non_mixed_results, mixed_results, weights=None, models_json_path=None, top_k=None,
+    store_path=None,
+):
     """
     Perform a weighted evaluation of models based on multiple metrics, appending composite scores
     to each model in models.json.
 
+    The metrics are gathered in one matrix per kind of model and scored at
+    once (see composite_scores).
+
     Parameters:
-    - non_mixed_results (list): A list of dictionaries for non-mixed models.
-    - mixed_results (list): A list of dictionaries for mixed models.
+    - non_mixed_results (list): A list of dictionaries for non-mixed models
+      (or a DataFrame with one row per model, which gets a composite_score column).
+    - mixed_results (list): A list of dictionaries for mixed models (or a DataFrame).
     - weights (dict): A dictionary specifying the weights for each metric.
+      The non-mixed models are also scored on the cross-validation metrics
+      (CV_METRICS, lower is better) the weights name.
     - models_json_path (str): Path to the models.json file to update.
+    - top_k (int): If given, also return the top_k best models of each kind
+      ('non_mixed_top_models' and 'mixed_top_models'), best first.
+    - store_path (str): A columnar results store holding the same results in
+      the same order (see models_store, e.g. read with models_store.read_frame).
+      The composite scores are added to it as a new column, and models.json
+      is not rewritten.
 
     Returns:
     dict: The best models with updated composite scores.
@@ -60,14 +303,7 @@ def weighted_evaluation(non_mixed_results, mixed_results, weights=None, models_j
         sys.exit(1)
     
     if weights is None:
-        weights = {
-            'aic': 0.25,
-            'bic': 0.25,
-            'r_squared': 0.25,
-            'adj_r_squared': 0.25,
-            'marginal_r_squared': 0.25,
-            'conditional_r_squared': 0.25
-        }
+        weights = DEFAULT_WEIGHTS
 
 
     def evaluate(results, metric_keys):
@@ -75,54 +311,52 @@ def weighted_evaluation(non_mixed_results, mixed_results, weights=None, models_j
         Add composite scores to each model and find the best one.
 
         Parameters:
-        - results (list of dict): Models to evaluate.
+        - results (list of dict or pd.DataFrame): Models to evaluate.
         - metric_keys (list of str): Metrics used in evaluation.
 
         Returns:
-        dict: The best model based on the composite score.
+        tuple: The best model based on the composite score, the list of
+        composite scores and the positions of the top_k models.
         """
-        composite_scores = []
-        problematic_models = []
-
-        # Extract metric values for normalization
-        metrics_data = {key: [r.get(key, float('inf')) for r in results] for key in metric_keys}
-        normalized_metrics = {key: normalize_metric(values, reverse=(key in ['aic', 'bic'])) for key, values in metrics_data.items()}
-
-        for i, result in enumerate(results):
-            try:
-                # Calculate composite score and put it in the composite_scores list
-                composite_score = sum(weights[key] * normalized_metrics[key][i] for key in metric_keys if key in result)
-                result['composite_score'] = composite_score
-                composite_scores.append(composite_score)
-            except ValueError as e:
-                formula = result.get('formula', f'Unknown Model {i}')
-                problematic_models.append(f"Error: {e} for model formula '{formula}'")
-
-        # Report problematic models
-        if problematic_models:
-            for error in problematic_models:
-                print(error)
-
-        # Find and return the best model's formula
-        if composite_scores:
-            best_model_index = np.argmax(composite_scores)
-            return results[best_model_index], composite_scores
-        else:
+        if len(results) == 0:
             print("Error: No valid models to evaluate.")
             return None
 
+        scores = composite_scores(results, metric_keys, weights)
+        if isinstance(results, pd.DataFrame):
+            results['composite_score'] = scores
+        else:
+            for result, score in zip(results, scores.tolist()):
+                result['composite_score'] = score
+
+        # Find and return the best model
+        best_model_index = int(np.argmax(scores))
+        best_model = results.iloc[best_model_index].to_dict() if isinstance(results, pd.DataFrame) else results[best_model_index]
+        top = top_k_indices(scores, top_k) if top_k is not None else None
+        return best_model, scores.tolist(), top
+
+    def top_models(results, evaluation):
+        return [] if evaluation is None else _rows(results, evaluation[2])
+
     # Evaluate non-mixed and mixed models (formulae)
-    non_mixed_best_model = evaluate(non_mixed_results, ['aic', 'bic', 'r_squared', 'adj_r_squared'])
-    mixed_best_model = evaluate(mixed_results, ['aic', 'bic', 'marginal_r_squared', 'conditional_r_squared'])
+    non_mixed_evaluation = evaluate(non_mixed_results, NON_MIXED_METRICS + [key for key in CV_METRICS if key in weights])
+    mixed_evaluation = evaluate(mixed_results, MIXED_METRICS)
+
+    # Add the scores to the store as one more column
+    if store_path is not None:
+        for kind, evaluation in (('non_mixed', non_mixed_evaluation), ('mixed', mixed_evaluation)):
+            if evaluation is not None:
+                models_store.add_column(store_path, kind, 'composite_score', evaluation[1])
+        print(f"Added the composite scores to the store '{store_path}'")
 
     # Save the updated results to models.json
-    if models_json_path:
+    elif models_json_path:
         try:
             with open(models_json_path, "r", encoding="utf-8") as json_file:
                 models_data = json.load(json_file)
 
-            models_data['non_mixed'] = non_mixed_results
-            models_data['mixed'] = mixed_results
+            for kind, results in (('non_mixed', non_mixed_results), ('mixed', mixed_results)):
+                models_data[kind] = results.to_dict('records') if isinstance(results, pd.DataFrame) else results
 
             with open(models_json_path, "w", encoding="utf-8") as json_file:
                 json.dump(models_data, json_file, indent=4)
@@ -132,7 +366,11 @@ def weighted_evaluation(non_mixed_results, mixed_results, weights=None, models_j
             print(f"Error updating models.json: {e}")
 
     # Return the best models and composite_scores list
-    return {
-        'non_mixed_best_model': non_mixed_best_model,
-        'mixed_best_model': mixed_best_model
+    best_models = {
+        'non_mixed_best_model': non_mixed_evaluation and non_mixed_evaluation[:2],
+        'mixed_best_model': mixed_evaluation and mixed_evaluation[:2]
     }
+    if top_k is not None:
+        best_models['non_mixed_top_models'] = top_models(non_mixed_results, non_mixed_evaluation)
+        best_models['mixed_top_models'] = top_models(mixed_results, mixed_evaluation)
+    return best_models
@@ -4,11 +4,304 @@ from tqdm import tqdm
 import warnings
 import statsmodels.formula.api as smf
 import gc
+import time
+import numpy as np
 import json
+from itertools import islice
+import ols_engine
+import models_parallel
+import models_checkpoint
+import models_cache
+import models_terms
+import models_store
+from vars_conversion import adapt_r
 
 os.environ['R_HOME'] = '/usr/lib/R'  # Set env variable R_HOME through python
 
-def compute_models_indexes(df, model_formulas, batch_size=10, output_file=os.path.join(os.getcwd(), "models.json")):
+# Non-mixed fitting errors that skip a model instead of stopping the sweep
+FIT_ERRORS = (ZeroDivisionError, FloatingPointError, ValueError, np.linalg.LinAlgError, MemoryError)
+
+
+def _alias_result(result, formula):
+    """Copy the result of a formula to another formula spanning the same column space."""
+    if isinstance(result, Exception):
+        return result
+    alias = dict(result)
+    alias['formula'] = formula
+    alias['alias_of'] = result.get('alias_of', result['formula'])
+    return alias
+
+
+def fit_non_mixed_formulas(
+    df, formulas, engine="batched", designs=None, span_dedupe="structural", cv_metrics=None,
+    cv_folds=10,
+):
+    """
+    Fit a list of non-mixed (OLS) formulas with the chosen engine.
+
+    Parameters:
+    df (pd.DataFrame): The input DataFrame containing the data.
+    formulas (list): Non-mixed model formula strings.
+    engine (str): The fitting engine (see compute_models_indexes).
+    designs (dict): Design caches of ols_engine by response variable, reused
+    across calls. A new cache is used if None.
+    span_dedupe (str): How formulas spanning the same column space are
+    detected (see ols_engine.span_signatures): "structural", "numeric" or
+    None. Each distinct space is fitted once (also across calls sharing
+    designs) and the other formulas get a copy of its metrics, with
+    'alias_of' set to the formula actually fitted.
+    cv_metrics (tuple): Cross-validation metrics added to the results of the
+    formulas the engine supports: "press" and/or "kfold" (see
+    ols_engine.cross_validate_key_sets). None for none.
+    cv_folds (int): The number of folds of "kfold".
+
+    Returns:
+    list: One entry per formula, either its metrics dict or the exception
+    that prevented the fit.
+    """
+    designs = {} if designs is None else designs
+
+    def get_design(formula):
+        parsed = ols_engine.parse_formula(formula)
+        if parsed is None:
+            return None
+        if parsed[0] not in designs:
+            designs[parsed[0]] = ols_engine.build_design(df, parsed[0])
+        return designs[parsed[0]]
+
+    results = [None] * len(formulas)
+    by_design = {}
+    for position, formula in enumerate(formulas):
+        design = get_design(formula)
+        if design is not None:
+            by_design.setdefault(design['response'], []).append(position)
+
+    # Fit every distinct column space once: the first formula spanning it is
+    # fitted, the others (aliases) wait for its result
+    representatives, aliases = {}, {}
+    if span_dedupe is not None:
+        for response, positions in by_design.items():
+            spans = designs[response].setdefault('spans', {})
+            signatures = ols_engine.span_signatures(
+                designs[response], [formulas[position] for position in positions], numeric=span_dedupe == "numeric"
+            )
+            for position, signature in zip(positions, signatures):
+                if signature is None:
+                    continue
+                signature = (response, signature)
+                if signature in spans:
+                    results[position] = _alias_result(spans[signature], formulas[position])
+                elif signature in representatives:
+                    aliases[position] = representatives[signature]
+                else:
+                    representatives[signature] = position
+
+    # Fit all the formulas at once with the batched or incremental engines
+    if engine in ("batched", "incremental"):
+        fit = ols_engine.fit_formulas_batched if engine == "batched" else ols_engine.fit_formulas_incremental
+        for response, positions in by_design.items():
+            positions = [position for position in positions if results[position] is None and position not in aliases]
+            fitted = fit(designs[response], [formulas[position] for position in positions])
+            for position, result in zip(positions, fitted):
+                results[position] = result
+
+    for position, formula in enumerate(formulas):
+        if results[position] is not None or position in aliases:
+            continue
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+
+                if engine in ("lstsq", "gram"):
+                    design = get_design(formula)
+                    if design is not None:
+                        fit = ols_engine.fit_formula_gram if engine == "gram" else ols_engine.fit_formula
+                        results[position] = fit(design, formula)
+
+                if results[position] is None:
+                    model = smf.ols(formula=formula, data=df).fit()
+                    num_params = len(model.params)
+                    num_observations = model.nobs
+                    if model.df_resid <= 0 or num_observations <= num_params:
+                        raise ValueError(
+                            f"Residual degrees of freedom is zero or negative, "
+                            f"or observations ({num_observations}) are <= parameters ({num_params})."
+                        )
+
+                    results[position] = {
+                        'formula': formula,
+                        'aic': model.aic,
+                        'bic': model.bic,
+                        'r_squared': model.rsquared,
+                        'adj_r_squared': model.rsquared_adj,
+                    }
+        except FIT_ERRORS as e:
+            results[position] = e
+
+    # Out-of-sample metrics of the formulas fitted, before they are copied to
+    # their aliases
+    if cv_metrics:
+        for response, positions in by_design.items():
+            positions = [position for position in positions if isinstance(results[position], dict) and 'alias_of' not in results[position]]
+            validated = ols_engine.cross_validate_formulas(
+                designs[response], [formulas[position] for position in positions], cv_metrics, cv_folds
+            )
+            for position, metrics in zip(positions, validated):
+                if metrics is not None:
+                    results[position].update(metrics)
+
+    for signature, position in representatives.items():
+        designs[signature[0]]['spans'][signature] = results[position]
+    for position, representative in aliases.items():
+        results[position] = _alias_result(results[representative], formulas[position])
+
+    return results
+
+
+def _fit_non_mixed_chunk(state, formulas):
+    """Worker task of the process pool: fit a chunk of non-mixed formulas."""
+    designs = state.setdefault('designs', {})
+    return fit_non_mixed_formulas(
+        state['df'], formulas, state['engine'], designs, state['span_dedupe'], state['cv_metrics'], state['cv_folds']
+    )
+
+
+def fit_mixed_formula(formula):
+    """
+    Fit a mixed formula with lme4::lmer on the R data frame 'df_r'.
+
+    Parameters:
+    formula (str): The mixed model formula.
+
+    Returns:
+    dict: The model metrics (AIC, BIC, marginal and conditional R-squared).
+    """
+    lmer_fit = rpy2.robjects.r['lmer'](formula, data=rpy2.robjects.globalenv['df_r'])
+    aic = rpy2.robjects.r['AIC'](lmer_fit)[0]
+    bic = rpy2.robjects.r['BIC'](lmer_fit)[0]
+    r2_values = rpy2.robjects.r['r2'](lmer_fit)
+    marginal_r_squared = r2_values[0]
+    conditional_r_squared = r2_values[1]
+
+    return {
+        'formula': formula,
+        'aic': aic,
+        'bic': bic,
+        'marginal_r_squared': marginal_r_squared[0],
+        'conditional_r_squared': conditional_r_squared[0],
+    }
+
+
+# R function fitting a whole character vector of mixed formulas in one call:
+# one row of AIC, BIC, marginal and conditional R-squared per formula (NA when
+# the fit fails) plus the error message of each failed fit. The matrix is
+# returned flattened by row, which converts back to Python the same way
+# whatever rpy2 converters are active.
+LMER_BATCH_R = """
+function(formulas, data) {
+    metrics <- matrix(NA_real_, nrow = length(formulas), ncol = 4,
+                      dimnames = list(NULL, c("aic", "bic", "marginal_r_squared", "conditional_r_squared")))
+    errors <- character(length(formulas))
+    for (i in seq_along(formulas)) {
+        errors[i] <- tryCatch({
+            fit <- lme4::lmer(as.formula(formulas[i]), data = data)
+            r2_values <- performance::r2(fit)
+            metrics[i, ] <- c(AIC(fit), BIC(fit), r2_values[[1]][1], r2_values[[2]][1])
+            ""
+        }, error = function(e) conditionMessage(e))
+    }
+    list(metrics = as.numeric(t(metrics)), errors = errors)
+}
+"""
+
+
+def fit_mixed_formulas(formulas, mixed_engine="batched"):
+    """
+    Fit a list of mixed formulas with lme4::lmer on the R data frame 'df_r'.
+
+    Parameters:
+    formulas (list): Mixed model formula strings.
+    mixed_engine (str): "batched" sends the whole list to R in a single call
+    and loops over it in R (LMER_BATCH_R), paying the rpy2 conversion and
+    dispatch cost once; "per_formula" calls lmer, AIC, BIC and r2 from Python
+    for every formula (see fit_mixed_formula).
+
+    Returns:
+    list: One entry per formula, either its metrics dict or the exception
+    (a RuntimeError carrying the R error message) that prevented the fit.
+    """
+    if not formulas:
+        return []
+
+    if mixed_engine == "per_formula":
+        results = []
+        for formula in formulas:
+            try:
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore")
+                    results.append(fit_mixed_formula(formula))
+            except rpy2.rinterface_lib.embedded.RRuntimeError as e:
+                # Keep a plain exception, R errors do not always pickle
+                results.append(RuntimeError(str(e)))
+            except (ZeroDivisionError, FloatingPointError, ValueError, MemoryError) as e:
+                results.append(e)
+        return results
+
+    # Define the R function once per R session
+    if not rpy2.robjects.r['exists']('psy_fit_lmer_batch', envir=rpy2.robjects.globalenv, inherits=False)[0]:
+        rpy2.robjects.globalenv['psy_fit_lmer_batch'] = rpy2.robjects.r(LMER_BATCH_R)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        fitted = rpy2.robjects.globalenv['psy_fit_lmer_batch'](
+            rpy2.robjects.StrVector(formulas), rpy2.robjects.globalenv['df_r']
+        )
+    metrics = np.asarray(fitted.rx2('metrics'), dtype=np.float64).reshape(len(formulas), 4)
+    errors = list(fitted.rx2('errors'))
+
+    results = []
+    for formula, row, error in zip(formulas, metrics, errors):
+        if error:
+            results.append(RuntimeError(error))
+        else:
+            results.append({
+                'formula': formula,
+                'aic': float(row[0]),
+                'bic': float(row[1]),
+                'marginal_r_squared': float(row[2]),
+                'conditional_r_squared': float(row[3]),
+            })
+    return results
+
+
+def _fit_mixed_chunk(state, formulas):
+    """
+    Worker task of the R worker pool: fit a chunk of mixed formulas in the
+    worker's own R session.
+    """
+    return fit_mixed_formulas(formulas, state['mixed_engine'])
+
+
+def _fit_mixed_task(state, formula):
+    """Worker task of the killable R worker pool: fit one mixed formula."""
+    return fit_mixed_formulas([formula], state['mixed_engine'])[0]
+
+
+def _report_fit_error(formula, error):
+    """Print why a non-mixed model was skipped."""
+    if isinstance(error, MemoryError):
+        print(f"MemoryError: Issue with model '{formula}': {error}")
+    else:
+        print(f"Warning: Issue with model '{formula}': {error}")
+
+
+def compute_models_indexes(
+    df, model_formulas, batch_size=1000, output_file=os.path.join(os.getcwd(), "models.json"),
+    engine="batched", n_jobs=1, r_jobs=1, df_r=None, r_batch_size=10, mixed_engine="batched",
+    checkpoint_file=None, cache_file=None, cache_max_bytes=256 * 1024 ** 2,
+    span_dedupe="structural", fit_timeout=None, deadline=None, store_path=None, cv_metrics=None,
+    cv_folds=10,
+):
     """
     Evaluate a list of model formulas using linear regression and determine the best model.
     Save results in a JSON file instead of a text file.
@@ -17,71 +310,288 @@ def compute_models_indexes(df, model_formulas, batch_size=10, output_file=os.pat
     df (pd.DataFrame): The input DataFrame containing the data.
 
     model_formulas (list): A list of model formula strings to be evaluated.
+    Any iterable works, e.g. the generator of models_generator.iter_all_models:
+    it is consumed one batch at a time, so the formulas are never all in memory.
+    Formulas describing the same model ("y ~ a + b" and "y ~ b + a") are
+    fitted once, under the first of them as written (see
+    models_terms.unique_formulas).
     
-    batch_size (int): The number of models to process in each batch.
+    batch_size (int): The number of models to process in each batch. With the
+    "batched" engine, the non-mixed formulas of a batch are fitted together.
+    With n_jobs > 1, the non-mixed formulas of a batch are split among the workers.
     
-    output_file (str): The JSON file to write the results to.
+    output_file (str): The JSON file to write the results to (None to only
+    return them).
+
+    store_path (str): Directory of a columnar results store to write the
+    results to (see models_store), as well as or instead of output_file: its
+    columns can be memory-mapped one at a time, and composite scores are
+    added to it without rewriting it.
+
+    cv_metrics (tuple): Out-of-sample metrics added to the non-mixed results,
+    at close to the cost of one fit per model (see
+    ols_engine.cross_validate_key_sets): "press" (leave-one-out PRESS, from
+    the leverages of the single fit) and/or "kfold" ('kfold_mse', the k-fold
+    mean squared prediction error, from downdates of the Gram matrix). Lower
+    is better; models_comparison.weighted_evaluation uses them when its
+    weights name them. The checkpoint and the fit cache only reuse the
+    non-mixed results computed with the same cv_metrics and cv_folds.
+
+    cv_folds (int): The number of folds of "kfold".
+
+    engine (str): How non-mixed formulas are fitted. "batched" solves all the
+    same-size models of a batch with one vectorized call on the shared Gram
+    matrix (see ols_engine.fit_formulas_batched); "incremental" fits the
+    formulas in order, updating one QR factorization from each model to the
+    next (best with the "gray" order of generate_simple_and_additional_models);
+    "lstsq" encodes the design columns once and fits each formula with a single
+    least-squares solve (see ols_engine); "gram" fits each formula from the
+    sub-block of one shared X'X / X'y / y'y Gram matrix, so a fit no longer
+    depends on the number of rows; "statsmodels" calls smf.ols for every
+    formula. Formulas the engine cannot handle always fall back to statsmodels.
+
+    n_jobs (int): Number of worker processes for the non-mixed formulas. The
+    pool is started once for the whole sweep (see models_parallel.start_pool).
+
+    r_jobs (int): Number of R worker processes for the mixed formulas. Each
+    worker runs its own R session (see models_parallel.start_r_pool); with 1,
+    mixed formulas are fitted by the embedded R interpreter of this process.
+
+    df_r (pd.DataFrame): The R-ready copy of df sent once to every R worker
+    (see vars_conversion.adapt_r). Built from df if None.
+
+    r_batch_size (int): The number of mixed formulas fitted per R call (and
+    sent to an R worker per task).
+
+    mixed_engine (str): How mixed formulas are fitted. "batched" fits each
+    group of r_batch_size formulas in a single round trip to R;
+    "per_formula" calls lmer, AIC, BIC and r2 separately for every formula.
+
+    checkpoint_file (str): Path of a JSON-lines checkpoint (see
+    models_checkpoint). Every result is appended to it as soon as it is
+    computed, and formulas already in it for the same dataset are not fitted
+    again, so an interrupted sweep can be resumed by running it again.
+
+    cache_file (str): Path of a persistent fit cache shared across runs (see
+    models_cache). Formulas already fitted on the same data are taken from it
+    instead of being fitted, and new results are added to it.
+
+    cache_max_bytes (int): Size limit of the fit cache (least recently used
+    results are evicted above it).
+
+    span_dedupe (str): Fit the non-mixed formulas spanning the same column
+    space only once, and copy the metrics to the other ones ("alias_of" in
+    their results names the formula actually fitted). "structural" detects
+    formulas expanding to the same design blocks (e.g. interactions of
+    categorical variables), "numeric" also spans equal through collinearity
+    (see ols_engine.span_signatures), None fits every formula.
+
+    fit_timeout (float): Seconds allowed to each mixed fit (None for no
+    limit). The mixed formulas are then fitted one at a time in killable R
+    worker processes (see models_parallel.map_killable, max(r_jobs, 1)
+    workers): a fit over the budget is abandoned, its worker is replaced, and
+    the formula is recorded with status "timeout". Non-mixed fits are
+    vectorized and are only bounded by the deadline.
+
+    deadline (float): Seconds allowed to the whole sweep (None for no limit).
+    When they are over, the fits still running are stopped, the remaining
+    formulas are not fitted, and the models evaluated so far are ranked and
+    written as usual. Mixed formulas are fitted in killable workers as with
+    fit_timeout.
     
     Returns:
-    dict: A dictionary with keys 'non_mixed' and 'mixed' containing lists of model performance metrics.
+    dict: A dictionary with keys 'non_mixed' and 'mixed' containing lists of
+    model performance metrics, and 'timeouts' listing the formulas whose fit
+    ran over fit_timeout (with 'status' "timeout" and the 'error' message).
     """
+    if engine not in ("batched", "incremental", "lstsq", "gram", "statsmodels"):
+        raise ValueError(f"Unknown engine '{engine}'. Use 'batched', 'incremental', 'lstsq', 'gram' or 'statsmodels'.")
+    if mixed_engine not in ("batched", "per_formula"):
+        raise ValueError(f"Unknown mixed_engine '{mixed_engine}'. Use 'batched' or 'per_formula'.")
+    if span_dedupe not in ("structural", "numeric", None):
+        raise ValueError(f"Unknown span_dedupe '{span_dedupe}'. Use 'structural', 'numeric' or None.")
+    if (fit_timeout is not None and fit_timeout <= 0) or (deadline is not None and deadline <= 0):
+        raise ValueError("fit_timeout and deadline must be positive numbers of seconds.")
+    if cv_metrics is not None and not set(cv_metrics) <= {"press", "kfold"}:
+        raise ValueError(f"Unknown cv_metrics {cv_metrics}. Use 'press' and/or 'kfold'.")
+
+    # The sweep stops cleanly at the deadline
+    stop_at = None if deadline is None else time.monotonic() + deadline
+    stopped = False
+
     non_mixed_results = []
     mixed_results = []
+    timeouts = []
 
-    # Process all formulas in batches
-    for i in tqdm(range(0, len(model_formulas), batch_size), desc="Evaluating models"):
-        batch_formulas = model_formulas[i:i + batch_size]
+    fingerprint = None
+    if checkpoint_file is not None or cache_file is not None:
+        fingerprint = models_checkpoint.dataset_fingerprint(df)
 
-        for formula in batch_formulas:
-            result = None
-            try:
-                with warnings.catch_warnings():
-                    warnings.simplefilter("ignore")
+    # Results stored without the requested cross-validation metrics (or with
+    # other folds) are not reused
+    variant = ""
+    if cv_metrics:
+        variant = "cv=" + ",".join(sorted(set(cv_metrics))) + (f";folds={cv_folds}" if "kfold" in cv_metrics else "")
 
-                    if '|' in formula:
-                        try:
-                            lmer_fit = rpy2.robjects.r['lmer'](formula, data=rpy2.robjects.globalenv['df_r'])
-                            aic = rpy2.robjects.r['AIC'](lmer_fit)[0]
-                            bic = rpy2.robjects.r['BIC'](lmer_fit)[0]
-                            r2_values = rpy2.robjects.r['r2'](lmer_fit)
-                            marginal_r_squared = r2_values[0]
-                            conditional_r_squared = r2_values[1]
-    
-                            result = {
-                                'formula': formula,
-                                'aic': aic,
-                                'bic': bic,
-                                'marginal_r_squared': marginal_r_squared[0],
-                                'conditional_r_squared': conditional_r_squared[0],
-                            }
-                            mixed_results.append(result)
-                            
-                        except rpy2.rinterface_lib.embedded.RRuntimeError as e:
-                            print(f"Skipping model '{formula}' due to an error: {e}")
-                    else:
-                        model = smf.ols(formula=formula, data=df).fit()
-                        num_params = len(model.params)
-                        num_observations = model.nobs
-                        if model.df_resid <= 0 or num_observations <= num_params:
-                            raise ValueError(
-                                f"Residual degrees of freedom is zero or negative, "
-                                f"or observations ({num_observations}) are <= parameters ({num_params})."
-                            )
-
-                        result = {
-                            'formula': formula,
-                            'aic': model.aic,
-                            'bic': model.bic,
-                            'r_squared': model.rsquared,
-                            'adj_r_squared': model.rsquared_adj,
-                        }
-                        non_mixed_results.append(result)
-            except (ZeroDivisionError, FloatingPointError, ValueError) as e:
-                print(f"Warning: Issue with model '{formula}': {e}")
-            except MemoryError as e:
-                print(f"MemoryError: Issue with model '{formula}': {e}")
-            
+    # Results of a previous (interrupted) run
+    checkpoint = None
+    if checkpoint_file is not None:
+        checkpoint = models_checkpoint.open_checkpoint(checkpoint_file, df, fingerprint, variant)
+
+    # Results of the formulas fitted on the same data in previous runs
+    cache = None
+    if cache_file is not None:
+        cache = models_cache.open_cache(cache_file, cache_max_bytes, variant, tuple(df.columns))
+
+    def done(formulas, results):
+        # Stream the results to the checkpoint and the cache, and advance the
+        # progress bar
+        if checkpoint is not None:
+            models_checkpoint.write_results(checkpoint, formulas, results)
+        if cache is not None:
+            models_cache.put_cached(cache, fingerprint, formulas, results)
+        progress.update(len(formulas))
+
+    def collect(formulas, results):
+        for formula, result in zip(formulas, results):
+            if isinstance(result, TimeoutError):
+                print(f"Warning: Model '{formula}' stopped: {result}")
+                timeouts.append({'formula': formula, 'status': 'timeout', 'error': str(result)})
+            elif '|' in formula and isinstance(result, RuntimeError):
+                print(f"Skipping model '{formula}' due to an error: {result}")
+            elif isinstance(result, Exception):
+                _report_fit_error(formula, result)
+            else:
+                (mixed_results if '|' in formula else non_mixed_results).append(result)
+
+    # Design caches of the column-sliced engine, one per response variable
+    designs = {}
+
+    # model_formulas may be a generator (see models_generator.iter_all_models):
+    # it is consumed one batch at a time
+    # Drop the formulas describing a model already seen ("y ~ b + a" after
+    # "y ~ a + b") before paying to fit them
+    sized = hasattr(model_formulas, '__len__')
+    model_formulas = models_terms.unique_formulas(model_formulas, tuple(df.columns))
+    if sized:
+        model_formulas = list(model_formulas)
+    total = len(model_formulas) if sized else None
+    progress = tqdm(total=total, desc="Evaluating models", unit="model")
+    restored = cached = 0
+
+    # Worker pools live for the whole sweep; the data is sent to them once
+    pool = None
+    if n_jobs > 1:
+        pool = models_parallel.start_pool(
+            {'df': df, 'engine': engine, 'span_dedupe': span_dedupe, 'cv_metrics': cv_metrics, 'cv_folds': cv_folds}, n_jobs
+        )
+    r_pool = None
+    # Mixed fits that can be stopped run in killable R workers, started at the
+    # first mixed formula
+    killable = fit_timeout is not None or deadline is not None
+    killable_pool = None
+    if r_jobs > 1 and not killable:
+        r_pool = models_parallel.start_r_pool(
+            adapt_r(df) if df_r is None else df_r, r_jobs, state={'mixed_engine': mixed_engine}
+        )
+
+    try:
+        # Process all formulas in batches
+        formulas_iterator = iter(model_formulas)
+        while True:
+            if stop_at is not None and time.monotonic() >= stop_at:
+                stopped = True
+                break
+            batch_formulas = list(islice(formulas_iterator, batch_size))
+            if not batch_formulas:
+                break
+
+            if checkpoint is not None:
+                batch_formulas, non_mixed_done, mixed_done, timeouts_done, failed = models_checkpoint.split_done(checkpoint, batch_formulas)
+                non_mixed_results.extend(non_mixed_done)
+                mixed_results.extend(mixed_done)
+                timeouts.extend(timeouts_done)
+                restored += len(non_mixed_done) + len(mixed_done) + len(timeouts_done) + failed
+                progress.update(len(non_mixed_done) + len(mixed_done) + len(timeouts_done) + failed)
+
+            if cache is not None:
+                found = models_cache.get_cached(cache, fingerprint, batch_formulas)
+                if found:
+                    found_formulas = [formula for formula in batch_formulas if formula in found]
+                    if checkpoint is not None:
+                        models_checkpoint.write_results(checkpoint, found_formulas, [found[formula] for formula in found_formulas])
+                    collect(found_formulas, [found[formula] for formula in found_formulas])
+                    cached += len(found_formulas)
+                    progress.update(len(found_formulas))
+                    batch_formulas = [formula for formula in batch_formulas if formula not in found]
+
+            non_mixed_formulas = [formula for formula in batch_formulas if '|' not in formula]
+            mixed_formulas = [formula for formula in batch_formulas if '|' in formula]
+
+            # Send the batch to the worker pools first, so that OLS and lmer
+            # fits run at the same time
+            if pool is not None:
+                size = max(1, -(-len(non_mixed_formulas) // n_jobs))
+                non_mixed_chunks = [non_mixed_formulas[j:j + size] for j in range(0, len(non_mixed_formulas), size)]
+                non_mixed_futures = models_parallel.submit_chunks(pool, _fit_non_mixed_chunk, non_mixed_chunks)
+            mixed_chunks = [mixed_formulas[j:j + r_batch_size] for j in range(0, len(mixed_formulas), r_batch_size)]
+            if r_pool is not None:
+                mixed_futures = models_parallel.submit_chunks(r_pool, _fit_mixed_chunk, mixed_chunks)
+
+            if pool is not None:
+                chunk_results = models_parallel.collect_chunks(non_mixed_futures, non_mixed_chunks, on_done=done)
+                collect(non_mixed_formulas, [result for results in chunk_results for result in results])
+            else:
+                batch_results = fit_non_mixed_formulas(df, non_mixed_formulas, engine, designs, span_dedupe, cv_metrics, cv_folds)
+                done(non_mixed_formulas, batch_results)
+                collect(non_mixed_formulas, batch_results)
+
+            if killable and mixed_formulas:
+                if killable_pool is None:
+                    killable_pool = models_parallel.start_killable_r_pool(
+                        adapt_r(df) if df_r is None else df_r, max(r_jobs, 1), state={'mixed_engine': mixed_engine}
+                    )
+                fitted = models_parallel.map_killable(
+                    killable_pool, _fit_mixed_task, mixed_formulas, fit_timeout, stop_at,
+                    on_done=lambda formula, result: done([formula], [result]),
+                )
+                # Formulas left undone at the deadline have no result
+                stopped = stopped or any(result is None for result in fitted)
+                chunk_results = [[result for result in fitted if result is not None]]
+                mixed_formulas = [formula for formula, result in zip(mixed_formulas, fitted) if result is not None]
+            elif r_pool is not None:
+                chunk_results = models_parallel.collect_chunks(mixed_futures, mixed_chunks, on_done=done)
+            else:
+                chunk_results = []
+                for chunk in mixed_chunks:
+                    chunk_results.append(fit_mixed_formulas(chunk, mixed_engine))
+                    done(chunk, chunk_results[-1])
+            collect(mixed_formulas, [result for results in chunk_results for result in results])
+
+            # Collect garbage once per batch: a full collection per formula
+            # costs more than a column-sliced fit
             gc.collect()
+            if stopped:
+                break
+    finally:
+        progress.close()
+        if pool is not None:
+            models_parallel.stop_pool(pool)
+        if r_pool is not None:
+            r_pool.shutdown()
+        if killable_pool is not None:
+            models_parallel.stop_killable_pool(killable_pool)
+        if checkpoint is not None:
+            models_checkpoint.close_checkpoint(checkpoint)
+        if cache is not None:
+            models_cache.close_cache(cache)
+
+    if stopped:
+        print(f"Warning: The deadline of {deadline} s was reached; ranking the {progress.n} models evaluated so far.")
+    if restored:
+        print(f"Resumed from '{checkpoint_file}': {restored} models were already evaluated.")
+    if cached:
+        print(f"Took {cached} models from the fit cache '{cache_file}'.")
 
     # Sort results by AIC
     non_mixed_results = sorted(non_mixed_results, key=lambda x: x['aic'])
@@ -90,8 +600,16 @@ def compute_models_indexes(df, model_formulas, batch_size=10, output_file=os.pat
     models_indexes = {
         'non_mixed': non_mixed_results,
         'mixed': mixed_results,
+        'timeouts': timeouts,
     }
 
+    if store_path is not None:
+        models_store.write_store(store_path, models_indexes)
+        print(f"Results successfully written to the store '{store_path}'")
+
+    if output_file is None:
+        return models_indexes
+
     try:
         with open(output_file, "w", encoding="utf-8") as json_file:
             json.dump(models_indexes, json_file, indent=4)
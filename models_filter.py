@@ -1,72 +1,177 @@
 # A “nonsense‐filtering” function that tries to catch the most common causes
 # of infeasible models (in particular, random‐effects terms that blow up the
-# number of parameters relative to the data size).
+# number of parameters relative to the data size, or near-collinear
+# predictors).
 
-import re
+import numpy as np
 import pandas as pd
+import ols_engine
+from models_terms import Model, RANDOM_EFFECT_PATTERN, parse_model, used_variables
 
-def filter_dumb_models(df, model_list):
+# Numeric grouping variables with more levels than this are treated as continuous
+MAX_NUMERIC_GROUPING_LEVELS = 10
+
+
+def column_stats(df, columns=None):
+    """
+    Scan the columns once and index the statistics the feasibility checks
+    need, so that checking a formula never touches the data again.
+
+    Args:
+        df (pd.DataFrame): The dataset.
+        columns (list): The columns to index (all of them if None).
+
+    Returns:
+        dict: 'n' (the number of rows) and 'columns', with for every column
+        'levels' (its number of distinct observed values), 'numeric' (numeric dtype),
+        'categorical' (dummy-coded in a formula: non-numeric or boolean),
+        'min_rows_per_level' and 'max_rows_per_level'.
+    """
+    stats = {'n': df.shape[0], 'columns': {}}
+    for column in df.columns if columns is None else columns:
+        series = df[column]
+        # Only the observed levels count: value_counts lists the unused
+        # categories of a Categorical too (with a count of 0)
+        rows_per_level = series.value_counts()
+        rows_per_level = rows_per_level[rows_per_level > 0]
+        stats['columns'][column] = {
+            'levels': len(rows_per_level),
+            'numeric': pd.api.types.is_numeric_dtype(series),
+            'categorical': pd.api.types.is_bool_dtype(series) or not pd.api.types.is_numeric_dtype(series),
+            'min_rows_per_level': int(rows_per_level.min()) if len(rows_per_level) else 0,
+            'max_rows_per_level': int(rows_per_level.max()) if len(rows_per_level) else 0,
+        }
+    return stats
+
+
+def grouping_levels(stats, grouping_var):
+    """
+    Count the levels of a grouping variable, if it can be one.
+
+    Args:
+        stats (dict): The column statistics returned by column_stats.
+        grouping_var (str): The candidate grouping variable.
+
+    Returns:
+        int: The number of levels, or None if the variable is not in the
+        DataFrame or is numeric with more than MAX_NUMERIC_GROUPING_LEVELS levels.
+    """
+    # If the grouping variable is not in the DataFrame, it cannot be used
+    column = stats['columns'].get(grouping_var)
+    if column is None:
+        return None
+    
+    # If grouping var is purely numeric/float with large cardinality, usually dumb
+    # (Unless you explicitly turned it into a categorical or few-level factor)
+    if column['numeric'] and column['levels'] > MAX_NUMERIC_GROUPING_LEVELS:
+        return None
+    return column['levels']
+
+
+def max_random_effects(stats, unique_levels):
+    """
+    The largest number of random effects (intercept + slopes) per level of a
+    grouping variable that keeps the model identifiable: the total,
+    (intercept + slopes) * number_of_levels, must stay below N.
+
+    Args:
+        stats (dict): The column statistics returned by column_stats.
+        unique_levels (int): The number of levels of the grouping variable.
+
+    Returns:
+        int: The maximum number of random effects per level (0 if none fits).
+    """
+    return (stats['n'] - 1) // max(unique_levels, 1)
+
+
+def fixed_effect_params(stats, model):
+    """
+    Count the fixed-effect parameters (design columns) of a model the way
+    Patsy codes it: a categorical variable contributes its levels minus one
+    dummies, and an interaction the product of the contributions of its
+    variables, counting only the columns not already spanned by the
+    lower-order terms (as in ols_engine.term_blocks).
+
+    Args:
+        stats (dict): The column statistics returned by column_stats.
+        model (Model): The model (see models_terms).
+
+    Returns:
+        int: The number of fixed-effect parameters, intercept included.
+    """
+    columns = stats['columns']
+    blocks = {frozenset()}
+    for mask in model.terms:
+        names = [model.variables[i] for i in range(mask.bit_length()) if mask >> i & 1]
+        numeric = frozenset(name for name in names if not columns[name]['categorical'])
+        categorical = [name for name in names if columns[name]['categorical']]
+        for code in range(2 ** len(categorical)):
+            blocks.add(numeric.union(name for j, name in enumerate(categorical) if code >> j & 1))
+
+    params = 0
+    for block in blocks:
+        size = 1
+        for name in block:
+            if columns[name]['categorical']:
+                size *= columns[name]['levels'] - 1
+        params += size
+    return params
+
+
+def filter_dumb_models(df, model_list, stats=None):
     """
     Removes model formulas that are unlikely to be computed successfully,
     mainly where the random-effects structure implies more parameters than data.
     
     Args:
         df (pd.DataFrame): The dataset.
-        model_list (list): A list of R/Patsy-style formulas.
+        model_list (list): A list of R/Patsy-style formulas (or models_terms.Model
+            tuples, e.g. from models_generator.iter_all_model_terms).
+        stats (dict): The column statistics of df (see column_stats), to reuse
+            across calls; computed once if None.
 
     Returns:
         list: A filtered list of model formulas that are more likely to be feasible.
     """
     filtered = []
-    n = df.shape[0]  # total number of observations
-    
-    # Regex to find random-effects terms of the form (something | groupingVar)
-    random_effect_pattern = r"\((.*?)\s*\|\s*(.*?)\)"
+    columns = tuple(df.columns)
+    stats = column_stats(df) if stats is None else stats
     
     for formula in model_list:
-        # Find all random-effect blocks, e.g. "(1 + x | group)" => [("1 + x", "group")]
-        random_effects = re.findall(random_effect_pattern, formula)
+        # Parse the formula once into its terms, e.g.
+        # "y ~ x + (1 + x | group)" => one random block on group with intercept and one slope
+        model = formula if isinstance(formula, Model) else parse_model(formula, columns)
+        if model is None:
+            # Formulas the parser does not understand cannot be checked: keep
+            # them, unless a random block groups on a variable that is not in
+            # the DataFrame
+            groupings = [grouping.strip() for _, grouping in RANDOM_EFFECT_PATTERN.findall(formula)]
+            if all(grouping in columns for grouping in groupings):
+                filtered.append(formula)
+            continue
+        
+        # Models on variables that are not in the DataFrame (or not indexed
+        # in stats) cannot be checked
+        if not stats['columns'].keys() >= used_variables(model):
+            continue
+        
+        # As many fixed-effect parameters as observations: no residual
+        # degrees of freedom left (OLS and mixed models alike)
+        if fixed_effect_params(stats, model) >= stats['n']:
+            continue
         
         skip_this_formula = False
         
-        for rand_part, grouping_var in random_effects:
-            # If the grouping variable is not in the DataFrame, skip immediately
-            if grouping_var not in df.columns:
-                skip_this_formula = True
-                break
-            
-            # Count unique levels
-            unique_levels = df[grouping_var].nunique()
-            
-            # If grouping var is purely numeric/float with large cardinality, usually dumb
-            # (Unless you explicitly turned it into a categorical or few-level factor)
-            if pd.api.types.is_numeric_dtype(df[grouping_var]) and unique_levels > 10:
+        for grouping, intercept, slopes in model.random:
+            unique_levels = grouping_levels(stats, model.variables[grouping])
+            if unique_levels is None:
                 skip_this_formula = True
                 break
             
-            # Split the random part by '+' to count intercept vs slopes
-            # e.g. "1 + x + y" => intercept=1 + 2 slopes
-            #      "0 + x + y" => no intercept, 2 slopes
-            # We remove spaces to avoid splitting on them
-            terms = rand_part.replace(" ", "").split("+")
-            
-            random_intercepts = 0
-            random_slopes = 0
-            for t in terms:
-                if t == '1':
-                    random_intercepts += 1
-                elif t.startswith("0"):
-                    # "0" means no intercept, so we ignore that piece
-                    pass
-                else:
-                    # anything else is presumably a slope
-                    random_slopes += 1
-            
-            # Total random effects = (intercepts + slopes) * number_of_levels
-            total_rand_effects = (random_intercepts + random_slopes) * unique_levels
-            
-            # If that total is >= N, it's probably unidentifiable
-            if total_rand_effects >= n:
+            # lme4 fits a random intercept unless the block starts with "0",
+            # so "(x | g)" has an intercept and a slope. If the total random
+            # effects are >= N, it's probably unidentifiable
+            if int(intercept) + len(slopes) > max_random_effects(stats, unique_levels):
                 skip_this_formula = True
                 break
         
@@ -74,3 +179,130 @@ def filter_dumb_models(df, model_list):
             filtered.append(formula)
     
     return filtered
+
+
+def _scaled_eigh(xtx):
+    """Eigendecompose stacked correlation-scaled Grams; zero-variance columns give a zero eigenvalue."""
+    scale = np.sqrt(np.einsum('...ii->...i', xtx))
+    constant = scale == 0
+    scale = np.where(constant, 1.0, scale)
+    correlation = xtx / (scale[..., :, None] * scale[..., None, :])
+    correlation = np.where(constant[..., :, None] | constant[..., None, :], 0.0, correlation)
+    return np.linalg.eigh(correlation)
+
+
+def _collinearity(eigenvalues, eigenvectors):
+    """
+    VIFs (the diagonal of the inverse correlation matrix) and condition
+    numbers (sqrt(largest / smallest eigenvalue), of the scaled design) of
+    stacked correlation matrices; infinite when singular.
+    """
+    singular = eigenvalues[..., 0] <= eigenvalues[..., -1] * eigenvalues.shape[-1] * np.finfo(float).eps
+    safe = np.where(singular[..., None], 1.0, eigenvalues)
+    vif = np.einsum('...ij,...j,...ij->...i', eigenvectors, 1 / safe, eigenvectors)
+    vif[singular] = np.inf
+    with np.errstate(divide='ignore'):
+        condition = np.where(singular, np.inf, np.sqrt(eigenvalues[..., -1] / safe[..., 0]))
+    return vif, condition
+
+
+def collinearity_screen(df, model_list, max_vif=10.0, max_condition=None):
+    """
+    Find the formulas whose fixed-effects design is too collinear, without
+    fitting them.
+
+    The correlation matrix of every design column the formulas use (dummies
+    and interaction columns included) is taken from one shared centered Gram
+    matrix (see ols_engine), and its inverse is computed once: the VIFs of the
+    full column set are upper bounds of the VIF of the same column in any
+    subset, and its condition number bounds the condition number of any
+    subset. Only the formulas using a column over the bound are checked, from
+    their own block of the correlation matrix (one batched eigendecomposition
+    per size). The columns are those of ols_engine's design blocks, which
+    are Patsy's columns except for interactions with a categorical factor
+    whose main effect is missing (same span, another basis).
+
+    Args:
+        df (pd.DataFrame): The dataset.
+        model_list (list): R/Patsy-style formulas (or models_terms.Model tuples);
+            the fixed effects of mixed formulas are screened too.
+        max_vif (float): Largest variance inflation factor accepted (None for no limit).
+        max_condition (float): Largest condition number of the scaled design
+            accepted (None for no limit); 30 is a common threshold.
+
+    Returns:
+        dict: For every formula over a threshold, its 'max_vif' and
+        'condition_number'. Formulas the engine cannot encode are not screened.
+    """
+    columns = tuple(df.columns)
+    by_response = {}
+    for formula in model_list:
+        model = formula if isinstance(formula, Model) else parse_model(formula, columns)
+        if model is None:
+            continue
+        terms = tuple(frozenset(model.variables[i] for i in range(mask.bit_length()) if mask >> i & 1) for mask in model.terms)
+        by_response.setdefault(model.response, []).append((formula, terms))
+
+    flagged = {}
+    for response, candidates in by_response.items():
+        design = ols_engine.build_design(df, response)
+        if design is None:
+            continue
+        key_sets = [(formula, ols_engine.term_blocks(design, terms)) for formula, terms in candidates]
+        key_sets = [(formula, keys) for formula, keys in key_sets if keys is not None]
+
+        # Correlation matrix and inverse of every column used, computed once
+        all_keys = sorted(set().union(*[keys for _, keys in key_sets]), key=lambda key: (len(key), sorted(key)))
+        ols_engine.gram_indices(design, all_keys)
+        gram = design['gram']
+        full_vif, full_condition = _collinearity(*_scaled_eigh(gram['xtx']))
+        vif_limit = np.inf if max_vif is None else max_vif
+        condition_limit = np.inf if max_condition is None else max_condition
+        if full_vif.max(initial=0) <= vif_limit and full_condition <= condition_limit:
+            continue
+        suspicious = full_vif > vif_limit
+
+        # Check the formulas that may be over a threshold, grouped by size
+        groups = {}
+        for formula, keys in key_sets:
+            indices = ols_engine.gram_indices(design, keys)
+            if len(indices) > 1 and (full_condition > condition_limit or suspicious[indices].any()):
+                groups.setdefault(len(indices), []).append((formula, indices))
+        for members in groups.values():
+            indices = np.stack([member_indices for _, member_indices in members])
+            vif, condition = _collinearity(*_scaled_eigh(gram['xtx'][indices[:, :, None], indices[:, None, :]]))
+            max_vifs = vif.max(axis=1)
+            for (formula, _), formula_vif, formula_condition in zip(members, max_vifs, condition):
+                if formula_vif > vif_limit or formula_condition > condition_limit:
+                    flagged[formula] = {'max_vif': float(formula_vif), 'condition_number': float(formula_condition)}
+    return flagged
+
+
+def filter_collinear_models(df, model_list, max_vif=10.0, max_condition=None, action="drop"):
+    """
+    Drop (or flag) the formulas whose fixed-effects design is too collinear
+    before they reach models_features.compute_models_indexes (see
+    collinearity_screen).
+
+    Args:
+        df (pd.DataFrame): The dataset.
+        model_list (list): A list of R/Patsy-style formulas.
+        max_vif (float): Largest variance inflation factor accepted.
+        max_condition (float): Largest condition number accepted.
+        action (str): "drop" removes the collinear formulas; "flag" keeps them
+            and prints a warning for each.
+
+    Returns:
+        list: The formulas kept.
+    """
+    if action not in ("drop", "flag"):
+        raise ValueError(f"Unknown action '{action}'. Use 'drop' or 'flag'.")
+
+    model_list = list(model_list)
+    flagged = collinearity_screen(df, model_list, max_vif, max_condition)
+    if action == "flag":
+        for formula, collinearity in flagged.items():
+            print(f"Warning: Collinear model '{formula}': max VIF {collinearity['max_vif']:.1f}, "
+                  f"condition number {collinearity['condition_number']:.1f}")
+        return list(model_list)
+    return [formula for formula in model_list if formula not in flagged]
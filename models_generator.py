@@ -1,28 +1,31 @@
 import pandas as pd
-from itertools import combinations
+from itertools import chain, combinations
+from models_terms import make_model, to_formula
+from models_filter import column_stats, grouping_levels, max_random_effects
+
+# The model families of generate_all_models
+MODEL_FAMILIES = ("null", "additive", "interaction", "multilevel")
 
 
 # Null models formulas
+def iter_null_models(response_var):
+    yield f"{response_var} ~ 1"
+
+
 def generate_null_models(response_var):
-    models = [f"{response_var} ~ 1"]
+    models = list(iter_null_models(response_var))
     return models
 
 
 # Simple and additional models formulas
-def generate_simple_and_additional_models(df, response_var, predictor_vars):
+def iter_simple_and_additional_models(df, response_var, predictor_vars, order="combinations"):
     """
-    Generate all possible simple and additional model formulas (R/Patsy-style)
-    from response_var and predictor_vars in a DataFrame.
-    
-    Parameters:
-    df (pd.DataFrame): The DataFrame containing the data.
-    response_var (str): The response variable.
-    predictor_vars (list): A list of predictor variable names.
-    
+    Lazily generate the formulas of generate_simple_and_additional_models,
+    one at a time (see that function for the parameters).
+
     Returns:
-    list: A list of model formulas.
+    iterator: The model formulas.
     """
-    
     # Ensure the response_var and predictor_vars are in the DataFrame
     if response_var not in df.columns:
         raise ValueError(f"Response variable '{response_var}' is not in the DataFrame.")
@@ -31,127 +34,263 @@ def generate_simple_and_additional_models(df, response_var, predictor_vars):
         if predictor not in df.columns:
             raise ValueError(f"Predictor variable '{predictor}' is not in the DataFrame.")
     
-    # Initialize the list to hold all model formulas
-    models = []
-    
-    # Generate simple models (one predictor at a time)
-    for predictor in predictor_vars:
-        models.append(f"{response_var} ~ {predictor}")
-    
-    # Generate additional models (combinations of predictors)
-    for i in range(2, len(predictor_vars) + 1):
-        for combo in combinations(predictor_vars, i):
-            models.append(f"{response_var} ~ {' + '.join(combo)}")
-    
-    return models
+    if order not in ("combinations", "gray"):
+        raise ValueError(f"Unknown order '{order}'. Use 'combinations' or 'gray'.")
 
+    # Validate now, generate on demand
+    return map(to_formula, _simple_and_additional_models(response_var, tuple(predictor_vars), order))
 
-# Interaction models formulas
-def generate_interaction_models(df, response_var, predictor_vars):
+
+def _simple_and_additional_models(response_var, variables, order):
+    if order == "gray":
+        # Consecutive Gray codes differ by exactly one bit (one predictor)
+        for i in range(1, 2 ** len(variables)):
+            code = i ^ (i >> 1)
+            yield make_model(response_var, variables, [1 << bit for bit in range(len(variables)) if code >> bit & 1])
+        return
+
+    # Generate simple models (one predictor at a time) and additional models
+    # (combinations of predictors)
+    for i in range(1, len(variables) + 1):
+        for combo in combinations(range(len(variables)), i):
+            yield make_model(response_var, variables, [1 << bit for bit in combo])
+
+
+def generate_simple_and_additional_models(df, response_var, predictor_vars, order="combinations"):
     """
-    Generate all possible interaction model formulas (R/Patsy-style)
+    Generate all possible simple and additional model formulas (R/Patsy-style)
     from response_var and predictor_vars in a DataFrame.
-    Generate models that include both the main effects and the interaction terms.
     
     Parameters:
     df (pd.DataFrame): The DataFrame containing the data.
     response_var (str): The response variable.
     predictor_vars (list): A list of predictor variable names.
+    order (str): "combinations" lists the models by number of predictors;
+    "gray" follows a binary reflected Gray code, so that each model differs
+    from the previous one by adding or dropping a single predictor (the
+    order ols_engine.fit_formulas_incremental is fastest on).
     
     Returns:
     list: A list of model formulas.
     """
+    models = list(iter_simple_and_additional_models(df, response_var, predictor_vars, order=order))
+    return models
+
+
+# Interaction models formulas
+def iter_interaction_models(df, response_var, predictor_vars):
+    """
+    Lazily generate the formulas of generate_interaction_models, one at a
+    time and each exactly once (see that function for the parameters).
+
+    Returns:
+    iterator: The model formulas.
+    """
     if not isinstance(df, pd.DataFrame):
         raise ValueError("df must be a pandas DataFrame")
     if not isinstance(response_var, str):
         raise ValueError("response_var must be a string")
     if not isinstance(predictor_vars, list) or not all(isinstance(var, str) for var in predictor_vars):
         raise ValueError("predictor_vars must be a list of strings")
+
+    # Validate now, generate on demand
+    return map(to_formula, _interaction_models(response_var, tuple(predictor_vars)))
+
+
+def _interaction_models(response_var, variables):
+    # Main effects terms
+    main_effects = [1 << bit for bit in range(len(variables))]
     
-    # Generate main effects formula
-    main_effects = " + ".join(predictor_vars)
-    
-    # List to store the formulas
-    formulas = []
+    # Model with only main effects
+    yield make_model(response_var, variables, main_effects)
     
-    # Add formula with only main effects
-    formulas.append(f"{response_var} ~ {main_effects}")
+    # Generate interaction terms (every pair of the predictors in combo)
+    for i in range(2, len(variables) + 1):
+        for combo in combinations(range(len(variables)), i):
+            interaction_terms = [1 << a | 1 << b for a, b in combinations(combo, 2)]
+            yield make_model(response_var, variables, interaction_terms)
+            yield make_model(response_var, variables, main_effects + interaction_terms)
     
-    # Generate interaction terms
-    for i in range(2, len(predictor_vars) + 1):
-        for combo in combinations(predictor_vars, i):
-            interaction_terms = " + ".join([":".join(pair) for pair in combinations(combo, 2)])
-            formulas.append(f"{response_var} ~ {interaction_terms}")
-            if main_effects:
-                formulas.append(f"{response_var} ~ {main_effects} + {interaction_terms}")
+    # Individual interaction terms combined with main effects (the model
+    # with the interaction term alone was generated above, with its pair)
+    for a, b in combinations(range(len(variables)), 2):
+        for bit in (a, b):
+            yield make_model(response_var, variables, [1 << bit, 1 << a | 1 << b])
+
+
+def generate_interaction_models(df, response_var, predictor_vars):
+    """
+    Generate all possible interaction model formulas (R/Patsy-style)
+    from response_var and predictor_vars in a DataFrame.
+    Generate models that include both the main effects and the interaction terms.
     
-    # Generate individual interaction terms combined with main effects
-    for combo in combinations(predictor_vars, 2):
-        interaction_term = ":".join(combo)
-        formulas.append(f"{response_var} ~ {interaction_term}")
-        for var in combo:
-            formulas.append(f"{response_var} ~ {var} + {interaction_term}")
+    Parameters:
+    df (pd.DataFrame): The DataFrame containing the data.
+    response_var (str): The response variable.
+    predictor_vars (list): A list of predictor variable names.
     
+    Returns:
+    list: A list of model formulas.
+    """
+    formulas = list(iter_interaction_models(df, response_var, predictor_vars))
     return formulas
 
 
 # Multilevel models formulas
-def generate_multilevel_models(df, response_var, predictor_vars):
-    multilevel_models = set()  # Use a set to track unique models
-    
+def multilevel_groupings(df, predictor_vars, prune=True):
+    """
+    Choose the grouping variables of the multilevel models, with the largest
+    random-effects structure each of them can identify (see
+    models_filter.grouping_levels and models_filter.max_random_effects).
+
+    Parameters:
+    df (pd.DataFrame): The DataFrame containing the data.
+    predictor_vars (list): A list of predictor variable names.
+    prune (bool): If False, every predictor is a grouping variable, without limits.
+
+    Returns:
+    dict: The maximum number of random effects (intercept + slopes) per
+    level, by index of the grouping variable in predictor_vars.
+    """
+    if not prune:
+        return {bit: len(predictor_vars) + 1 for bit in range(len(predictor_vars))}
+
+    stats = column_stats(df, predictor_vars)
+    groupings = {}
+    for bit, grouping_var in enumerate(predictor_vars):
+        unique_levels = grouping_levels(stats, grouping_var)
+        if unique_levels is not None and max_random_effects(stats, unique_levels) >= 1:
+            groupings[bit] = max_random_effects(stats, unique_levels)
+    return groupings
+
+
+def iter_multilevel_models(df, response_var, predictor_vars, prune=True):
+    """
+    Lazily generate the formulas of generate_multilevel_models. Each formula
+    is generated exactly once by construction, so no set of the formulas
+    already seen is kept in memory.
+
+    Parameters:
+    df (pd.DataFrame): The DataFrame containing the data.
+    response_var (str): The response variable.
+    predictor_vars (list): A list of predictor variable names.
+    prune (bool): Only generate the models models_filter.filter_dumb_models
+    would keep: no continuous grouping variables, and no random-effects
+    structure with as many parameters as observations.
+
+    Returns:
+    iterator: The model formulas.
+    """
+    groupings = multilevel_groupings(df, predictor_vars, prune)
+    return map(to_formula, _multilevel_models(response_var, tuple(predictor_vars), groupings))
+
+
+def _multilevel_models(response_var, variables, groupings):
+    # Random intercept models
+    for grouping_var in groupings:
+        yield make_model(response_var, variables, random=[(grouping_var, True, ())])
+
     # Generate all combinations of predictors for fixed effects
-    for r in range(1, len(predictor_vars) + 1):
-        for combo in combinations(predictor_vars, r):
-            fixed_effects = ' + '.join(combo)
+    for r in range(1, len(variables) + 1):
+        for combo in combinations(range(len(variables)), r):
+            fixed_effects = [1 << bit for bit in combo]
             
-            for grouping_var in predictor_vars:
-                # Random intercept models
-                random_intercept_formula = f"{response_var} ~ 1 + (1 | {grouping_var})"
-                multilevel_models.add(random_intercept_formula)
-                
-                fixed_effect_random_intercept_formula = f"{response_var} ~ {fixed_effects} + (1 | {grouping_var})"
-                multilevel_models.add(fixed_effect_random_intercept_formula)
+            for grouping_var, max_effects in groupings.items():
+                yield make_model(response_var, variables, fixed_effects, [(grouping_var, True, ())])
                 
                 # Random intercept and slope models
                 if grouping_var not in combo:  # Exclude cases where grouping_var is in the fixed effects
-                    random_intercept_and_slope_formula = f"{response_var} ~ 1 + ({fixed_effects} | {grouping_var})"
-                    multilevel_models.add(random_intercept_and_slope_formula)
-                    
-                    fixed_effect_random_intercept_and_slope_formula = f"{response_var} ~ {fixed_effects} + ({fixed_effects} | {grouping_var})"
-                    multilevel_models.add(fixed_effect_random_intercept_and_slope_formula)
+                    if r + 1 <= max_effects:
+                        yield make_model(response_var, variables, random=[(grouping_var, True, fixed_effects)])
+                        yield make_model(response_var, variables, fixed_effects, [(grouping_var, True, fixed_effects)])
+                    # Random slope model without fixed effects. With grouping_var
+                    # in combo it equals the one of combo without grouping_var
+                    if r <= max_effects:
+                        yield make_model(response_var, variables, random=[(grouping_var, False, fixed_effects)])
                 
                 # Random slope models without intercept, ensuring grouping_var is not involved in random slope
-                random_slope_terms = ' + '.join([var for var in combo if var != grouping_var])
-                if random_slope_terms:  # Only if there's something to add
-                    random_slope_formula = f"{response_var} ~ 1 + (0 + {random_slope_terms} | {grouping_var})"
-                    multilevel_models.add(random_slope_formula)
-                    
-                    fixed_effect_random_slope_formula = f"{response_var} ~ {fixed_effects} + (0 + {random_slope_terms} | {grouping_var})"
-                    multilevel_models.add(fixed_effect_random_slope_formula)
-    
-    return list(multilevel_models)  # Convert set back to list for the final output
+                random_slope_terms = [1 << bit for bit in combo if bit != grouping_var]
+                if random_slope_terms and len(random_slope_terms) <= max_effects:  # Only if there's something to add
+                    yield make_model(response_var, variables, fixed_effects, [(grouping_var, False, random_slope_terms)])
+
+
+def generate_multilevel_models(df, response_var, predictor_vars, prune=True):
+    multilevel_models = list(iter_multilevel_models(df, response_var, predictor_vars, prune=prune))
+    return multilevel_models
 
 
 # Generate all possible models (the meaningful ones)
-def generate_all_models(df, response_var, predictor_vars):
-    null_models = generate_null_models(response_var)
-    simple_and_additional_models = generate_simple_and_additional_models(df, response_var, predictor_vars)
-    interaction_models = generate_interaction_models(df, response_var, predictor_vars)
+def iter_all_model_terms(df, response_var, predictor_vars, order="combinations", families=MODEL_FAMILIES, prune=True):
+    """
+    Lazily generate the models of generate_all_models as canonical
+    models_terms.Model tuples (term bitmasks over predictor_vars), one at a
+    time and each exactly once. Cheap to hash and compare, e.g. to take set
+    differences between the sweeps of two predictor lists.
+
+    Parameters:
+    df (pd.DataFrame): The DataFrame containing the data.
+    response_var (str): The response variable.
+    predictor_vars (list): A list of predictor variable names.
+    order (str): The order of the additive models (see
+    generate_simple_and_additional_models).
+    families (tuple): The model families to generate, among MODEL_FAMILIES
+    (see print_models_amount.plan_sweep to choose them within a budget).
+    Multilevel models are only generated if a predictor is categorical.
+    prune (bool): Skip the infeasible multilevel models while generating
+    them (see iter_multilevel_models).
+
+    Returns:
+    iterator: The models.
+    """
+    # Validate the arguments the way the single families do
+    iter_simple_and_additional_models(df, response_var, predictor_vars, order=order)
+    iter_interaction_models(df, response_var, predictor_vars)
+    for family in families:
+        if family not in MODEL_FAMILIES:
+            raise ValueError(f"Unknown model family '{family}'. Use {', '.join(MODEL_FAMILIES)}.")
+
+    variables = tuple(predictor_vars)
+    models = []
+    if "null" in families:
+        models.append([make_model(response_var, variables)])
+    if "additive" in families:
+        models.append(_simple_and_additional_models(response_var, variables, order))
+    if "interaction" in families:
+        interaction_models = _interaction_models(response_var, variables)
+        # The main effects model is the last additive model (or the null
+        # model, without predictors)
+        if ("additive" if variables else "null") in families:
+            next(interaction_models)
+        models.append(interaction_models)
 
     # Check for 'category' dtype columns
     category_columns = df[predictor_vars].select_dtypes(include='category')
-    if not category_columns.empty:
-        multilevel_models = generate_multilevel_models(df, response_var, predictor_vars)
-        all_models = null_models + simple_and_additional_models + interaction_models + multilevel_models
-    else:
-        all_models = null_models + simple_and_additional_models + interaction_models
-
-    # Remove duplicates
-    unique_models = set()
-    all_models_cleaned = []
-    for string in all_models:
-        if string not in unique_models:
-            all_models_cleaned.append(string)
-            unique_models.add(string)
-    
-    return all_models_cleaned
\ No newline at end of file
+    if "multilevel" in families and not category_columns.empty:
+        models.append(_multilevel_models(response_var, variables, multilevel_groupings(df, predictor_vars, prune)))
+    return chain(*models)
+
+
+def iter_all_models(df, response_var, predictor_vars, order="combinations", families=MODEL_FAMILIES, prune=True):
+    """
+    Lazily generate the formulas of generate_all_models, one at a time and
+    each exactly once, so that even sweeps too large to list can be streamed
+    to models_features.compute_models_indexes.
+
+    Parameters:
+    df (pd.DataFrame): The DataFrame containing the data.
+    response_var (str): The response variable.
+    predictor_vars (list): A list of predictor variable names.
+    order (str): The order of the additive models (see
+    generate_simple_and_additional_models).
+    families (tuple): The model families to generate (see iter_all_model_terms).
+    prune (bool): Skip the infeasible multilevel models (see iter_multilevel_models).
+
+    Returns:
+    iterator: The model formulas.
+    """
+    return map(to_formula, iter_all_model_terms(df, response_var, predictor_vars, order=order, families=families, prune=prune))
+
+
+def generate_all_models(df, response_var, predictor_vars, order="combinations", families=MODEL_FAMILIES, prune=True):
+    all_models = list(iter_all_models(df, response_var, predictor_vars, order=order, families=families, prune=prune))
+    return all_models
@@ -0,0 +1,372 @@
+# Process pools used to spread model fitting over several cores.
+# The data is handed to the workers once: forked workers inherit it from the
+# parent process, and otherwise it is sent once per worker through the pool
+# initializer, never once per task. R workers each run their own R session.
+# Killable pools run one task at a time per worker and terminate the workers
+# whose task runs over its time budget.
+import sys
+import time
+import multiprocessing
+from multiprocessing.connection import wait
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Data shared with the worker processes (see start_pool)
+_state = {}
+
+
+def _init_worker(state):
+    """Pool initializer used when workers cannot be forked."""
+    _state.clear()
+    _state.update(state)
+
+
+def _run_chunk(function, chunk):
+    """Call a worker task with the shared state of its process."""
+    return function(_state, chunk)
+
+
+def start_pool(state, n_jobs):
+    """
+    Start a pool of worker processes sharing some data.
+
+    Parameters:
+    state (dict): Data shared with every worker once, e.g. the DataFrame.
+    Workers may add their own caches to it.
+    n_jobs (int): Number of worker processes.
+
+    Returns:
+    ProcessPoolExecutor: The pool, to be stopped with stop_pool.
+    """
+    _state.clear()
+    _state.update(state)
+    # Fork only on Linux, unless another start method was chosen: on macOS
+    # forking is unsafe with system frameworks (spawn is the default there)
+    if sys.platform.startswith('linux') and multiprocessing.get_start_method(allow_none=True) in (None, 'fork'):
+        # Forked workers inherit the state without any pickling (they are
+        # started on demand, so the state stays set until stop_pool)
+        return ProcessPoolExecutor(max_workers=n_jobs, mp_context=multiprocessing.get_context('fork'))
+    return ProcessPoolExecutor(max_workers=n_jobs, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=_init_worker, initargs=(state,))
+
+
+def stop_pool(executor):
+    """Shut down a pool started by start_pool and release the shared data."""
+    executor.shutdown()
+    _state.clear()
+
+
+def submit_chunks(executor, function, chunks):
+    """
+    Submit function(state, chunk) for every chunk to a pool.
+
+    Parameters:
+    executor (ProcessPoolExecutor): A pool from start_pool or start_r_pool.
+    function (callable): A module-level function taking the shared state dict
+    and a chunk (it is sent to the workers by reference, so it must be
+    importable).
+    chunks (list): The chunks of work, e.g. lists of formulas.
+
+    Returns:
+    list: The futures, in the same order as chunks.
+    """
+    return [executor.submit(_run_chunk, function, chunk) for chunk in chunks]
+
+
+def collect_chunks(futures, chunks, on_done=None):
+    """
+    Wait for submitted chunks and return their results in chunk order.
+
+    Parameters:
+    futures (list): The futures returned by submit_chunks.
+    chunks (list): The submitted chunks.
+    on_done (callable): Called with each chunk and its result as soon as it
+    is done, e.g. to advance a progress bar or stream the results.
+
+    Returns:
+    list: The return values of function, in the same order as chunks.
+    """
+    results = [None] * len(chunks)
+    positions = {future: position for position, future in enumerate(futures)}
+    for future in as_completed(positions):
+        position = positions[future]
+        results[position] = future.result()
+        if on_done is not None:
+            on_done(chunks[position], results[position])
+    return results
+
+
+def map_chunks(function, chunks, state, n_jobs, on_done=None):
+    """
+    Run function(state, chunk) for every chunk in a new pool of worker processes.
+
+    Parameters:
+    function (callable): A module-level worker task (see submit_chunks).
+    chunks (list): The chunks of work.
+    state (dict): Data shared with every worker once.
+    n_jobs (int): Number of worker processes.
+    on_done (callable): Called with each chunk and its result as soon as it is done.
+
+    Returns:
+    list: The return values of function, in the same order as chunks.
+    """
+    if not chunks:
+        return []
+    executor = start_pool(state, min(n_jobs, len(chunks)))
+    try:
+        return collect_chunks(submit_chunks(executor, function, chunks), chunks, on_done)
+    finally:
+        stop_pool(executor)
+
+
+def _init_r_worker(df_r, r_packages, state):
+    """
+    Pool initializer of the R workers: start this process' own embedded R
+    session, load the R packages and transfer df_r to R's global environment.
+    """
+    import rpy2.robjects
+    from rpy2.robjects import pandas2ri
+    from rpy2.robjects.packages import importr
+
+    for package in r_packages:
+        importr(package)
+
+    # Activate pandas to R conversion
+    pandas2ri.activate()
+    rpy2.robjects.globalenv['df_r'] = pandas2ri.py2rpy(df_r)
+
+    _state.clear()
+    _state.update(state)
+
+
+def start_r_pool(df_r, n_jobs, r_packages=('lme4', 'performance'), state=None):
+    """
+    Start a pool of isolated R worker processes. The embedded R interpreter
+    is single-threaded, so this is the only way to fit several lmer models at
+    the same time.
+
+    Workers are always started fresh ("spawn"): forking a process that already
+    runs an embedded R session is not safe. Each worker loads r_packages and
+    receives df_r once, as the R data frame 'df_r'.
+
+    Parameters:
+    df_r (pd.DataFrame): The R-ready DataFrame (see vars_conversion.adapt_r).
+    n_jobs (int): Number of R worker processes.
+    r_packages (tuple): R packages loaded by every worker.
+    state (dict): Other (small) data shared with every worker once.
+
+    Returns:
+    ProcessPoolExecutor: The pool, to be stopped with its shutdown method.
+    """
+    return ProcessPoolExecutor(max_workers=n_jobs, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=_init_r_worker, initargs=(df_r, tuple(r_packages), state or {}))
+
+
+def map_r_chunks(function, chunks, df_r, n_jobs, r_packages=('lme4', 'performance'), state=None, on_done=None):
+    """
+    Run function(state, chunk) for every chunk in a new pool of isolated R
+    worker processes (see start_r_pool).
+
+    Parameters:
+    function (callable): A module-level worker task fitting the chunk with rpy2.
+    chunks (list): The chunks of work, e.g. lists of mixed formulas.
+    df_r (pd.DataFrame): The R-ready DataFrame (see vars_conversion.adapt_r).
+    n_jobs (int): Number of R worker processes.
+    r_packages (tuple): R packages loaded by every worker.
+    state (dict): Other (small) data shared with every worker once.
+    on_done (callable): Called with each chunk and its result as soon as it is done.
+
+    Returns:
+    list: The return values of function, in the same order as chunks.
+    """
+    if not chunks:
+        return []
+    with start_r_pool(df_r, min(n_jobs, len(chunks)), r_packages, state) as executor:
+        return collect_chunks(submit_chunks(executor, function, chunks), chunks, on_done)
+
+
+def _killable_worker(connection, initializer, initargs):
+    """
+    Main loop of a killable worker: initialize, announce it is ready, then
+    run the (function, item) tasks received until None.
+    """
+    if initializer is not None:
+        initializer(*initargs)
+    connection.send(('ready', None))
+    while True:
+        task = connection.recv()
+        if task is None:
+            break
+        function, item = task
+        try:
+            connection.send(('done', function(_state, item)))
+        except Exception as e:
+            # Keep a plain exception, not every exception pickles
+            connection.send(('done', RuntimeError(f"{type(e).__name__}: {e}")))
+    connection.close()
+
+
+def _start_killable_worker(pool):
+    """Start a worker of a killable pool; it is busy until it sends 'ready'."""
+    parent_end, child_end = pool['context'].Pipe()
+    process = pool['context'].Process(
+        target=_killable_worker, args=(child_end, pool['initializer'], pool['initargs']), daemon=True
+    )
+    process.start()
+    child_end.close()
+    return {'process': process, 'connection': parent_end, 'ready': False}
+
+
+def _kill_worker(worker):
+    """Terminate a worker, whatever it is doing."""
+    worker['process'].terminate()
+    worker['process'].join(5)
+    if worker['process'].is_alive():
+        worker['process'].kill()
+        worker['process'].join()
+    worker['connection'].close()
+
+
+def start_killable_pool(n_jobs, initializer=None, initargs=(), start_method='spawn'):
+    """
+    Start a pool of worker processes that can be killed one at a time.
+
+    Unlike a ProcessPoolExecutor, a worker whose task runs over its time
+    budget is terminated and replaced by a fresh one, without stopping the
+    others (see map_killable).
+
+    Parameters:
+    n_jobs (int): Number of worker processes.
+    initializer (callable): Called with initargs in every new worker, e.g.
+    _init_worker with the shared state (a replaced worker runs it again).
+    initargs (tuple): The arguments of initializer.
+    start_method (str): The multiprocessing start method ("spawn" is the only
+    safe one for processes running an embedded R session).
+
+    Returns:
+    dict: The pool, to be stopped with stop_killable_pool.
+    """
+    pool = {
+        'context': multiprocessing.get_context(start_method),
+        'initializer': initializer,
+        'initargs': initargs,
+    }
+    pool['workers'] = [_start_killable_worker(pool) for _ in range(n_jobs)]
+    return pool
+
+
+def start_killable_r_pool(df_r, n_jobs, r_packages=('lme4', 'performance'), state=None):
+    """
+    Start a killable pool of isolated R worker processes (see start_r_pool and
+    start_killable_pool).
+
+    Parameters:
+    df_r (pd.DataFrame): The R-ready DataFrame (see vars_conversion.adapt_r).
+    n_jobs (int): Number of R worker processes.
+    r_packages (tuple): R packages loaded by every worker.
+    state (dict): Other (small) data shared with every worker once.
+
+    Returns:
+    dict: The pool, to be stopped with stop_killable_pool.
+    """
+    return start_killable_pool(n_jobs, _init_r_worker, (df_r, tuple(r_packages), state or {}))
+
+
+def map_killable(pool, function, items, timeout=None, deadline=None, on_done=None):
+    """
+    Run function(state, item) for every item in a killable pool, one item per
+    task.
+
+    A task running longer than timeout is abandoned: its worker is killed and
+    replaced, and the item gets a TimeoutError. When the deadline passes, the
+    running tasks are killed the same way and the items not done yet get no
+    result. The time a worker takes to start (e.g. to load R) is not counted.
+
+    Parameters:
+    pool (dict): A pool from start_killable_pool.
+    function (callable): A module-level function taking the shared state dict
+    and an item.
+    items (list): The items, e.g. formulas.
+    timeout (float): Seconds allowed per task (None for no limit).
+    deadline (float): time.monotonic() value at which everything stops (None
+    for no limit).
+    on_done (callable): Called with each item and its result (or TimeoutError)
+    as soon as it is done.
+
+    Returns:
+    list: The return values of function (a TimeoutError for the tasks over
+    timeout, None for the items left undone at the deadline), in the same
+    order as items.
+    """
+    results = [None] * len(items)
+    workers = pool['workers']
+    pending = list(range(len(items)))[::-1]
+    busy = {}
+
+    def finish(position, result):
+        results[position] = result
+        if on_done is not None:
+            on_done(items[position], result)
+
+    def replace(index):
+        _kill_worker(workers[index])
+        workers[index] = _start_killable_worker(pool)
+
+    while pending or busy:
+        now = time.monotonic()
+        if deadline is not None and now >= deadline:
+            for index in list(busy):
+                busy.pop(index)
+                replace(index)
+            break
+
+        # Hand the next items to the idle workers
+        for index, worker in enumerate(workers):
+            if pending and worker['ready'] and index not in busy:
+                position = pending.pop()
+                worker['connection'].send((function, items[position]))
+                busy[index] = (position, time.monotonic())
+
+        # Wait for a result, a task over its budget or the deadline
+        limits = [] if deadline is None else [deadline]
+        if timeout is not None:
+            limits += [started + timeout for _, started in busy.values()]
+        ready = wait([worker['connection'] for worker in workers],
+                     timeout=max(min(limits) - now, 0) if limits else None)
+
+        for connection in ready:
+            index = next(index for index, worker in enumerate(workers) if worker['connection'] is connection)
+            try:
+                status, result = connection.recv()
+            except EOFError:
+                # The worker died: fail its task, or stop if it never started
+                if not workers[index]['ready']:
+                    raise RuntimeError("A worker process could not be started.")
+                replace(index)
+                if index in busy:
+                    finish(busy.pop(index)[0], RuntimeError("The worker process died."))
+                continue
+            if status == 'ready':
+                workers[index]['ready'] = True
+            else:
+                finish(busy.pop(index)[0], result)
+
+        if timeout is not None:
+            now = time.monotonic()
+            for index, (position, started) in list(busy.items()):
+                if now - started >= timeout:
+                    busy.pop(index)
+                    replace(index)
+                    finish(position, TimeoutError(f"Ran over the time budget of {timeout} s."))
+    return results
+
+
+def stop_killable_pool(pool):
+    """Stop the workers of a pool started by start_killable_pool."""
+    for worker in pool['workers']:
+        if worker['ready']:
+            try:
+                worker['connection'].send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            worker['process'].join(5)
+        _kill_worker(worker)
@@ -0,0 +1,113 @@
+# Successive-halving screening of large sweeps. All the candidate formulas
+# are ranked on a small random subsample of the rows, the best fraction is
+# kept and ranked again on a larger subsample, and so on: only the survivors
+# are fitted on the whole dataset, and only those full-data fits are reported.
+# Subsamples are nested prefixes of one seeded permutation of the rows, so a
+# screening is reproducible.
+import os
+import numpy as np
+import models_features
+import models_terms
+from vars_conversion import adapt_r
+
+
+def _set_r_data(df):
+    """Replace the R data frame 'df_r' used by the in-process mixed fits."""
+    import rpy2.robjects
+    from rpy2.robjects import pandas2ri
+
+    pandas2ri.activate()
+    rpy2.robjects.globalenv['df_r'] = pandas2ri.py2rpy(adapt_r(df))
+
+
+def screening_rounds(n, initial_fraction=0.01, eta=3, min_rows=500):
+    """
+    Compute the subsample sizes of a successive-halving screening.
+
+    Parameters:
+    n (int): Number of rows of the dataset.
+    initial_fraction (float): Fraction of the rows of the first round.
+    eta (int): Growth factor of the subsample between rounds (the kept
+    fraction of the candidates is 1 / eta).
+    min_rows (int): Smallest subsample size.
+
+    Returns:
+    list: The subsample sizes of the screening rounds (all smaller than n;
+    the survivors of the last round are fitted on all the rows).
+    """
+    sizes = []
+    size = max(int(n * initial_fraction), min_rows)
+    while size < n:
+        sizes.append(size)
+        size *= eta
+    return sizes
+
+
+def successive_halving_indexes(
+    df, model_formulas, criterion="aic", initial_fraction=0.01, eta=3, min_rows=500,
+    min_candidates=10, seed=0, output_file=os.path.join(os.getcwd(), "models.json"),
+    batch_size=1000, engine="batched", n_jobs=1, r_jobs=1, mixed_engine="batched",
+):
+    """
+    Evaluate model formulas like models_features.compute_models_indexes, but
+    fit every formula on the whole dataset only if it survives a
+    successive-halving screening on growing random subsamples.
+
+    Non-mixed and mixed formulas are ranked separately (weighted_evaluation
+    picks the best of each kind), and at least min_candidates of each kind
+    survive every round. Formulas that cannot be fitted on a subsample are
+    dropped.
+
+    Parameters:
+    df (pd.DataFrame): The input DataFrame containing the data.
+    model_formulas (list): The model formulas to be evaluated.
+    criterion (str): "aic" or "bic", the criterion the candidates are ranked by.
+    initial_fraction (float): Fraction of the rows of the first round.
+    eta (int): Growth factor of the subsample between rounds; 1 / eta of the
+    candidates is kept after each round.
+    min_rows (int): Smallest subsample size.
+    min_candidates (int): Candidates of each kind always kept.
+    seed (int): Seed of the row permutation, for reproducible screenings.
+    output_file (str): The JSON file to write the full-data results to.
+    batch_size, engine, n_jobs, r_jobs, mixed_engine: see
+    models_features.compute_models_indexes.
+
+    Returns:
+    dict: A dictionary with keys 'non_mixed' and 'mixed' containing the
+    full-data metrics of the surviving models.
+    """
+    if criterion not in ("aic", "bic"):
+        raise ValueError(f"Unknown criterion '{criterion}'. Use 'aic' or 'bic'.")
+    if eta < 2:
+        raise ValueError("eta must be at least 2.")
+
+    candidates = list(models_terms.unique_formulas(model_formulas, tuple(df.columns)))
+    has_mixed = any('|' in formula for formula in candidates)
+    order = np.random.default_rng(seed).permutation(df.shape[0])
+
+    try:
+        for round_number, size in enumerate(screening_rounds(df.shape[0], initial_fraction, eta, min_rows), start=1):
+            sample = df.iloc[np.sort(order[:size])].reset_index(drop=True)
+            if has_mixed and r_jobs == 1:
+                _set_r_data(sample)
+            models_indexes = models_features.compute_models_indexes(
+                sample, candidates, batch_size=batch_size, output_file=None, engine=engine, n_jobs=n_jobs,
+                r_jobs=r_jobs, df_r=adapt_r(sample) if has_mixed and r_jobs > 1 else None, mixed_engine=mixed_engine,
+            )
+
+            survivors = set()
+            for kind in ('non_mixed', 'mixed'):
+                ranked = sorted(models_indexes[kind], key=lambda result: result[criterion])
+                keep = max(len(ranked) // eta, min(min_candidates, len(ranked)))
+                survivors.update(result['formula'] for result in ranked[:keep])
+            print(f"Screening round {round_number}: {len(candidates)} models on {size} rows, {len(survivors)} kept.")
+            candidates = [formula for formula in candidates if formula in survivors]
+    finally:
+        if has_mixed and r_jobs == 1:
+            _set_r_data(df)
+
+    # Only the survivors are fitted on the whole dataset
+    return models_features.compute_models_indexes(
+        df, candidates, batch_size=batch_size, output_file=output_file, engine=engine, n_jobs=n_jobs,
+        r_jobs=r_jobs, mixed_engine=mixed_engine,
+    )
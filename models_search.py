@@ -0,0 +1,398 @@
+# Search strategies that find the best OLS models without fitting every
+# candidate formula first. They all work on the shared Gram matrix of
+# ols_engine, so every fit costs O(k^3) whatever the number of observations.
+# branch_and_bound_models is exact; the stepwise, beam and genetic searches
+# are heuristics that scale to large predictor pools (and to interactions).
+import heapq
+from itertools import combinations
+import numpy as np
+import ols_engine
+from models_terms import make_model, to_formula
+
+
+def _prepare_design(df, response_var, predictor_vars):
+    """
+    Validate the variables and build the ols_engine design cache.
+
+    Returns:
+    tuple: (design, predictor block keys, number of columns per predictor)
+    """
+    if response_var not in df.columns:
+        raise ValueError(f"Response variable '{response_var}' is not in the DataFrame.")
+    for predictor in predictor_vars:
+        if predictor not in df.columns:
+            raise ValueError(f"Predictor variable '{predictor}' is not in the DataFrame.")
+    if not predictor_vars:
+        raise ValueError("predictor_vars must contain at least one predictor.")
+
+    design = ols_engine.build_design(df, response_var)
+    if design is None:
+        raise ValueError(f"Response variable '{response_var}' must be numeric and without missing values.")
+
+    keys, columns = [], []
+    for predictor in predictor_vars:
+        predictor_keys = ols_engine.term_blocks(design, (frozenset([predictor]),))
+        if predictor_keys is None:
+            raise ValueError(f"Predictor variable '{predictor}' has missing values or an unsupported dtype.")
+        keys.append(frozenset([predictor]))
+        columns.append(ols_engine.gram_indices(design, predictor_keys).size)
+
+    return design, keys, columns
+
+
+def _additive_formula(response_var, predictor_vars, subset):
+    """Write the formula of an additive model the way models_generator does."""
+    if not subset:
+        return f"{response_var} ~ 1"
+    return f"{response_var} ~ {' + '.join(predictor_vars[i] for i in sorted(subset))}"
+
+
+def branch_and_bound_models(df, response_var, predictor_vars, top_k=5, min_rcond=1e-10):
+    """
+    Find the exact top-k additive models (every subset of predictor_vars, the
+    null model included) by AIC and by BIC without fitting all 2^p candidates.
+
+    This is a leaps-and-bounds search: the RSS of a model is a lower bound for
+    the RSS of every model nested inside it, and every nested model still
+    contains the predictors fixed on its branch. Together they bound the best
+    AIC/BIC reachable in a branch of the subset lattice, and branches that
+    cannot beat the current k-th best model on either criterion are skipped.
+
+    Parameters:
+    df (pd.DataFrame): The DataFrame containing the data.
+    response_var (str): The response variable.
+    predictor_vars (list): A list of predictor variable names.
+    top_k (int): The number of best models to return for each criterion.
+    min_rcond (float): Reciprocal condition number below which a fit falls
+    back to a QR solve on the data (see ols_engine.fit_key_sets).
+
+    Returns:
+    dict: 'aic' and 'bic' with the top_k model dicts (same keys as the
+    non-mixed results of compute_models_indexes) sorted by that criterion,
+    and 'models_fitted' with the number of models actually fitted.
+    """
+    design, keys, columns = _prepare_design(df, response_var, predictor_vars)
+    n, tss = design['n'], design['tss']
+    models_fitted = 0
+
+    # Max-heaps (negated criterion) holding the current top_k models
+    best = {'aic': [], 'bic': []}
+    counter = 0
+
+    def threshold(criterion):
+        heap = best[criterion]
+        return -heap[0][0] if len(heap) == top_k else np.inf
+
+    def fit(subsets):
+        nonlocal models_fitted, counter
+        key_sets = [[frozenset()] + [keys[i] for i in subset] for subset in subsets]
+        num_params, rank, ssr = ols_engine.fit_key_sets(design, key_sets, min_rcond)
+        models_fitted += len(subsets)
+
+        for j, subset in enumerate(subsets):
+            try:
+                result = {'formula': _additive_formula(response_var, predictor_vars, subset)}
+                result.update(ols_engine.ols_metrics(n, num_params[j], rank[j], ssr[j], tss))
+            except ValueError:
+                continue
+            for criterion in best:
+                counter += 1
+                heapq.heappush(best[criterion], (-result[criterion], counter, result))
+                if len(best[criterion]) > top_k:
+                    heapq.heappop(best[criterion])
+
+        return [(ssr[j], rank[j] == num_params[j]) for j in range(len(subsets))]
+
+    def prunable(fixed, ssr, full_rank):
+        # Every model of the branch contains the fixed predictors; without
+        # collinearity each of their columns adds one to the rank
+        rank = 1 + sum(columns[i] for i in fixed) if full_rank else 1
+        aic, bic, _, _ = ols_engine.information_criteria(n, rank, ssr, tss)
+        return aic > threshold('aic') and bic > threshold('bic')
+
+    # Fit the full model and every model with one predictor dropped, then
+    # drop the weakest predictors first so good models are found early
+    full = tuple(range(len(predictor_vars)))
+    dropped = [tuple(i for i in full if i != j) for j in full]
+    fits = fit([full] + dropped)
+    order = sorted(full, key=lambda j: fits[1 + j][0])
+    known = {frozenset(subset): fits[1 + j] for j, subset in enumerate(dropped)}
+
+    # Each node is (fixed predictors, free predictors): its branch holds
+    # every model between the fixed ones and fixed + free
+    stack = [((), tuple(order), fits[0][0], fits[0][1])]
+    while stack:
+        fixed, free, ssr, full_rank = stack.pop()
+        # The k-th best models may have improved since the node was pushed
+        if prunable(fixed, ssr, full_rank):
+            continue
+        children = [(fixed + free[:i], free[i + 1:]) for i in range(len(free))]
+        subsets = [child_fixed + child_free for child_fixed, child_free in children]
+        if all(frozenset(subset) in known for subset in subsets):
+            child_fits = [known.pop(frozenset(subset)) for subset in subsets]
+        else:
+            child_fits = fit(subsets)
+
+        # Push in reverse so the first child (weakest predictor dropped) is
+        # explored first
+        for (child_fixed, child_free), (ssr, full_rank) in reversed(list(zip(children, child_fits))):
+            if child_free and not prunable(child_fixed, ssr, full_rank):
+                stack.append((child_fixed, child_free, ssr, full_rank))
+
+    return {
+        'aic': [result for _, _, result in sorted(best['aic'], key=lambda item: -item[0])],
+        'bic': [result for _, _, result in sorted(best['bic'], key=lambda item: -item[0])],
+        'models_fitted': models_fitted,
+    }
+
+
+def _term_space(df, response_var, predictor_vars, interactions):
+    """
+    Build the design cache and the candidate terms of a heuristic search: the
+    main effects, plus every pairwise interaction if interactions is True.
+    """
+    design, _, _ = _prepare_design(df, response_var, predictor_vars)
+    terms = [frozenset([predictor]) for predictor in predictor_vars]
+    if interactions:
+        terms += [frozenset(pair) for pair in combinations(predictor_vars, 2)]
+    return design, terms
+
+
+def _term_fitter(design, response_var, predictor_vars, terms, min_rcond):
+    """
+    Make a memoized fitter of models given as sets of indices into terms.
+
+    Returns:
+    tuple: (fit, fitted). fit(models) returns the metrics dict of every model
+    (None if it cannot be fitted), fitting the models not seen yet with one
+    batched call; fitted maps every model fitted so far to its result.
+    """
+    variables = tuple(predictor_vars)
+    index = {name: i for i, name in enumerate(variables)}
+    term_masks = [sum(1 << index[name] for name in term) for term in terms]
+    term_keys = [ols_engine.term_blocks(design, (term,)) for term in terms]
+    n, tss = design['n'], design['tss']
+    fitted = {}
+
+    def fit(models):
+        new = list(dict.fromkeys(model for model in models if model not in fitted))
+        if new:
+            key_sets = [sorted(set().union(*[term_keys[i] for i in model], [frozenset()]),
+                               key=lambda key: (len(key), sorted(key))) for model in new]
+            num_params, rank, ssr = ols_engine.fit_key_sets(design, key_sets, min_rcond)
+            for j, model in enumerate(new):
+                formula = to_formula(make_model(response_var, variables, [term_masks[i] for i in model]))
+                try:
+                    result = {'formula': formula}
+                    result.update(ols_engine.ols_metrics(n, num_params[j], rank[j], ssr[j], tss))
+                except ValueError:
+                    result = None
+                fitted[model] = result
+        return [fitted[model] for model in models]
+
+    return fit, fitted
+
+
+def _criterion_value(result, criterion):
+    return np.inf if result is None else result[criterion]
+
+
+def _search_results(fitted, top_k):
+    """Summarize a search: the top_k models by AIC and by BIC, and the number of models fitted."""
+    results = [result for result in fitted.values() if result is not None]
+    return {
+        'aic': heapq.nsmallest(top_k, results, key=lambda result: result['aic']),
+        'bic': heapq.nsmallest(top_k, results, key=lambda result: result['bic']),
+        'models_fitted': len(fitted),
+    }
+
+
+def _check_criterion(criterion):
+    if criterion not in ("aic", "bic"):
+        raise ValueError(f"Unknown criterion '{criterion}'. Use 'aic' or 'bic'.")
+
+
+def stepwise_models(
+    df, response_var, predictor_vars, criterion="aic", interactions=False, start=None,
+    max_steps=None, top_k=5, min_rcond=1e-10,
+):
+    """
+    Bidirectional stepwise search: starting from a model, add or drop the
+    single term that improves the criterion most, until no move improves it
+    (like R's step with direction = "both"). All the moves of a step are
+    fitted with one batched call.
+
+    Parameters:
+    df (pd.DataFrame): The DataFrame containing the data.
+    response_var (str): The response variable.
+    predictor_vars (list): A list of predictor variable names.
+    criterion (str): "aic" or "bic", the criterion minimized.
+    interactions (bool): Also consider every pairwise interaction term.
+    start (list): The predictors of the starting model (None for the null model).
+    max_steps (int): Maximum number of moves (None for no limit).
+    top_k (int): The number of best models to return for each criterion.
+    min_rcond (float): Reciprocal condition number below which a fit falls
+    back to a QR solve on the data (see ols_engine.fit_key_sets).
+
+    Returns:
+    dict: 'aic' and 'bic' with the top_k model dicts among the models fitted
+    (same keys as the non-mixed results of compute_models_indexes),
+    'models_fitted', 'steps' (the moves made) and 'path' (the formula after
+    every move, starting model first).
+    """
+    _check_criterion(criterion)
+    design, terms = _term_space(df, response_var, predictor_vars, interactions)
+    fit, fitted = _term_fitter(design, response_var, predictor_vars, terms, min_rcond)
+
+    start = start or []
+    for predictor in start:
+        if predictor not in predictor_vars:
+            raise ValueError(f"Start predictor '{predictor}' is not in predictor_vars.")
+    current = frozenset(predictor_vars.index(predictor) for predictor in start)
+    value = _criterion_value(fit([current])[0], criterion)
+    path = [fitted[current]['formula'] if fitted[current] is not None else None]
+
+    steps = 0
+    while max_steps is None or steps < max_steps:
+        moves = [current ^ {i} for i in range(len(terms))]
+        values = [_criterion_value(result, criterion) for result in fit(moves)]
+        best = int(np.argmin(values))
+        if not values[best] < value:
+            break
+        current, value = moves[best], values[best]
+        path.append(fitted[current]['formula'])
+        steps += 1
+
+    results = _search_results(fitted, top_k)
+    results.update({'steps': steps, 'path': path})
+    return results
+
+
+def beam_search_models(
+    df, response_var, predictor_vars, beam_width=5, criterion="aic", interactions=False, top_k=5,
+    min_rcond=1e-10,
+):
+    """
+    Forward beam search: starting from the null model, extend every model of
+    the beam by one term, and keep the beam_width best extensions, until no
+    extension improves on the best model found.
+
+    Parameters:
+    df (pd.DataFrame): The DataFrame containing the data.
+    response_var (str): The response variable.
+    predictor_vars (list): A list of predictor variable names.
+    beam_width (int): The number of models kept at each size (1 is forward
+    stepwise selection).
+    criterion (str): "aic" or "bic", the criterion minimized.
+    interactions (bool): Also consider every pairwise interaction term.
+    top_k (int): The number of best models to return for each criterion.
+    min_rcond (float): Reciprocal condition number below which a fit falls
+    back to a QR solve on the data (see ols_engine.fit_key_sets).
+
+    Returns:
+    dict: 'aic' and 'bic' with the top_k model dicts among the models fitted,
+    'models_fitted' and 'levels' (the number of terms of the last beam).
+    """
+    _check_criterion(criterion)
+    if beam_width < 1:
+        raise ValueError("beam_width must be at least 1.")
+    design, terms = _term_space(df, response_var, predictor_vars, interactions)
+    fit, fitted = _term_fitter(design, response_var, predictor_vars, terms, min_rcond)
+
+    beam = [frozenset()]
+    best_value = _criterion_value(fit(beam)[0], criterion)
+    levels = 0
+    while True:
+        children = list(dict.fromkeys(model | {i} for model in beam for i in range(len(terms)) if i not in model))
+        if not children:
+            break
+        values = [_criterion_value(result, criterion) for result in fit(children)]
+        ranked = sorted(range(len(children)), key=values.__getitem__)[:beam_width]
+        if not values[ranked[0]] < best_value:
+            break
+        best_value = values[ranked[0]]
+        beam = [children[j] for j in ranked if np.isfinite(values[j])]
+        levels += 1
+
+    results = _search_results(fitted, top_k)
+    results['levels'] = levels
+    return results
+
+
+def genetic_search_models(
+    df, response_var, predictor_vars, population_size=50, generations=100, criterion="aic",
+    interactions=False, initial_terms=5, mutation_rate=None, tournament_size=3, elitism=2,
+    patience=20, seed=None, top_k=5, min_rcond=1e-10,
+):
+    """
+    Genetic search over term sets. Each model is a set of terms; every
+    generation keeps the elitism best models and breeds the rest of the
+    population by tournament selection, uniform crossover and mutation (a
+    term is added or dropped with probability mutation_rate). A generation
+    is fitted with one batched call, and models already seen are not refitted.
+
+    Parameters:
+    df (pd.DataFrame): The DataFrame containing the data.
+    response_var (str): The response variable.
+    predictor_vars (list): A list of predictor variable names.
+    population_size (int): The number of models per generation.
+    generations (int): Maximum number of generations.
+    criterion (str): "aic" or "bic", the criterion minimized.
+    interactions (bool): Also consider every pairwise interaction term.
+    initial_terms (float): Expected number of terms of the random initial models.
+    mutation_rate (float): Probability of flipping each term (1 / number of
+    terms if None).
+    tournament_size (int): The number of models competing for each parent.
+    elitism (int): The number of best models copied to the next generation.
+    patience (int): Stop after this many generations without improvement.
+    seed (int): Seed of the random number generator, for reproducible searches.
+    top_k (int): The number of best models to return for each criterion.
+    min_rcond (float): Reciprocal condition number below which a fit falls
+    back to a QR solve on the data (see ols_engine.fit_key_sets).
+
+    Returns:
+    dict: 'aic' and 'bic' with the top_k model dicts among the models fitted,
+    'models_fitted' and 'generations' (the number of generations run).
+    """
+    _check_criterion(criterion)
+    if population_size < 2 or not 0 <= elitism < population_size:
+        raise ValueError("population_size must be at least 2 and elitism between 0 and population_size - 1.")
+    design, terms = _term_space(df, response_var, predictor_vars, interactions)
+    fit, fitted = _term_fitter(design, response_var, predictor_vars, terms, min_rcond)
+    rng = np.random.default_rng(seed)
+    num_terms = len(terms)
+    mutation_rate = 1 / num_terms if mutation_rate is None else mutation_rate
+
+    def evaluate(population):
+        models = [frozenset(np.flatnonzero(row).tolist()) for row in population]
+        return np.array([_criterion_value(result, criterion) for result in fit(models)])
+
+    population = rng.random((population_size, num_terms)) < min(initial_terms / num_terms, 1.0)
+    values = evaluate(population)
+    best_value = values.min()
+    stale = 0
+
+    generation = 0
+    while generation < generations and stale < patience:
+        generation += 1
+        order = np.argsort(values)
+
+        # Tournament selection: the best of tournament_size random models
+        contenders = rng.integers(0, population_size, (2, population_size - elitism, tournament_size))
+        winners = np.take_along_axis(contenders, np.argmin(values[contenders], axis=2)[..., None], axis=2)[..., 0]
+        # Uniform crossover, then mutation
+        children = np.where(rng.random((population_size - elitism, num_terms)) < 0.5,
+                            population[winners[0]], population[winners[1]])
+        children ^= rng.random(children.shape) < mutation_rate
+
+        population = np.concatenate([population[order[:elitism]], children])
+        values = np.concatenate([values[order[:elitism]], evaluate(children)])
+        if values.min() < best_value:
+            best_value = values.min()
+            stale = 0
+        else:
+            stale += 1
+
+    results = _search_results(fitted, top_k)
+    results['generations'] = generation
+    return results
@@ -0,0 +1,216 @@
+# Columnar results store. A sweep's results are kept in a directory with one
+# sub-directory per kind of model ('non_mixed', 'mixed', 'timeouts') and one
+# file per column: numeric metrics are float64 .npy arrays (NaN where a model
+# has no value), text columns (formula, alias_of, ...) are a UTF-8 string table
+# plus an .npy index of (start, length) pairs. Readers memory-map only the
+# columns they need, and a new column (e.g. the composite score) is added as
+# one more file without rewriting the others. models.json stays available
+# through export_json.
+import os
+import json
+import numbers
+import numpy as np
+import pandas as pd
+
+# The kinds of results of models_features.compute_models_indexes
+KINDS = ('non_mixed', 'mixed', 'timeouts')
+
+
+def _save_array(path, array):
+    """Write an .npy file atomically (readers never see half a column)."""
+    with open(path + ".tmp", "wb") as column_file:
+        np.save(column_file, array)
+    os.replace(path + ".tmp", path)
+
+
+def _write_column(kind_path, name, values):
+    """Write one column, numeric if every value is a number (or missing), text otherwise."""
+    values = list(values)
+    if all(value is None or (isinstance(value, numbers.Number) and not isinstance(value, bool)) for value in values):
+        _save_array(os.path.join(kind_path, f"{name}.npy"), np.array(
+            [np.nan if value is None else value for value in values], dtype=np.float64
+        ))
+        return "float"
+
+    encoded = [None if value is None else str(value).encode("utf-8") for value in values]
+    index = np.empty((len(values), 2), dtype=np.int64)
+    start = 0
+    for row, item in enumerate(encoded):
+        # A missing string has length -1
+        index[row] = (start, -1) if item is None else (start, len(item))
+        start += 0 if item is None else len(item)
+    with open(os.path.join(kind_path, f"{name}.utf8.tmp"), "wb") as text_file:
+        text_file.write(b"".join(item for item in encoded if item is not None))
+    os.replace(os.path.join(kind_path, f"{name}.utf8.tmp"), os.path.join(kind_path, f"{name}.utf8"))
+    _save_array(os.path.join(kind_path, f"{name}.index.npy"), index)
+    return "str"
+
+
+def _read_columns_file(kind_path):
+    with open(os.path.join(kind_path, "columns.json"), "r", encoding="utf-8") as columns_file:
+        return json.load(columns_file)
+
+
+def _write_columns_file(kind_path, columns):
+    with open(os.path.join(kind_path, "columns.json.tmp"), "w", encoding="utf-8") as columns_file:
+        json.dump(columns, columns_file)
+    os.replace(os.path.join(kind_path, "columns.json.tmp"), os.path.join(kind_path, "columns.json"))
+
+
+def write_store(store_path, models_indexes):
+    """
+    Write the results of a sweep to a columnar store (replacing the kinds it
+    contains).
+
+    Parameters:
+    store_path (str): The store directory (created if needed).
+    models_indexes (dict): The results, as returned by
+    models_features.compute_models_indexes: a list of result dicts per kind.
+    """
+    for kind, results in models_indexes.items():
+        kind_path = os.path.join(store_path, kind)
+        os.makedirs(kind_path, exist_ok=True)
+        for name in os.listdir(kind_path):
+            os.remove(os.path.join(kind_path, name))
+
+        # Columns in order of first appearance, the formula first
+        names = {'formula': None}
+        for result in results:
+            names.update(dict.fromkeys(result))
+        columns = {'rows': len(results), 'columns': []}
+        for name in names:
+            dtype = _write_column(kind_path, name, (result.get(name) for result in results))
+            columns['columns'].append([name, dtype])
+        _write_columns_file(kind_path, columns)
+
+
+def store_columns(store_path, kind):
+    """
+    List the columns stored for a kind of results.
+
+    Parameters:
+    store_path (str): The store directory.
+    kind (str): 'non_mixed', 'mixed' or 'timeouts'.
+
+    Returns:
+    dict: The type ("float" or "str") of every column, in stored order.
+    """
+    kind_path = os.path.join(store_path, kind)
+    if not os.path.exists(os.path.join(kind_path, "columns.json")):
+        return {}
+    return dict(_read_columns_file(kind_path)['columns'])
+
+
+def read_columns(store_path, kind, columns=None, mmap=True):
+    """
+    Read some columns of a kind of results; only their files are touched.
+
+    Parameters:
+    store_path (str): The store directory.
+    kind (str): 'non_mixed', 'mixed' or 'timeouts'.
+    columns (list): The columns to read (all of them if None).
+    mmap (bool): Memory-map the numeric columns instead of loading them.
+
+    Returns:
+    dict: Every column by name: a float64 array for the numeric ones (NaN
+    where missing), an object array of str (None where missing) for the text
+    ones.
+    """
+    kind_path = os.path.join(store_path, kind)
+    types = store_columns(store_path, kind)
+    columns = list(types) if columns is None else columns
+    unknown = [name for name in columns if name not in types]
+    if unknown:
+        raise ValueError(f"Unknown columns {unknown} in the '{kind}' results of '{store_path}'.")
+
+    data = {}
+    for name in columns:
+        if types[name] == "float":
+            data[name] = np.load(os.path.join(kind_path, f"{name}.npy"), mmap_mode='r' if mmap else None)
+            continue
+        index = np.load(os.path.join(kind_path, f"{name}.index.npy"))
+        with open(os.path.join(kind_path, f"{name}.utf8"), "rb") as text_file:
+            text = text_file.read()
+        data[name] = np.array(
+            [None if length < 0 else text[start:start + length].decode("utf-8") for start, length in index.tolist()],
+            dtype=object,
+        )
+    return data
+
+
+def read_frame(store_path, kind, columns=None):
+    """
+    Read some columns of a kind of results as a DataFrame, e.g. to pass to
+    models_comparison.weighted_evaluation.
+
+    Parameters:
+    store_path (str): The store directory.
+    kind (str): 'non_mixed', 'mixed' or 'timeouts'.
+    columns (list): The columns to read (all of them if None).
+
+    Returns:
+    pd.DataFrame: One row per model, in stored order.
+    """
+    if not store_columns(store_path, kind):
+        return pd.DataFrame(columns=columns)
+    return pd.DataFrame(read_columns(store_path, kind, columns))
+
+
+def add_column(store_path, kind, name, values):
+    """
+    Add (or replace) a column of a kind of results without rewriting the
+    other columns.
+
+    Parameters:
+    store_path (str): The store directory.
+    kind (str): 'non_mixed', 'mixed' or 'timeouts'.
+    name (str): The column name, e.g. 'composite_score'.
+    values (iterable): One value per stored model, in stored order.
+    """
+    kind_path = os.path.join(store_path, kind)
+    columns = _read_columns_file(kind_path)
+    values = list(np.asarray(values).tolist() if isinstance(values, np.ndarray) else values)
+    if len(values) != columns['rows']:
+        raise ValueError(f"Column '{name}' has {len(values)} values, but '{kind}' has {columns['rows']} models.")
+
+    dtype = _write_column(kind_path, name, values)
+    columns['columns'] = [column for column in columns['columns'] if column[0] != name] + [[name, dtype]]
+    _write_columns_file(kind_path, columns)
+
+
+def load_models_indexes(store_path):
+    """
+    Rebuild the compute_models_indexes results from a store.
+
+    Parameters:
+    store_path (str): The store directory.
+
+    Returns:
+    dict: A list of result dicts per kind stored (missing values are left out
+    of the dicts, as in the original results).
+    """
+    models_indexes = {}
+    for kind in KINDS:
+        if not store_columns(store_path, kind):
+            continue
+        data = read_columns(store_path, kind, mmap=False)
+        names = list(data)
+        rows = zip(*[data[name].tolist() for name in names])
+        models_indexes[kind] = [
+            {name: value for name, value in zip(names, row) if value is not None and value == value}
+            for row in rows
+        ]
+    return models_indexes
+
+
+def export_json(store_path, output_file):
+    """
+    Write a store as models.json, for the tools reading the JSON format.
+
+    Parameters:
+    store_path (str): The store directory.
+    output_file (str): The JSON file to write.
+    """
+    with open(output_file, "w", encoding="utf-8") as json_file:
+        json.dump(load_models_indexes(store_path), json_file, indent=4)
+    print(f"Results successfully written to {output_file}")
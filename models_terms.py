@@ -0,0 +1,233 @@
+# Compact canonical representation of model formulas. A model is a response,
+# a set of fixed-effect terms stored as integer bitmasks over an index of
+# variables (bit i set = variable i is in the term, so "a:b" and "b:a" are the
+# same int), and a set of random-effect blocks. Terms and blocks are kept in a
+# canonical order, so two formulas describing the same model give equal (and
+# equally hashed) tuples, and to_formula always writes them the same way.
+import re
+import hashlib
+from collections import deque, namedtuple
+from functools import lru_cache
+
+# response (str): the response variable.
+# variables (tuple): the variable names indexed by the bitmasks.
+# terms (tuple): the fixed-effect term bitmasks (the intercept is implicit).
+# random (tuple): the random-effect blocks, as (grouping variable index,
+# random intercept (bool), tuple of slope term bitmasks).
+Model = namedtuple('Model', ['response', 'variables', 'terms', 'random'])
+
+# Distinct models unique_formulas remembers (about 65 MB of digests): in a
+# longer sweep, only the duplicates among the last DEDUPE_WINDOW models are dropped
+DEDUPE_WINDOW = 500_000
+
+# Random-effect blocks, e.g. "(1 + x | group)"
+RANDOM_EFFECT_PATTERN = re.compile(r"\(([^()|]*)\|([^()|]*)\)")
+
+
+@lru_cache(maxsize=None)
+def _term_order(mask):
+    """Sort key of a term: main effects first, then by variable index."""
+    bits = tuple(i for i in range(mask.bit_length()) if mask >> i & 1)
+    return len(bits), bits
+
+
+def make_model(response, variables, terms=(), random=()):
+    """
+    Build a model in canonical form (duplicate terms removed, terms and
+    random-effect blocks sorted).
+
+    Parameters:
+    response (str): The response variable.
+    variables (tuple): The variable names indexed by the bitmasks.
+    terms (iterable): The fixed-effect term bitmasks.
+    random (iterable): The random-effect blocks, as (grouping variable index,
+    random intercept, slope term bitmasks).
+
+    Returns:
+    Model: The canonical model.
+    """
+    terms = tuple(sorted(set(terms), key=_term_order))
+    random = tuple(sorted(
+        (grouping, bool(intercept), tuple(sorted(set(slopes), key=_term_order)))
+        for grouping, intercept, slopes in random
+    ))
+    return Model(response, variables, terms, random)
+
+
+@lru_cache(maxsize=None)
+def _term_name(variables, mask):
+    return ":".join(variables[i] for i in _term_order(mask)[1])
+
+
+def to_formula(model):
+    """
+    Write a model as an R/Patsy-style formula, in the same style as
+    models_generator (e.g. "y ~ a + b + a:b" or "y ~ 1 + (0 + a | g)").
+
+    Parameters:
+    model (Model): The model.
+
+    Returns:
+    str: The formula.
+    """
+    variables = model.variables
+    fixed = " + ".join([_term_name(variables, mask) for mask in model.terms]) or "1"
+    if not model.random:
+        return f"{model.response} ~ {fixed}"
+
+    blocks = []
+    for grouping, intercept, slopes in model.random:
+        slope_terms = " + ".join([_term_name(variables, mask) for mask in slopes])
+        if not slopes:
+            blocks.append(f"(1 | {variables[grouping]})")
+        elif intercept:
+            blocks.append(f"({slope_terms} | {variables[grouping]})")
+        else:
+            blocks.append(f"(0 + {slope_terms} | {variables[grouping]})")
+    return f"{model.response} ~ {fixed} + {' + '.join(blocks)}"
+
+
+def _parse_terms(text, index):
+    """
+    Parse a sum of terms ("a + b:c + d*e") into (intercept, bitmasks).
+    intercept is None when the sum does not mention it. Returns None on
+    unknown variables or unsupported syntax.
+    """
+    intercept = None
+    masks = []
+    for item in text.split("+"):
+        item = item.strip()
+        if item == "1":
+            intercept = True
+        elif item == "0":
+            intercept = False
+        elif item:
+            factors = [name.strip() for name in item.replace("*", ":").split(":")]
+            if any(name not in index for name in factors):
+                return None
+            bits = [1 << index[name] for name in factors]
+            if "*" in item:
+                # a*b is a + b + a:b: every non-empty product of the factors
+                for code in range(1, 2 ** len(bits)):
+                    masks.append(sum(bit for j, bit in enumerate(bits) if code >> j & 1))
+            else:
+                masks.append(sum(set(bits)))
+    return intercept, masks
+
+
+def parse_model(formula, variables):
+    """
+    Parse a formula into its canonical model.
+
+    Only the syntax used by models_generator is supported: sums of variables,
+    ":" and "*" interactions, "1"/"0" intercepts and "(terms | group)"
+    random-effect blocks.
+
+    Parameters:
+    formula (str): The model formula.
+    variables (tuple): The variable names the bitmasks refer to, e.g. the
+    predictor variables or the DataFrame columns.
+
+    Returns:
+    Model: The canonical model, or None if the formula uses a variable not in
+    variables or unsupported syntax.
+    """
+    if formula.count("~") != 1:
+        return None
+    response, rhs = (part.strip() for part in formula.split("~"))
+    if not response:
+        return None
+    index = {name: i for i, name in enumerate(variables)}
+
+    random = []
+    for rand_part, grouping_var in RANDOM_EFFECT_PATTERN.findall(rhs):
+        grouping_var = grouping_var.strip()
+        parsed = _parse_terms(rand_part, index)
+        if parsed is None or grouping_var not in index:
+            return None
+        intercept, slopes = parsed
+        # lme4 fits a random intercept unless it is removed with "0"
+        intercept = intercept is not False
+        if not intercept and not slopes:
+            return None
+        random.append((index[grouping_var], intercept, slopes))
+
+    fixed = RANDOM_EFFECT_PATTERN.sub("", rhs)
+    if "(" in fixed or "|" in fixed or not (fixed.strip(" +") or random):
+        return None
+    parsed = _parse_terms(fixed, index)
+    if parsed is None or parsed[0] is False:
+        # Models without the fixed intercept are not supported
+        return None
+    return make_model(response, tuple(variables), parsed[1], random)
+
+
+def used_variables(model):
+    """
+    List the variables a model actually uses: its response, the variables of
+    its fixed and random terms and its grouping variables.
+
+    Parameters:
+    model (Model): The model.
+
+    Returns:
+    set: The variable names.
+    """
+    masks = set(model.terms)
+    used = {model.response}
+    for grouping, _, slopes in model.random:
+        used.add(model.variables[grouping])
+        masks.update(slopes)
+    mask = 0
+    for term in masks:
+        mask |= term
+    used.update(model.variables[i] for i in range(mask.bit_length()) if mask >> i & 1)
+    return used
+
+
+def canonical_formula(formula, variables):
+    """
+    Rewrite a formula (or a Model) in canonical form, so that formulas that
+    describe the same model ("y ~ a + b" and "y ~ b + a") become equal.
+
+    Parameters:
+    formula (str or Model): The model formula or model.
+    variables (tuple): The variable names (see parse_model).
+
+    Returns:
+    str: The canonical formula, or formula unchanged if it cannot be parsed.
+    """
+    if isinstance(formula, Model):
+        return to_formula(formula)
+    model = parse_model(formula, variables)
+    return formula if model is None else to_formula(model)
+
+
+def unique_formulas(formulas, variables, window=DEDUPE_WINDOW):
+    """
+    Lazily drop the formulas describing a model already seen ("y ~ b + a"
+    after "y ~ a + b"). The first formula of every model is kept as written.
+
+    Models are compared by an 8-byte digest of their canonical formula, and
+    only the last window distinct models are remembered, so the memory stays
+    bounded on a streamed sweep (a duplicate further back is not dropped).
+
+    Parameters:
+    formulas (iterable): The model formulas (or Models).
+    variables (tuple): The variable names (see parse_model).
+    window (int): The number of distinct models remembered.
+
+    Returns:
+    iterator: The formulas, each model once (Models written with to_formula).
+    """
+    seen, order = set(), deque()
+    for formula in formulas:
+        canonical = canonical_formula(formula, variables)
+        digest = hashlib.blake2b(canonical.encode("utf-8"), digest_size=8).digest()
+        if digest in seen:
+            continue
+        seen.add(digest)
+        order.append(digest)
+        if len(order) > window:
+            seen.discard(order.popleft())
+        yield canonical if isinstance(formula, Model) else formula
@@ -0,0 +1,1047 @@
+# A column-sliced OLS engine for the fixed-effects (non-mixed) formulas.
+# Instead of letting Patsy re-parse every formula and rebuild the whole design
+# matrix from the DataFrame, every main-effect and interaction block is encoded
+# once and cached. Each formula is then fitted by stacking the blocks it needs
+# and running a single least-squares solve.
+#
+# Categorical factors are expanded the way Patsy does it: a term with numeric
+# factors N and categorical factors C spans the blocks N x (reduced coding of S)
+# for every subset S of C. Those "elementary blocks" span exactly the same
+# column space as Patsy's design, so the statsmodels metrics (which only depend
+# on the column space and its rank) are reproduced.
+import numpy as np
+import pandas as pd
+from itertools import combinations
+from scipy.linalg import solve_triangular
+
+
+def parse_formula(formula):
+    """
+    Split a fixed-effects R/Patsy-style formula into its response and terms.
+
+    Only the syntax produced by models_generator is understood: terms joined by
+    '+', interactions written with ':' and an optional explicit '1'.
+
+    Parameters:
+    formula (str): The model formula, e.g. "y ~ a + b + a:b".
+
+    Returns:
+    tuple: (response, terms) where terms is a tuple of frozensets of variable
+    names, or None if the formula uses syntax the engine does not handle
+    (random effects, functions, '*', '-', '0', ...).
+    """
+    if formula.count('~') != 1 or '|' in formula:
+        return None
+
+    response, rhs = (part.strip() for part in formula.split('~'))
+    if not response.isidentifier():
+        return None
+
+    terms = []
+    for term in rhs.split('+'):
+        term = term.strip()
+        if term == '1':
+            continue
+        factors = [factor.strip() for factor in term.split(':')]
+        if not all(factor.isidentifier() for factor in factors):
+            return None
+        term = frozenset(factors)
+        if term not in terms:
+            terms.append(term)
+
+    return response, tuple(terms)
+
+
+def _encode_variable(series):
+    """
+    Encode a single DataFrame column for the engine.
+
+    Parameters:
+    series (pd.Series): The column to encode.
+
+    Returns:
+    tuple: ('numeric', 1-D float array) or ('categorical', 2-D reduced
+    (treatment) dummy matrix), or None if the column cannot be encoded here.
+    """
+    if series.isna().any():
+        return None
+
+    if pd.api.types.is_bool_dtype(series) or not pd.api.types.is_numeric_dtype(series):
+        if pd.api.types.is_datetime64_any_dtype(series) or pd.api.types.is_timedelta64_dtype(series):
+            return None
+        codes, _ = pd.factorize(series, sort=True)
+        levels = np.unique(codes)
+        # Treatment coding: the first observed level is absorbed by the intercept
+        dummies = (codes[:, None] == levels[None, 1:]).astype(np.float64)
+        return 'categorical', dummies
+
+    return 'numeric', series.to_numpy(dtype=np.float64)
+
+
+def build_design(df, response_var):
+    """
+    Create an (initially empty) design cache for the given response variable.
+    Predictor columns and interaction blocks are encoded lazily, the first
+    time a formula needs them, and reused for every following formula.
+
+    Parameters:
+    df (pd.DataFrame): The input DataFrame containing the data.
+    response_var (str): The response variable.
+
+    Returns:
+    dict: The design cache, or None if the response cannot be handled by the
+    engine (missing values or a non-numeric response).
+    """
+    if response_var not in df.columns:
+        return None
+
+    y = df[response_var]
+    if y.isna().any() or pd.api.types.is_bool_dtype(y) or not pd.api.types.is_numeric_dtype(y):
+        return None
+
+    y = y.to_numpy(dtype=np.float64)
+    return {
+        'df': df,
+        'response': response_var,
+        'y': y,
+        'n': y.shape[0],
+        'tss': float(np.sum((y - y.mean()) ** 2)),
+        'variables': {},
+        'blocks': {frozenset(): np.ones((y.shape[0], 1))},
+    }
+
+
+def _variable(design, name):
+    """Return the cached encoding of a predictor column, encoding it if needed."""
+    if name not in design['variables']:
+        df = design['df']
+        design['variables'][name] = _encode_variable(df[name]) if name in df.columns else None
+    return design['variables'][name]
+
+
+def _block(design, key):
+    """
+    Return the columns of an elementary block: the product of its numeric
+    variables times the row-wise Kronecker product of the reduced dummies of
+    its categorical variables.
+    """
+    if key not in design['blocks']:
+        columns = np.ones((design['n'], 1))
+        for name in sorted(key):
+            kind, values = _variable(design, name)
+            if kind == 'numeric':
+                columns = columns * values[:, None]
+            else:
+                columns = (columns[:, :, None] * values[:, None, :]).reshape(design['n'], -1)
+        design['blocks'][key] = columns
+    return design['blocks'][key]
+
+
+def term_blocks(design, terms):
+    """
+    Expand the terms of a formula into the sorted list of elementary block keys
+    spanning the same column space as Patsy's design matrix (intercept included).
+
+    Parameters:
+    design (dict): The design cache returned by build_design.
+    terms (tuple): The terms returned by parse_formula.
+
+    Returns:
+    list: The block keys (frozensets of variable names), or None if one of the
+    variables cannot be encoded by the engine.
+    """
+    keys = {frozenset()}
+    for term in terms:
+        numeric, categorical = [], []
+        for name in term:
+            encoded = _variable(design, name)
+            if encoded is None:
+                return None
+            (numeric if encoded[0] == 'numeric' else categorical).append(name)
+        for size in range(len(categorical) + 1):
+            for subset in combinations(categorical, size):
+                keys.add(frozenset(numeric).union(subset))
+    return sorted(keys, key=lambda key: (len(key), sorted(key)))
+
+
+def information_criteria(n, rank, ssr, tss):
+    """Information criteria and R-squared values; works on scalars and arrays."""
+    llf = -n / 2.0 * (np.log(2 * np.pi) + np.log(ssr / n) + 1)
+    r_squared = 1 - ssr / tss
+    with np.errstate(divide='ignore', invalid='ignore'):
+        adj_r_squared = 1 - (n - 1) / (n - rank) * (1 - r_squared)
+    return -2 * llf + 2 * rank, -2 * llf + np.log(n) * rank, r_squared, adj_r_squared
+
+
+def _too_many_params_error(n, num_params):
+    return ValueError(
+        f"Residual degrees of freedom is zero or negative, "
+        f"or observations ({n}) are <= parameters ({num_params})."
+    )
+
+
+def ols_metrics(n, num_params, rank, ssr, tss):
+    """
+    Compute the statsmodels OLS information criteria and R-squared values
+    from the residual sum of squares of a fit with an intercept.
+
+    Parameters:
+    n (int): Number of observations.
+    num_params (int): Number of design columns (statsmodels' len(params)).
+    rank (int): Rank of the design matrix.
+    ssr (float): Residual sum of squares.
+    tss (float): Centered total sum of squares of the response.
+
+    Returns:
+    dict: 'aic', 'bic', 'r_squared' and 'adj_r_squared'.
+    """
+    if n - rank <= 0 or n <= num_params:
+        raise _too_many_params_error(n, num_params)
+
+    aic, bic, r_squared, adj_r_squared = information_criteria(n, rank, ssr, tss)
+    return {
+        'aic': float(aic),
+        'bic': float(bic),
+        'r_squared': float(r_squared),
+        'adj_r_squared': float(adj_r_squared),
+    }
+
+
+def _formula_keys(design, formula):
+    """Return the elementary block keys of a formula, or None if unsupported."""
+    parsed = parse_formula(formula)
+    if parsed is None or parsed[0] != design['response']:
+        return None
+    return term_blocks(design, parsed[1])
+
+
+def fit_formula(design, formula):
+    """
+    Fit a fixed-effects formula with a single least-squares solve on the
+    cached design columns.
+
+    Parameters:
+    design (dict): The design cache returned by build_design.
+    formula (str): The model formula.
+
+    Returns:
+    dict: The same metrics compute_models_indexes stores for statsmodels fits
+    ('formula', 'aic', 'bic', 'r_squared', 'adj_r_squared'), or None if the
+    formula is not supported by the engine and must be fitted by statsmodels.
+    """
+    keys = _formula_keys(design, formula)
+    if keys is None:
+        return None
+
+    X = np.hstack([_block(design, key) for key in keys])
+    beta, _, rank, _ = np.linalg.lstsq(X, design['y'], rcond=None)
+    residuals = design['y'] - X @ beta
+    ssr = float(residuals @ residuals)
+
+    result = {'formula': formula}
+    result.update(ols_metrics(design['n'], X.shape[1], rank, ssr, design['tss']))
+    return result
+
+
+def _fit_qr(design, keys):
+    """
+    Fit the stacked blocks with a Householder QR solve. Rank-deficient designs
+    are handed to the SVD-based least-squares solver, like statsmodels' pinv.
+
+    Returns:
+    tuple: (num_params, rank, ssr)
+    """
+    X = np.hstack([_block(design, key) for key in keys])
+    y = design['y']
+    Q, R = np.linalg.qr(X)
+    diagonal = np.abs(np.diag(R))
+    if diagonal.min() <= diagonal.max() * max(X.shape) * np.finfo(float).eps:
+        beta, _, rank, _ = np.linalg.lstsq(X, y, rcond=None)
+        residuals = y - X @ beta
+    else:
+        rank = X.shape[1]
+        residuals = y - Q @ (Q.T @ y)
+    return X.shape[1], rank, float(residuals @ residuals)
+
+
+def gram_indices(design, keys):
+    """
+    Return the positions of the given blocks in the centered Gram matrix,
+    adding the blocks that are not in it yet.
+
+    The Gram matrix holds the cross-products of the centered design columns
+    (X'X), their cross-products with the response (X'y) and is shared by every
+    formula fitted on the design, so it is only extended, never rebuilt.
+
+    Parameters:
+    design (dict): The design cache returned by build_design.
+    keys (list): Elementary block keys (the intercept block is skipped).
+
+    Returns:
+    np.ndarray: Integer column indices into design['gram']['xtx'].
+    """
+    gram = design.setdefault('gram', {
+        'index': {},
+        'order': [],
+        'xtx': np.empty((0, 0)),
+        'xty': np.empty(0),
+    })
+
+    for key in keys:
+        if not key or key in gram['index']:
+            continue
+        block = _block(design, key)
+        # Centered columns are orthogonal to the intercept, so their
+        # cross-products with the raw columns equal the centered ones
+        centered = block - block.mean(axis=0)
+        size = gram['xtx'].shape[0]
+        cross = np.hstack([centered.T @ _block(design, other) for other in gram['order']]) \
+            if gram['order'] else np.empty((block.shape[1], 0))
+        gram['xtx'] = np.block([[gram['xtx'], cross.T], [cross, centered.T @ centered]])
+        gram['xty'] = np.concatenate([gram['xty'], centered.T @ design['y']])
+        if 'xtz' in gram:
+            gram['xtz'] = np.vstack([gram['xtz'], centered.T @ design['probes']])
+        gram['index'][key] = np.arange(size, size + block.shape[1])
+        gram['order'].append(key)
+
+    indices = [gram['index'][key] for key in keys if key]
+    return np.concatenate(indices) if indices else np.empty(0, dtype=int)
+
+
+def _block_width(design, key):
+    """Return the number of columns of an elementary block without building it."""
+    width = 1
+    for name in key:
+        kind, values = _variable(design, name)
+        if kind == 'categorical':
+            width *= values.shape[1]
+    return width
+
+
+def _probe_gram(design, probes):
+    """
+    Add the cross-products of the design columns with random probe vectors
+    (X'Z) to the Gram matrix, for the numeric span signatures.
+    """
+    gram_indices(design, [])
+    gram = design['gram']
+    if 'xtz' not in gram:
+        rng = np.random.default_rng(0)
+        Z = rng.standard_normal((design['n'], probes))
+        design['probes'] = Z - Z.mean(axis=0)
+        blocks = [_block(design, key) for key in gram['order']]
+        gram['xtz'] = np.vstack([block.T @ design['probes'] for block in blocks]) \
+            if blocks else np.empty((0, probes))
+        gram['ztz'] = np.einsum('ij,ij->j', design['probes'], design['probes'])
+    return gram
+
+
+def span_signatures(design, formulas, numeric=False, probes=2, decimals=8):
+    """
+    Compute a hashable signature of the column space spanned by the design of
+    every formula, so that formulas spanning the same space (which have the
+    same fit) are fitted only once.
+
+    The structural signature is the set of elementary blocks of the formula
+    (see term_blocks): formulas expanding to the same blocks, e.g. "a:b" and
+    "a + b + a:b" with categorical a and b, span exactly the same space. The
+    numeric signature also catches spans that coincide through collinearity
+    (e.g. x and a copy of x): it is the rank of the design and the projections
+    z'Pz of random probe vectors z onto its span, computed from the Gram
+    matrix with one batched eigendecomposition per model size. It costs about
+    as much as a Gram fit, so it pays off when fits are more expensive.
+
+    Parameters:
+    design (dict): The design cache returned by build_design.
+    formulas (list): The model formulas.
+    numeric (bool): Use the numeric signature instead of the structural one.
+    probes (int): Number of random probe vectors of the numeric signature.
+    decimals (int): Decimals the (relative) projections are rounded to.
+
+    Returns:
+    list: One signature per formula (None if the engine does not support the
+    formula). Formulas with the same signature have the same metrics (the
+    numeric signature also flags the designs with as many parameters as
+    observations, which cannot be fitted whatever their span).
+    """
+    signatures = [None] * len(formulas)
+    positions, key_sets = [], []
+    for position, formula in enumerate(formulas):
+        keys = _formula_keys(design, formula)
+        if keys is not None:
+            positions.append(position)
+            key_sets.append(keys)
+
+    if not numeric:
+        for position, keys in zip(positions, key_sets):
+            signatures[position] = tuple(keys)
+        return signatures
+
+    # Collinear columns do not change the span, but with as many parameters
+    # (columns and intercept) as observations the fit fails whatever its span
+    n = design['n']
+    saturated = [sum(_block_width(design, key) for key in keys) + 1 >= n for keys in key_sets]
+
+    gram = _probe_gram(design, probes)
+    groups = {}
+    for j, keys in enumerate(key_sets):
+        indices = gram_indices(design, keys)
+        groups.setdefault(len(indices), []).append((j, indices))
+
+    for size, members in groups.items():
+        if size == 0:
+            for j, _ in members:
+                signatures[positions[j]] = (0, (0.0,) * probes, saturated[j])
+            continue
+        indices = np.stack([member_indices for _, member_indices in members])
+        xtx = gram['xtx'][indices[:, :, None], indices[:, None, :]]
+        xtz = gram['xtz'][indices]
+        scale = np.sqrt(np.einsum('mii->mi', xtx))
+        scale[scale == 0] = 1.0
+        eigenvalues, eigenvectors = np.linalg.eigh(xtx / (scale[:, :, None] * scale[:, None, :]))
+        kept = eigenvalues > eigenvalues[:, -1:] * size * np.finfo(float).eps * 1e3
+        coordinates = np.einsum('mki,mkp->mip', eigenvectors, xtz / scale[:, :, None])
+        projections = np.einsum('mi,mip->mp', np.where(kept, 1 / np.where(kept, eigenvalues, 1), 0), coordinates ** 2)
+        projections = np.round(projections / gram['ztz'], decimals)
+        ranks = kept.sum(axis=1)
+        for (j, _), rank, projection in zip(members, ranks, projections):
+            signatures[positions[j]] = (int(rank), tuple(projection.tolist()), saturated[j])
+
+    return signatures
+
+
+def _solve_gram_batched(xtx, xty, tss, min_rcond):
+    """
+    Solve the (centered) normal equations of many same-size models at once
+    through batched Cholesky factorizations of their correlation-scaled
+    sub-Grams.
+
+    Parameters:
+    xtx (np.ndarray): Stacked sub-Grams, shape (models, k, k).
+    xty (np.ndarray): Stacked X'y sub-vectors, shape (models, k).
+    tss (float): Centered total sum of squares of the response.
+    min_rcond (float): Reciprocal condition number limit.
+
+    Returns:
+    np.ndarray: The residual sums of squares, NaN where the sub-block is
+    ill-conditioned (or the fit too close to perfect for the normal equations
+    to be accurate) and a QR solve is needed instead.
+    """
+    if xtx.shape[1] == 0:
+        return np.full(xtx.shape[0], tss)
+
+    scale = np.sqrt(np.einsum('mii->mi', xtx))
+    failed = ~np.all(scale > 0, axis=1)
+    scale[failed] = 1.0
+    scaled = xtx / (scale[:, :, None] * scale[:, None, :])
+    scaled[failed] = np.eye(xtx.shape[1])
+
+    try:
+        chol = np.linalg.cholesky(scaled)
+    except np.linalg.LinAlgError:
+        # Find the models that are not positive definite one by one
+        chol = np.empty_like(scaled)
+        for j in range(scaled.shape[0]):
+            try:
+                chol[j] = np.linalg.cholesky(scaled[j])
+            except np.linalg.LinAlgError:
+                failed[j] = True
+                chol[j] = np.eye(xtx.shape[1])
+
+    diagonal = np.einsum('mii->mi', chol)
+    failed |= (diagonal.min(axis=1) / diagonal.max(axis=1)) ** 2 < min_rcond
+
+    z = np.linalg.solve(chol, (xty / scale)[:, :, None])[:, :, 0]
+    ssr = tss - np.einsum('mi,mi->m', z, z)
+    failed |= ssr <= tss * np.sqrt(np.finfo(float).eps)
+    ssr[failed] = np.nan
+    return ssr
+
+
+def fit_key_sets(design, key_sets, min_rcond=1e-10):
+    """
+    Compute the residual sums of squares of many models, given as lists of
+    elementary block keys, from the shared Gram matrix. Models are grouped by
+    their number of design columns; the sub-Grams of each group are stacked
+    into one 3-D array and solved with a single vectorized Cholesky call.
+    Only ill-conditioned models are fitted one by one (QR).
+
+    Parameters:
+    design (dict): The design cache returned by build_design.
+    key_sets (list): One list of block keys (see term_blocks) per model.
+    min_rcond (float): Reciprocal condition number (of the correlation-scaled
+    sub-Gram) below which a model falls back to a QR solve on the data.
+
+    Returns:
+    tuple: (num_params, rank, ssr) arrays with one entry per model.
+    """
+    num_params = np.empty(len(key_sets), dtype=int)
+    rank = np.empty(len(key_sets), dtype=int)
+    ssr = np.empty(len(key_sets))
+
+    groups = {}
+    for position, keys in enumerate(key_sets):
+        indices = gram_indices(design, keys)
+        groups.setdefault(len(indices), []).append((position, indices))
+
+    for size, members in groups.items():
+        positions = np.array([position for position, _ in members])
+        indices = np.stack([member_indices for _, member_indices in members])
+        gram = design['gram']
+        group_ssr = _solve_gram_batched(
+            gram['xtx'][indices[:, :, None], indices[:, None, :]],
+            gram['xty'][indices],
+            design['tss'],
+            min_rcond,
+        )
+        num_params[positions] = rank[positions] = size + 1
+        ssr[positions] = group_ssr
+        for position in positions[np.isnan(group_ssr)]:
+            num_params[position], rank[position], ssr[position] = _fit_qr(design, key_sets[position])
+
+    return num_params, rank, ssr
+
+
+def fit_formulas_batched(design, formulas, min_rcond=1e-10):
+    """
+    Fit many fixed-effects formulas from the shared Gram matrix at once
+    (see fit_key_sets), computing their metrics as array operations.
+
+    Parameters:
+    design (dict): The design cache returned by build_design.
+    formulas (list): The model formulas.
+    min_rcond (float): Reciprocal condition number (of the correlation-scaled
+    sub-Gram) below which a model falls back to a QR solve on the data.
+
+    Returns:
+    list: One entry per formula: the metrics dict, None if the formula is not
+    supported by the engine and must be fitted by statsmodels, or the
+    ValueError describing an over-parameterised model.
+    """
+    results = [None] * len(formulas)
+    positions, key_sets = [], []
+    for position, formula in enumerate(formulas):
+        keys = _formula_keys(design, formula)
+        if keys is not None:
+            positions.append(position)
+            key_sets.append(keys)
+
+    n, tss = design['n'], design['tss']
+    num_params, rank, ssr = fit_key_sets(design, key_sets, min_rcond)
+    aic, bic, r_squared, adj_r_squared = information_criteria(n, rank, ssr, tss)
+    invalid = (n - rank <= 0) | (n <= num_params)
+
+    for j, position in enumerate(positions):
+        if invalid[j]:
+            results[position] = _too_many_params_error(n, num_params[j])
+        else:
+            results[position] = {
+                'formula': formulas[position],
+                'aic': float(aic[j]),
+                'bic': float(bic[j]),
+                'r_squared': float(r_squared[j]),
+                'adj_r_squared': float(adj_r_squared[j]),
+            }
+
+    return results
+
+
+def _r_delete(R, z, position):
+    """
+    Remove one column from the R factor (and the rotated response z = Q'y)
+    of a QR factorization, restoring the triangular shape with Givens
+    rotations.
+    """
+    R = np.delete(R, position, axis=1)
+    z = z.copy()
+    for i in range(position, R.shape[1]):
+        a, b = R[i, i], R[i + 1, i]
+        norm = np.hypot(a, b)
+        if norm == 0:
+            continue
+        rotation = np.array([[a, b], [-b, a]]) / norm
+        R[i:i + 2, i:] = rotation @ R[i:i + 2, i:]
+        z[i:i + 2] = rotation @ z[i:i + 2]
+    return R[:-1], z[:-1]
+
+
+def _r_append(R, z, cross, norm2, xy):
+    """
+    Append one column to the R factor of a QR factorization from its Gram
+    entries: cross-products with the current columns, squared norm and
+    cross-product with the response.
+
+    Returns:
+    tuple: (R, z), or None if the new column is (numerically) a linear
+    combination of the current ones.
+    """
+    r = solve_triangular(R, cross, trans='T') if R.shape[0] else np.empty(0)
+    rho2 = norm2 - r @ r
+    if rho2 <= norm2 * np.finfo(float).eps * 16:
+        return None
+    rho = np.sqrt(rho2)
+    size = R.shape[0]
+    updated = np.zeros((size + 1, size + 1))
+    updated[:size, :size] = R
+    updated[:size, size] = r
+    updated[size, size] = rho
+    return updated, np.append(z, (xy - r @ z) / rho)
+
+
+def fit_formulas_incremental(design, formulas, min_rcond=1e-10):
+    """
+    Fit fixed-effects formulas in order, updating one QR factorization (its R
+    factor and Q'y, built from the shared Gram matrix) from each model to the
+    next instead of refactoring from scratch. Dropping a column costs a few
+    Givens rotations and adding one a triangular solve, so a sequence in which
+    neighbouring models differ by a single term (see the "gray" order of
+    models_generator.generate_simple_and_additional_models) costs O(k^2) per
+    model. Larger jumps between models trigger a full refactorization.
+
+    Parameters:
+    design (dict): The design cache returned by build_design.
+    formulas (list): The model formulas, in enumeration order.
+    min_rcond (float): Reciprocal condition number (of the correlation-scaled
+    model) below which a model falls back to a QR solve on the data.
+
+    Returns:
+    list: One entry per formula, in the same format as fit_formulas_batched.
+    """
+    results = [None] * len(formulas)
+    n, tss = design['n'], design['tss']
+    # The current factorization survives between calls, so consecutive
+    # batches of one enumeration keep being updated
+    state = design.setdefault('incremental', {'columns': [], 'R': np.empty((0, 0)), 'z': np.empty(0)})
+
+    for position, formula in enumerate(formulas):
+        keys = _formula_keys(design, formula)
+        if keys is None:
+            continue
+        target = list(gram_indices(design, keys))
+        gram = design['gram']
+
+        current = state['columns']
+        target_set, current_set = set(target), set(current)
+        removed = [column for column in current if column not in target_set]
+        added = [column for column in target if column not in current_set]
+
+        R, z, columns = state['R'], state['z'], list(current)
+        if len(removed) + len(added) > max(2, len(target) // 2):
+            R, z, columns = np.empty((0, 0)), np.empty(0), []
+            added = target
+        else:
+            for column in removed:
+                R, z = _r_delete(R, z, columns.index(column))
+                columns.remove(column)
+
+        for column in added:
+            appended = _r_append(R, z, gram['xtx'][columns, column], gram['xtx'][column, column], gram['xty'][column])
+            if appended is None:
+                R = None
+                break
+            R, z = appended
+            columns.append(column)
+
+        ssr = None
+        if R is not None:
+            state.update(columns=columns, R=R, z=z)
+            ratios = np.diag(R) ** 2 / np.diag(gram['xtx'])[columns] if columns else np.ones(1)
+            ssr = tss - float(z @ z)
+            if ratios.min() / ratios.max() < min_rcond or ssr <= tss * np.sqrt(np.finfo(float).eps):
+                ssr = None
+        else:
+            state.update(columns=[], R=np.empty((0, 0)), z=np.empty(0))
+
+        if ssr is None:
+            num_params, rank, ssr = _fit_qr(design, keys)
+        else:
+            num_params = rank = len(target) + 1
+
+        try:
+            results[position] = {'formula': formula}
+            results[position].update(ols_metrics(n, num_params, rank, ssr, tss))
+        except ValueError as e:
+            results[position] = e
+
+    return results
+
+
+def fit_formula_gram(design, formula, min_rcond=1e-10):
+    """
+    Fit a fixed-effects formula from the sufficient statistics (X'X, X'y, y'y)
+    of the shared Gram matrix instead of the data rows: once the Gram matrix
+    exists, each fit costs O(k^3) whatever the number of observations.
+
+    Parameters:
+    design (dict): The design cache returned by build_design.
+    formula (str): The model formula.
+    min_rcond (float): Reciprocal condition number (of the correlation-scaled
+    sub-Gram) below which the fit falls back to a QR solve on the data.
+
+    Returns:
+    dict: The model metrics, or None if the formula is not supported by the
+    engine and must be fitted by statsmodels.
+    """
+    result = fit_formulas_batched(design, [formula], min_rcond)[0]
+    if isinstance(result, ValueError):
+        raise result
+    return result
+
+
+def _centered_columns(design):
+    """
+    Return every column of the Gram matrix, centered, as one (n, K) matrix in
+    Gram order; it is extended as the Gram matrix grows.
+    """
+    gram_indices(design, [])
+    gram = design['gram']
+    size = gram['xtx'].shape[0]
+    centered = design.get('centered', np.empty((design['n'], 0)))
+    if centered.shape[1] < size:
+        blocks = [_block(design, key) for key in gram['order'] if gram['index'][key][0] >= centered.shape[1]]
+        centered = np.hstack([centered] + [block - block.mean(axis=0) for block in blocks])
+        design['centered'] = centered
+    return centered
+
+
+def _fold_gram(design, folds):
+    """
+    Return the per-fold sufficient statistics of the k-fold cross-validation
+    (row counts, column sums, X'X, X'y, sum of y and y'y of the rows of every
+    fold, on the centered columns and response), extended as the Gram
+    matrix grows. The rows are assigned to the folds by a fixed permutation,
+    so every model is validated on the same folds.
+    """
+    centered = _centered_columns(design)
+    n, size = centered.shape
+    cv = design.get('cv')
+    if cv is None or cv['folds'] != folds:
+        if not 2 <= folds <= n:
+            raise ValueError(f"The number of folds must be between 2 and the number of observations ({n}).")
+        assignment = np.random.default_rng(0).permutation(n) % folds
+        yc = design['y'] - design['y'].mean()
+        rows = [np.flatnonzero(assignment == fold) for fold in range(folds)]
+        cv = design['cv'] = {
+            'folds': folds,
+            'rows': rows,
+            'yc': yc,
+            'counts': np.array([len(fold_rows) for fold_rows in rows], dtype=np.float64),
+            'ysum': np.array([yc[fold_rows].sum() for fold_rows in rows]),
+            'yy': np.array([yc[fold_rows] @ yc[fold_rows] for fold_rows in rows]),
+            'sums': np.empty((folds, 0)),
+            'xtx': np.empty((folds, 0, 0)),
+            'xty': np.empty((folds, 0)),
+        }
+
+    old = cv['sums'].shape[1]
+    if old < size:
+        # Only the cross-products of the new columns are computed
+        xtx = np.empty((folds, size, size))
+        xtx[:, :old, :old] = cv['xtx']
+        sums = np.empty((folds, size))
+        xty = np.empty((folds, size))
+        for fold, fold_rows in enumerate(cv['rows']):
+            rows = centered[fold_rows]
+            cross = rows[:, old:].T @ rows
+            xtx[fold, old:, :] = cross
+            xtx[fold, :, old:] = cross.T
+            sums[fold] = rows.sum(axis=0)
+            xty[fold] = rows.T @ cv['yc'][fold_rows]
+        cv.update(sums=sums, xtx=xtx, xty=xty)
+    return cv
+
+
+def _press_svd(X, y):
+    """PRESS of one model from the SVD of its design (with the intercept), for rank-deficient designs."""
+    U, singular, _ = np.linalg.svd(X, full_matrices=False)
+    U = U[:, singular > singular[0] * max(X.shape) * np.finfo(float).eps]
+    leverage = np.einsum('ij,ij->i', U, U)
+    residuals = y - U @ (U.T @ y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return float(np.sum((residuals / (1 - leverage)) ** 2)) if leverage.max() < 1 - 1e-10 else np.nan
+
+
+def _press_group(design, indices):
+    """
+    PRESS of same-size models from their leverages: h_i = 1/n + x_i' (X'X)^-1 x_i
+    on the centered columns, and PRESS = sum((e_i / (1 - h_i))^2). The
+    inverses of the correlation-scaled sub-Grams are computed in one batched
+    call; ill-conditioned models are handed to an SVD.
+    """
+    centered = _centered_columns(design)
+    gram = design['gram']
+    n = design['n']
+    yc = design['y'] - design['y'].mean()
+    models, size = indices.shape
+    press = np.empty(models)
+    if size == 0:
+        press[:] = np.sum((yc / (1 - 1 / n)) ** 2)
+        return press
+
+    xtx = gram['xtx'][indices[:, :, None], indices[:, None, :]]
+    scale = np.sqrt(np.einsum('mii->mi', xtx))
+    failed = ~np.all(scale > 0, axis=1)
+    scale[failed] = 1.0
+    scaled = xtx / (scale[:, :, None] * scale[:, None, :])
+    scaled[failed] = np.eye(size)
+    eigenvalues = np.linalg.eigvalsh(scaled)
+    failed |= eigenvalues[:, 0] < eigenvalues[:, -1] * 1e-10
+    scaled[failed] = np.eye(size)
+    inverse = np.linalg.inv(scaled)
+    xty = gram['xty'][indices] / scale
+
+    for j in range(models):
+        if failed[j]:
+            press[j] = _press_svd(np.column_stack([np.ones(n), centered[:, indices[j]]]), yc)
+            continue
+        # Leverages and fitted values from X (X'X)^-1, one matrix product
+        X = centered[:, indices[j]] / scale[j]
+        XG = X @ inverse[j]
+        leverage = 1 / n + np.einsum('nk,nk->n', XG, X)
+        if leverage.max() >= 1 - 1e-10:
+            # A point with leverage 1 has no leave-one-out prediction
+            press[j] = np.nan
+            continue
+        residuals = yc - XG @ xty[j]
+        press[j] = np.sum((residuals / (1 - leverage)) ** 2)
+    return press
+
+
+def _kfold_group(design, indices, folds):
+    """
+    k-fold mean squared prediction error of same-size models, without refits:
+    the normal equations of each training set are the full ones minus the
+    (downdated) Gram block of the held-out fold, and the held-out squared
+    errors are expanded in the fold's own Gram block.
+    """
+    cv = _fold_gram(design, folds)
+    gram = design['gram']
+    n = design['n']
+    models, size = indices.shape
+
+    # Gram blocks of [1, X] (intercept first) for every model and fold
+    fold_xtx = np.empty((models, folds, size + 1, size + 1))
+    fold_xtx[:, :, 0, 0] = cv['counts']
+    fold_xtx[:, :, 0, 1:] = np.transpose(cv['sums'][:, indices], (1, 0, 2))
+    fold_xtx[:, :, 1:, 0] = fold_xtx[:, :, 0, 1:]
+    fold_xtx[:, :, 1:, 1:] = np.transpose(cv['xtx'][:, indices[:, :, None], indices[:, None, :]], (1, 0, 2, 3))
+    fold_xty = np.empty((models, folds, size + 1))
+    fold_xty[:, :, 0] = cv['ysum']
+    fold_xty[:, :, 1:] = np.transpose(cv['xty'][:, indices], (1, 0, 2))
+
+    full_xtx = np.zeros((models, 1, size + 1, size + 1))
+    full_xtx[:, 0, 0, 0] = n
+    full_xtx[:, 0, 1:, 1:] = gram['xtx'][indices[:, :, None], indices[:, None, :]]
+    full_xty = np.zeros((models, 1, size + 1))
+    full_xty[:, 0, 1:] = gram['xty'][indices]
+
+    # Solve the training normal equations, correlation-scaled
+    train_xtx = full_xtx - fold_xtx
+    train_xty = full_xty - fold_xty
+    scale = np.sqrt(np.einsum('mfii->mfi', train_xtx))
+    scale[scale == 0] = 1.0
+    scaled = train_xtx / (scale[..., :, None] * scale[..., None, :])
+    try:
+        beta = np.linalg.solve(scaled, (train_xty / scale)[..., None])[..., 0] / scale
+    except np.linalg.LinAlgError:
+        beta = np.empty_like(train_xty)
+        for j in range(models):
+            for fold in range(folds):
+                beta[j, fold] = np.linalg.lstsq(scaled[j, fold], train_xty[j, fold] / scale[j, fold], rcond=None)[0] / scale[j, fold]
+
+    errors = (cv['yy'] - 2 * np.einsum('mfi,mfi->mf', beta, fold_xty)
+              + np.einsum('mfi,mfij,mfj->mf', beta, fold_xtx, beta))
+    return np.maximum(errors, 0).sum(axis=1) / n
+
+
+def cross_validate_key_sets(design, key_sets, metrics=("press", "kfold"), folds=10):
+    """
+    Compute out-of-sample prediction errors of many models, given as lists
+    of elementary block keys, at close to the cost of one fit per model.
+
+    "press" is the leave-one-out PRESS statistic (the sum of squared
+    leave-one-out prediction errors), computed from the residuals and
+    leverages of the single fit. "kfold" is the k-fold cross-validated mean
+    squared prediction error, computed from per-fold blocks of the Gram
+    matrix (see _fold_gram): each fit costs O(folds * k^3) whatever the
+    number of observations. Both only depend on the column space of the
+    model, and are lower for better models.
+
+    Parameters:
+    design (dict): The design cache returned by build_design.
+    key_sets (list): One list of block keys (see term_blocks) per model.
+    metrics (tuple): "press" and/or "kfold".
+    folds (int): The number of folds of "kfold".
+
+    Returns:
+    dict: 'press' and/or 'kfold_mse' arrays with one entry per model ('press'
+    is NaN for a model with a point of leverage 1, which has no leave-one-out
+    prediction).
+    """
+    unknown = set(metrics) - {"press", "kfold"}
+    if unknown:
+        raise ValueError(f"Unknown cross-validation metrics {sorted(unknown)}. Use 'press' and/or 'kfold'.")
+
+    values = {name: np.empty(len(key_sets)) for name in (("press",) if "press" in metrics else ()) + (("kfold_mse",) if "kfold" in metrics else ())}
+    groups = {}
+    for position, keys in enumerate(key_sets):
+        indices = gram_indices(design, keys)
+        groups.setdefault(len(indices), []).append((position, indices))
+
+    for size, members in groups.items():
+        positions = np.array([position for position, _ in members])
+        indices = np.stack([member_indices for _, member_indices in members]).reshape(len(members), size)
+        if "press" in metrics:
+            values['press'][positions] = _press_group(design, indices)
+        if "kfold" in metrics:
+            values['kfold_mse'][positions] = _kfold_group(design, indices, folds)
+    return values
+
+
+def cross_validate_formulas(design, formulas, metrics=("press", "kfold"), folds=10):
+    """
+    Compute the cross-validation metrics of fixed-effects formulas (see
+    cross_validate_key_sets).
+
+    Parameters:
+    design (dict): The design cache returned by build_design.
+    formulas (list): The model formulas.
+    metrics (tuple): "press" and/or "kfold".
+    folds (int): The number of folds of "kfold".
+
+    Returns:
+    list: One entry per formula: a dict of its metrics ('press' and/or
+    'kfold_mse'), or None if the formula is not supported by the engine.
+    """
+    results = [None] * len(formulas)
+    positions, key_sets = [], []
+    for position, formula in enumerate(formulas):
+        keys = _formula_keys(design, formula)
+        if keys is not None:
+            positions.append(position)
+            key_sets.append(keys)
+
+    values = cross_validate_key_sets(design, key_sets, metrics, folds)
+    for j, position in enumerate(positions):
+        results[position] = {name: float(metric[j]) for name, metric in values.items()}
+    return results
+
+
+def resampled_grams(design, counts, columns):
+    """
+    Compute the Gram matrices of [1, X, y] for many resamples of the rows at
+    once: a resample is given by how many times it draws every row, so its
+    Gram matrix is Z' diag(counts) Z, and all of them come from one matrix
+    product of the count matrix with the pairwise products of the columns of
+    Z (computed over blocks of rows).
+
+    Parameters:
+    design (dict): The design cache returned by build_design.
+    counts (np.ndarray): The resample counts, shape (resamples, n).
+    columns (np.ndarray): The Gram columns (see gram_indices) to include.
+
+    Returns:
+    np.ndarray: The Gram matrices, shape (resamples, k + 2, k + 2), with the
+    intercept first, then the (centered) columns, then the (centered) response.
+    """
+    n = design['n']
+    yc = design['y'] - design['y'].mean()
+    Z = np.column_stack([np.ones(n), _centered_columns(design)[:, columns], yc])
+    upper = np.triu_indices(Z.shape[1])
+    packed = np.zeros((counts.shape[0], len(upper[0])))
+    rows = max(1, min(2 ** 22 // len(upper[0]), 2 ** 23 // counts.shape[0]))
+    for start in range(0, n, rows):
+        block = Z[start:start + rows]
+        packed += counts[:, start:start + rows].astype(np.float64) @ (block[:, upper[0]] * block[:, upper[1]])
+
+    grams = np.empty((counts.shape[0], Z.shape[1], Z.shape[1]))
+    grams[:, upper[0], upper[1]] = packed
+    grams[:, upper[1], upper[0]] = packed
+    return grams
+
+
+def _solve_pinv_batched(xtx, xty, tss):
+    """
+    Residual sums of squares and ranks of stacked (rank-deficient) normal
+    equations, through the pseudo-inverse of their correlation-scaled Grams.
+    """
+    scale = np.sqrt(np.maximum(np.einsum('mii->mi', xtx), 0))
+    scale[scale == 0] = 1.0
+    eigenvalues, eigenvectors = np.linalg.eigh(xtx / (scale[:, :, None] * scale[:, None, :]))
+    kept = eigenvalues > eigenvalues[:, -1:] * xtx.shape[1] * np.finfo(float).eps * 1e3
+    coordinates = np.einsum('mki,mk->mi', eigenvectors, xty / scale)
+    explained = np.einsum('mi,mi->m', np.where(kept, 1 / np.where(kept, eigenvalues, 1), 0), coordinates ** 2)
+    return tss - explained, kept.sum(axis=1)
+
+
+def bootstrap_key_sets(design, key_sets, counts, min_rcond=1e-10):
+    """
+    Fit many models, given as lists of elementary block keys, on many
+    resamples of the rows at once, from the resampled Gram matrices (see
+    resampled_grams). Each resample is centered on its own means, and all
+    the same-size models of all the resamples are solved together (see
+    _solve_gram_batched); rank-deficient fits (e.g. a level missing from a
+    resample) go through a pseudo-inverse.
+
+    Parameters:
+    design (dict): The design cache returned by build_design.
+    key_sets (list): One list of block keys (see term_blocks) per model.
+    counts (np.ndarray): The resample counts, shape (resamples, n), each row
+    summing to n.
+    min_rcond (float): Reciprocal condition number below which a fit goes
+    through the pseudo-inverse.
+
+    Returns:
+    dict: 'aic', 'bic', 'r_squared' and 'adj_r_squared' arrays of shape
+    (resamples, models), NaN where a model has too many parameters.
+    """
+    n = design['n']
+    resamples = counts.shape[0]
+    indices = [gram_indices(design, keys) for keys in key_sets]
+    columns = np.unique(np.concatenate(indices)) if indices else np.empty(0, dtype=int)
+    position = np.zeros(design['gram']['xtx'].shape[0], dtype=int)
+    position[columns] = np.arange(1, len(columns) + 1)
+
+    # Centered cross-products of every resample: Z'CZ - n m m'
+    grams = resampled_grams(design, counts, columns)
+    means = grams[:, 0, :] / n
+    centered = grams - n * means[:, :, None] * means[:, None, :]
+    # Columns constant in a resample (e.g. the dummy of a level it does not
+    # draw) are left with round-off only: make them exactly zero
+    kept = np.einsum('bii->bi', centered) > np.einsum('bii->bi', grams) * 1e-10
+    centered *= kept[:, :, None] & kept[:, None, :]
+    tss = centered[:, -1, -1]
+
+    num_params = np.empty(len(key_sets), dtype=int)
+    rank = np.empty((resamples, len(key_sets)), dtype=int)
+    ssr = np.empty((resamples, len(key_sets)))
+    groups = {}
+    for model, model_indices in enumerate(indices):
+        groups.setdefault(len(model_indices), []).append(model)
+
+    for size, models in groups.items():
+        models = np.array(models)
+        sub = position[np.stack([indices[model] for model in models]).reshape(len(models), size)]
+        num_params[models] = size + 1
+        # Chunks of models, so the stacked sub-Grams stay within a few tens of MB
+        chunk = max(1, 2 ** 22 // (resamples * max(size, 1) ** 2))
+        for start in range(0, len(models), chunk):
+            block, block_sub = models[start:start + chunk], sub[start:start + chunk]
+            xtx = centered[:, block_sub[:, :, None], block_sub[:, None, :]].reshape(resamples * len(block), size, size)
+            xty = centered[:, block_sub, -1].reshape(resamples * len(block), size)
+            block_tss = np.repeat(tss, len(block))
+            block_ssr = _solve_gram_batched(xtx, xty, block_tss, min_rcond)
+            block_rank = np.full(block_ssr.shape, size + 1)
+            failed = np.isnan(block_ssr)
+            if failed.any():
+                block_ssr[failed], block_rank[failed] = _solve_pinv_batched(xtx[failed], xty[failed], block_tss[failed])
+                block_rank[failed] += 1
+            ssr[:, block] = block_ssr.reshape(resamples, len(block))
+            rank[:, block] = block_rank.reshape(resamples, len(block))
+
+    aic, bic, r_squared, adj_r_squared = information_criteria(n, rank, ssr, tss[:, None])
+    invalid = (n - rank <= 0) | (n <= num_params)
+    return {
+        name: np.where(invalid, np.nan, values)
+        for name, values in (('aic', aic), ('bic', bic), ('r_squared', r_squared), ('adj_r_squared', adj_r_squared))
+    }
@@ -1,5 +1,256 @@
+import sys
+import time
+from math import comb
+from models_generator import MODEL_FAMILIES, multilevel_groupings
+from models_terms import make_model, to_formula
+
+# Seconds per lmer fit assumed when it cannot be measured (e.g. without R)
+DEFAULT_MIXED_FIT_SECONDS = 0.5
+
+# Families dropped first when a sweep is narrowed to fit a budget
+NARROWING_ORDER = ("multilevel", "interaction")
+
+
 # Printing a message with the number of models generated and confronted
 def models_amount_msg(model_formulas):
     print(f"\n\n------------------------------------------------------------------------\n"
           f"Generating and comparing {len(model_formulas)} models...\n"
-          f"------------------------------------------------------------------------\n")
\ No newline at end of file
+          f"------------------------------------------------------------------------\n")
+
+
+def count_models(df, predictor_vars, families=MODEL_FAMILIES, prune=True):
+    """
+    Count the models models_generator.generate_all_models generates, per
+    family, without generating them.
+
+    With p predictors there are 2^p - 1 additive models; the interaction
+    family has 2 models per subset of at least two predictors plus 2 per
+    pair; the multilevel family (only with a categorical predictor) has, for
+    every grouping variable allowing up to K random effects per level,
+    2^p + 2 A(K - 1) + 3 A(K) models, where A(s) is the number of subsets of
+    1 to s of the other p - 1 predictors (without pruning, K is unlimited
+    and the family has p(7 * 2^(p-1) - 5) models).
+
+    Parameters:
+    df (pd.DataFrame): The DataFrame containing the data.
+    predictor_vars (list): A list of predictor variable names.
+    families (tuple): The model families to count (see models_generator.MODEL_FAMILIES).
+    prune (bool): Count only the feasible multilevel models (see
+    models_generator.iter_multilevel_models).
+
+    Returns:
+    dict: The number of models of each family.
+    """
+    p = len(predictor_vars)
+    counts = {family: 0 for family in families}
+    if "null" in families:
+        counts["null"] = 1
+    if "additive" in families:
+        counts["additive"] = 2 ** p - 1
+    if "interaction" in families:
+        counts["interaction"] = 2 * (2 ** p - 1 - p) + 2 * comb(p, 2)
+        # The main effects model is left to the additive (or null) family
+        if ("additive" if p else "null") not in families:
+            counts["interaction"] += 1
+    if "multilevel" in families and not df[predictor_vars].select_dtypes(include='category').empty:
+        def subsets(max_size):
+            return sum(comb(p - 1, size) for size in range(1, min(p - 1, max_size) + 1))
+
+        counts["multilevel"] = sum(
+            2 ** p + 2 * subsets(max_effects - 1) + 3 * subsets(max_effects)
+            for max_effects in multilevel_groupings(df, predictor_vars, prune).values()
+        )
+    return counts
+
+
+def _result_bytes(result):
+    """Approximate memory taken by a metrics dict."""
+    return sys.getsizeof(result) + sum(sys.getsizeof(value) for value in result.values())
+
+
+def measure_fit_costs(
+    df, response_var, predictor_vars, sample_size=20, mixed_sample_size=5, engine="batched",
+    mixed_engine="batched",
+):
+    """
+    Measure the average cost of a fit on the actual data, by fitting a small
+    sample of models of every size.
+
+    Mixed models are fitted by the embedded R session, which must already
+    hold the data as 'df_r' (see xplore_data); when that fails,
+    DEFAULT_MIXED_FIT_SECONDS is used.
+
+    Parameters:
+    df (pd.DataFrame): The DataFrame containing the data.
+    response_var (str): The response variable.
+    predictor_vars (list): A list of predictor variable names.
+    sample_size (int): The number of non-mixed models fitted.
+    mixed_sample_size (int): The number of mixed models fitted (0 to skip them).
+    engine (str): The non-mixed engine (see models_features.compute_models_indexes).
+    mixed_engine (str): The mixed engine.
+
+    Returns:
+    dict: 'non_mixed' and 'mixed' seconds per fit, 'result_bytes' and
+    'formula_bytes' per model.
+    """
+    import models_features
+
+    variables = tuple(predictor_vars)
+    p = len(variables)
+    # Models from the smallest to the largest, alternately without and with
+    # the pairwise interactions
+    non_mixed, mixed = [], []
+    for j in range(sample_size):
+        size = round(j * p / max(sample_size - 1, 1))
+        terms = [1 << bit for bit in range(size)]
+        if j % 2:
+            terms += [1 << a | 1 << b for a in range(size) for b in range(a + 1, size)]
+        non_mixed.append(to_formula(make_model(response_var, variables, terms)))
+    groupings = [bit for bit, predictor in enumerate(variables) if str(df[predictor].dtype) == 'category']
+    if groupings:
+        for j in range(mixed_sample_size):
+            size = round(j * p / max(mixed_sample_size - 1, 1))
+            fixed = [1 << bit for bit in range(size)]
+            mixed.append(to_formula(make_model(response_var, variables, fixed, [(groupings[0], True, ())])))
+
+    start = time.perf_counter()
+    results = models_features.fit_non_mixed_formulas(df, non_mixed, engine)
+    non_mixed_seconds = (time.perf_counter() - start) / len(non_mixed)
+    results = [result for result in results if isinstance(result, dict)]
+
+    mixed_seconds = DEFAULT_MIXED_FIT_SECONDS
+    if mixed:
+        try:
+            start = time.perf_counter()
+            mixed_results = models_features.fit_mixed_formulas(mixed, mixed_engine)
+            elapsed = (time.perf_counter() - start) / len(mixed)
+        except Exception as e:
+            print(f"Warning: could not time the mixed models ({e}); assuming {DEFAULT_MIXED_FIT_SECONDS} s per fit.")
+        else:
+            mixed_results = [result for result in mixed_results if isinstance(result, dict)]
+            if mixed_results:
+                mixed_seconds = elapsed
+                results += mixed_results
+            else:
+                print(f"Warning: every sample mixed model failed; assuming {DEFAULT_MIXED_FIT_SECONDS} s per fit.")
+
+    return {
+        'non_mixed': non_mixed_seconds,
+        'mixed': mixed_seconds,
+        'result_bytes': max((_result_bytes(result) for result in results), default=1024),
+        'formula_bytes': max(sys.getsizeof(formula) for formula in non_mixed + mixed),
+    }
+
+
+def estimate_sweep(df, response_var, predictor_vars, families=MODEL_FAMILIES, costs=None, n_jobs=1, r_jobs=1):
+    """
+    Predict the number of models, the wall time and the peak memory of a
+    full sweep (models_generator.generate_all_models followed by
+    models_features.compute_models_indexes) before generating anything.
+
+    Parameters:
+    df (pd.DataFrame): The DataFrame containing the data.
+    response_var (str): The response variable.
+    predictor_vars (list): A list of predictor variable names.
+    families (tuple): The model families of the sweep.
+    costs (dict): Per-fit costs from measure_fit_costs; measured if None.
+    n_jobs (int): Number of worker processes for the non-mixed models.
+    r_jobs (int): Number of R worker processes for the mixed models.
+
+    Returns:
+    dict: 'counts' and 'seconds' per family, 'total_models', 'total_seconds'
+    and 'peak_bytes' (the DataFrame, the formula list and the results).
+    """
+    counts = count_models(df, predictor_vars, families)
+    if costs is None:
+        costs = measure_fit_costs(
+            df, response_var, predictor_vars, mixed_sample_size=5 if counts.get("multilevel") else 0
+        )
+
+    seconds = {
+        family: count * (costs['mixed'] / r_jobs if family == "multilevel" else costs['non_mixed'] / n_jobs)
+        for family, count in counts.items()
+    }
+    total_models = sum(counts.values())
+    return {
+        'counts': counts,
+        'seconds': seconds,
+        'total_models': total_models,
+        'total_seconds': sum(seconds.values()),
+        'peak_bytes': int(df.memory_usage(deep=True).sum() + total_models * (costs['result_bytes'] + costs['formula_bytes'])),
+    }
+
+
+def _format_seconds(seconds):
+    hours, rest = divmod(int(seconds), 3600)
+    return f"{hours}h {rest // 60:02d}m {rest % 60:02d}s"
+
+
+# Printing a message with the estimated size of a sweep
+def estimate_msg(estimate):
+    lines = [
+        f"  {family}: {count} models, ~{_format_seconds(estimate['seconds'][family])}"
+        for family, count in estimate['counts'].items()
+    ]
+    print(f"\n\n------------------------------------------------------------------------\n"
+          f"Estimated sweep: {estimate['total_models']} models, "
+          f"~{_format_seconds(estimate['total_seconds'])}, "
+          f"~{estimate['peak_bytes'] / 1024 ** 2:.0f} MB\n"
+          + "\n".join(lines) +
+          f"\n------------------------------------------------------------------------\n")
+
+
+def plan_sweep(
+    df, response_var, predictor_vars, max_seconds=None, max_bytes=None, on_exceed="raise",
+    families=MODEL_FAMILIES, costs=None, n_jobs=1, r_jobs=1,
+):
+    """
+    Check a sweep against a time and memory budget before it is generated.
+
+    Parameters:
+    df (pd.DataFrame): The DataFrame containing the data.
+    response_var (str): The response variable.
+    predictor_vars (list): A list of predictor variable names.
+    max_seconds (float): Wall time budget (None for no limit).
+    max_bytes (int): Peak memory budget (None for no limit).
+    on_exceed (str): "raise" refuses a sweep over budget; "narrow" drops
+    the most expensive families (multilevel, then interaction) until it fits.
+    families (tuple): The model families wanted.
+    costs (dict): Per-fit costs from measure_fit_costs; measured if None.
+    n_jobs (int): Number of worker processes for the non-mixed models.
+    r_jobs (int): Number of R worker processes for the mixed models.
+
+    Returns:
+    tuple: (families to pass to models_generator.generate_all_models, estimate
+    of the sweep as returned by estimate_sweep).
+    """
+    if on_exceed not in ("raise", "narrow"):
+        raise ValueError(f"Unknown on_exceed '{on_exceed}'. Use 'raise' or 'narrow'.")
+
+    # Measure once, also for the narrowed sweeps
+    if costs is None:
+        has_mixed = bool(count_models(df, predictor_vars, families).get("multilevel"))
+        costs = measure_fit_costs(df, response_var, predictor_vars, mixed_sample_size=5 if has_mixed else 0)
+
+    def over_budget(estimate):
+        return ((max_seconds is not None and estimate['total_seconds'] > max_seconds)
+                or (max_bytes is not None and estimate['peak_bytes'] > max_bytes))
+
+    families = tuple(families)
+    estimate = estimate_sweep(df, response_var, predictor_vars, families, costs, n_jobs, r_jobs)
+    if on_exceed == "narrow":
+        for family in NARROWING_ORDER:
+            if not over_budget(estimate) or family not in families:
+                continue
+            families = tuple(kept for kept in families if kept != family)
+            print(f"Warning: dropping the {family} models to fit the budget.")
+            estimate = estimate_sweep(df, response_var, predictor_vars, families, costs, n_jobs, r_jobs)
+
+    estimate_msg(estimate)
+    if over_budget(estimate):
+        raise ValueError(
+            f"The sweep of {estimate['total_models']} models would take ~{_format_seconds(estimate['total_seconds'])} "
+            f"and ~{estimate['peak_bytes'] / 1024 ** 2:.0f} MB, over the budget. Use fewer predictors, fewer "
+            f"families or a search strategy (see models_search)."
+        )
+    return families, estimate
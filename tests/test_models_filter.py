@@ -0,0 +1,38 @@
+# Regression tests of the feasibility filter on categoricals with unused
+# categories: only the observed levels count.
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import models_filter
+import models_generator
+
+
+def _frame(n, observed, declared, column):
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        'y': rng.normal(size=n),
+        'x': rng.normal(size=n),
+        column: pd.Categorical(list(observed) * (n // len(observed)), categories=list(declared)),
+    })
+
+
+def test_column_stats_ignores_unused_categories():
+    df = _frame(20, "ab", "abcdefghijklmnop", 'g')
+    stats = models_filter.column_stats(df)['columns']['g']
+    assert stats['levels'] == 2
+    assert stats['min_rows_per_level'] == 10
+
+
+def test_grouping_with_unused_categories_is_kept():
+    df = _frame(20, "ab", "abcdefghijklmnop", 'g')
+    assert models_filter.filter_dumb_models(df, ['y ~ 1 + (x | g)']) == ['y ~ 1 + (x | g)']
+    assert 1 in models_generator.multilevel_groupings(df, ['x', 'g'])
+
+
+def test_fixed_effect_with_unused_categories_is_kept():
+    df = _frame(12, "ab", "abcdefghijklm", 'c')
+    assert models_filter.filter_dumb_models(df, ['y ~ c', 'y ~ x + c']) == ['y ~ c', 'y ~ x + c']
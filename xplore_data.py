@@ -24,7 +24,8 @@ gridExtra = rpy2.robjects.packages.importr('gridExtra')
 from data_cleaner import clean_dataframe
 import ydata_profiling_generator
 from vars_conversion import load_yprofiling_report, build_dtypes_dict, convert_datatypes, represent_dtype_changelog, adapt_r
-from print_models_amount import models_amount_msg
+from print_models_amount import models_amount_msg, plan_sweep
+from models_filter import filter_collinear_models
 import models_generator
 import models_features
 import models_comparison
@@ -36,11 +37,32 @@ import gen_obsidian_vault
 
 # Generate a JSON report and take data from it for an
 # intelligent categorization of the database variablels.
-def xplore_data(df, response_var, predictor_vars, print_r_warnings=True, vault_path=""):
+def xplore_data(
+    df, response_var, predictor_vars, print_r_warnings=True, vault_path="", max_seconds=None,
+    max_bytes=None, on_exceed="raise", max_vif=None, fit_timeout=None, deadline=None,
+    store_path=None,
+):
     '''A function to automate models generation, models performances
     and graphical representations for psychological research. It
     generates a JSON report and takes data from it for an
     intelligent categorization of the database variablels.
+
+    With max_seconds and/or max_bytes, the size of the sweep is estimated
+    before the models are generated, and a sweep over that budget is
+    refused (on_exceed="raise") or narrowed to fewer model families
+    (on_exceed="narrow"), see print_models_amount.plan_sweep.
+
+    With max_vif, the formulas with a variance inflation factor over it are
+    dropped before fitting (see models_filter.filter_collinear_models).
+
+    With fit_timeout, a mixed model whose fit takes longer than that many
+    seconds is abandoned (status "timeout" in models.json); with deadline,
+    the sweep stops after that many seconds and ranks the models evaluated
+    so far (see models_features.compute_models_indexes).
+
+    With store_path, the results are written to a columnar results store
+    instead of models.json, and the composite scores are added to it as a
+    new column (see models_store).
     '''
     # Set environment variable for R_HOME
     os.environ['R_HOME'] = '/usr/lib/R'
@@ -69,8 +91,17 @@ def xplore_data(df, response_var, predictor_vars, print_r_warnings=True, vault_p
     # Transfer the DataFrame to R's global environment
     rpy2.robjects.globalenv['df_r'] = rpy2.robjects.pandas2ri.py2rpy(df_r)
 
+    # Check the sweep against the budget before generating it
+    families = models_generator.MODEL_FAMILIES
+    if max_seconds is not None or max_bytes is not None:
+        families, _ = plan_sweep(df, response_var, predictor_vars, max_seconds, max_bytes, on_exceed)
+
     # Generate model formulas based on the response and predictor variables
-    model_formulas = models_generator.generate_all_models(df, response_var, predictor_vars)
+    model_formulas = models_generator.generate_all_models(df, response_var, predictor_vars, families=families)
+
+    # Drop the near-collinear formulas before fitting them
+    if max_vif is not None:
+        model_formulas = filter_collinear_models(df, model_formulas, max_vif=max_vif)
 
     # Output generated models amount
     models_amount_msg(model_formulas)
@@ -83,11 +114,16 @@ def xplore_data(df, response_var, predictor_vars, print_r_warnings=True, vault_p
     rpy2.robjects.r("str(df_r)")
     
     # Compute evaluation indexes
-    models_indexes = models_features.compute_models_indexes(df, model_formulas)
+    if store_path is None:
+        models_indexes = models_features.compute_models_indexes(df, model_formulas, fit_timeout=fit_timeout, deadline=deadline)
+    else:
+        models_indexes = models_features.compute_models_indexes(
+            df, model_formulas, output_file=None, fit_timeout=fit_timeout, deadline=deadline, store_path=store_path
+        )
 
     # Perform weighted evaluation and return the best models formulae and
     # the relative composite scores
-    best_models = models_comparison.weighted_evaluation(models_indexes['non_mixed'], models_indexes['mixed'])
+    best_models = models_comparison.weighted_evaluation(models_indexes['non_mixed'], models_indexes['mixed'], store_path=store_path)
 
     # Print R warnings if print_warnings is True
     if print_r_warnings: